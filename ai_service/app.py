@@ -12,7 +12,11 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+from services.uploads import SpoolingRequest
+
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('UPLOAD_MAX_BYTES', 50 * 1024 * 1024))
 CORS(app)
 
 # Import route modules
@@ -22,6 +26,7 @@ from routes.health_insights import health_insights_bp
 from routes.diagnostic import diagnostic_bp
 from routes.medication_recommendations import medication_bp
 from routes.pharmacy import pharmacy_bp
+from routes.vitals import vitals_bp
 
 # Register blueprints
 app.register_blueprint(triage_bp, url_prefix='/api/triage')
@@ -30,6 +35,7 @@ app.register_blueprint(health_insights_bp, url_prefix='/api')
 app.register_blueprint(diagnostic_bp, url_prefix='/api')
 app.register_blueprint(medication_bp, url_prefix='/api')
 app.register_blueprint(pharmacy_bp, url_prefix='/api/pharmacy')
+app.register_blueprint(vitals_bp, url_prefix='/api')
 
 @app.route('/')
 def home():
@@ -0,0 +1,218 @@
+"""
+Benchmark end-to-end text extraction over a synthetic lab report corpus.
+
+Generates reports with known text offline: rendered images at several DPIs,
+skews and noise levels, PDFs with a text layer and scanned PDFs. Each file
+goes through OCRService.extract_text_from_file_path, and the benchmark
+reports pages per second, p50/p95 latency, character error rate against the
+ground truth and the peak RSS of the process and its OCR subprocesses.
+
+Usage (from ai_service/):
+    python -m benchmarks.ocr_benchmark [--documents 3] [--output results.json] [--keep corpus/]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from benchmarks.preprocessing_benchmark import TESTS, character_error_rate
+from services.ocr_service import OCRService
+from services.text_compaction import PAGE_MARKER
+
+# A4 in inches
+PAGE_INCHES = (8.27, 11.69)
+
+# name: (kind, dpi, max skew in degrees, noise sigma, pages)
+VARIANTS = {
+    'image-150dpi': ('image', 150, 0, 0, 1),
+    'image-300dpi': ('image', 300, 0, 0, 1),
+    'image-skewed': ('image', 200, 5, 0, 1),
+    'image-noisy': ('image', 200, 0, 20, 1),
+    'image-photo': ('image', 200, 5, 20, 1),
+    'pdf-text': ('text-pdf', 72, 0, 0, 2),
+    'pdf-scanned': ('scanned-pdf', 200, 2, 8, 2),
+}
+
+
+def report_lines(rng: random.Random, page: int) -> List[str]:
+    """Ground-truth lines of one report page"""
+    lines = ['CITY DIAGNOSTIC LABORATORY', f'Report No: {rng.randint(10000, 99999)}  Page {page + 1}',
+             f'Patient: Test Patient  Age: {rng.randint(18, 90)}  Gender: {rng.choice("MF")}']
+    for name, value, unit, reference in rng.sample(TESTS, len(TESTS)):
+        jittered = f'{float(value) * rng.uniform(0.7, 1.3):.1f}'
+        lines.append(f'{name}  {jittered} {unit}  Ref: {reference}')
+    return lines
+
+
+def render_image(lines: List[str], dpi: int, skew: float, noise: float, seed: int) -> Image.Image:
+    """Render report lines on a page of the given DPI, rotated and with Gaussian noise"""
+    width, height = round(PAGE_INCHES[0] * dpi), round(PAGE_INCHES[1] * dpi)
+    page = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(page)
+    # 11 pt text
+    font = ImageFont.load_default(size=max(10, round(11 * dpi / 72)))
+    margin, leading = dpi, round(0.3 * dpi)
+    for index, line in enumerate(lines):
+        draw.text((margin, margin + index * leading), line, fill=0, font=font)
+
+    if skew:
+        page = page.rotate(skew, resample=Image.Resampling.BICUBIC, fillcolor=255)
+    if noise:
+        pixels = np.asarray(page, dtype=np.float32)
+        pixels += np.random.default_rng(seed).normal(0, noise, pixels.shape)
+        page = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    return page
+
+
+def _escape_pdf_text(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def text_layer_pdf(pages: List[List[str]]) -> bytes:
+    """A minimal PDF with one Helvetica text page per list of lines"""
+    page_count = len(pages)
+    font_id = 3 + 2 * page_count
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join(f'{3 + 2 * index} 0 R' for index in range(page_count)), page_count)
+    ]
+    for index, lines in enumerate(pages):
+        stream = 'BT /F1 11 Tf 14 TL 72 770 Td ' + ' '.join(
+            f'({_escape_pdf_text(line)}) Tj T*' for line in lines) + ' ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                       f'/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {4 + 2 * index} 0 R >>')
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    objects.append('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    output = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f'{number} 0 obj\n{body}\nendobj\n'.encode('latin-1')
+    xref = len(output)
+    output += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    output += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    output += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    return output
+
+
+def build_corpus(directory: str, documents: int) -> List[Dict[str, Any]]:
+    """
+    Write the synthetic corpus
+
+    Returns:
+        Entries with the variant, path, page count and ground-truth text of each file
+    """
+    corpus = []
+    for variant, (kind, dpi, max_skew, noise, page_count) in VARIANTS.items():
+        for number in range(documents):
+            seed = zlib.crc32(f'{variant}-{number}'.encode())
+            rng = random.Random(seed)
+            pages = [report_lines(rng, page) for page in range(page_count)]
+            skews = [rng.uniform(-max_skew, max_skew) for _ in pages]
+            path = os.path.join(directory, f'{variant}-{number}.{"png" if kind == "image" else "pdf"}')
+
+            if kind == 'text-pdf':
+                with open(path, 'wb') as f:
+                    f.write(text_layer_pdf(pages))
+            else:
+                images = [render_image(lines, dpi, skew, noise, seed + index)
+                          for index, (lines, skew) in enumerate(zip(pages, skews))]
+                if kind == 'image':
+                    images[0].save(path, dpi=(dpi, dpi))
+                else:
+                    images[0].save(path, 'PDF', resolution=dpi, save_all=True, append_images=images[1:])
+
+            corpus.append({
+                'variant': variant,
+                'path': path,
+                'pages': page_count,
+                'truth': '\n'.join('\n'.join(lines) for lines in pages)
+            })
+    return corpus
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    return float(np.percentile(values, fraction * 100)) if values else 0.0
+
+
+def peak_rss_mb() -> Tuple[float, float]:
+    """Peak resident set size of this process and of its largest finished child, in MB"""
+    if resource is None:
+        return 0.0, 0.0
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def run(documents: int, output: str = None, keep: str = None) -> Dict[str, Any]:
+    service = OCRService()
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = keep or scratch
+        os.makedirs(directory, exist_ok=True)
+        corpus = build_corpus(directory, documents)
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for entry in corpus:
+            started = time.perf_counter()
+            result = service.extract_text_from_file_path(entry['path'])
+            elapsed = time.perf_counter() - started
+
+            group = results.setdefault(entry['variant'], {'latencies': [], 'pages': 0, 'errors': [], 'failures': 0})
+            if not result['success']:
+                group['failures'] += 1
+                print(f"{entry['path']}: {result['error']}")
+                continue
+            group['latencies'].append(elapsed)
+            group['pages'] += entry['pages']
+            text = PAGE_MARKER.sub('', result['extracted_text'])
+            group['errors'].append(character_error_rate(entry['truth'], text))
+
+    print(f"{'variant':<14} {'docs':>5} {'pages/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'CER':>7} {'failed':>7}")
+    summary = {}
+    for variant, group in results.items():
+        latencies = group['latencies']
+        summary[variant] = {
+            'documents': len(latencies) + group['failures'],
+            'pagesPerSecond': round(group['pages'] / sum(latencies), 2) if sum(latencies) else 0.0,
+            'p50Ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'p95Ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'cer': round(statistics.mean(group['errors']), 4) if group['errors'] else None,
+            'failed': group['failures']
+        }
+        row = summary[variant]
+        cer = f"{row['cer']:.3f}" if row['cer'] is not None else 'n/a'
+        print(f"{variant:<14} {row['documents']:>5} {row['pagesPerSecond']:>8.2f} {row['p50Ms']:>9.1f} "
+              f"{row['p95Ms']:>9.1f} {cer:>7} {row['failed']:>7}")
+
+    process_rss, child_rss = peak_rss_mb()
+    print(f"peak RSS: {process_rss:.0f} MB (largest OCR subprocess {child_rss:.0f} MB)")
+
+    report = {'variants': summary, 'peakRssMb': round(process_rss, 1), 'peakChildRssMb': round(child_rss, 1)}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=3, help='documents per variant')
+    parser.add_argument('--output', help='write the results as JSON to compare runs')
+    parser.add_argument('--keep', help='write the corpus to this directory instead of a temporary one')
+    arguments = parser.parse_args()
+    run(arguments.documents, arguments.output, arguments.keep)
@@ -1,9 +1,18 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+import json
 import logging
+import os
 import time
+from datetime import datetime
 from services.gemini_wrapper import GeminiService
 from services.ocr_service import OCRService
 from services.diagnostic_analysis_service import DiagnosticAnalysisService
+from services.diagnostic_pipeline import DiagnosticPipeline, PipelineContext, PipelineError
+from services.result_store import DiagnosticResultStore
+from services.ocr_prefetch import OCRPrefetcher
+from services.layout_templates import LayoutTemplateStore
+from services.batch_extraction import BatchExtractor
+from services.ocr_admission import OCRAdmissionController, OCROverloadedError
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -15,6 +24,65 @@ diagnostic_bp = Blueprint('diagnostic', __name__)
 gemini_service = GeminiService()
 ocr_service = OCRService()
 diagnostic_service = DiagnosticAnalysisService(gemini_service)
+result_store = DiagnosticResultStore()
+layout_templates = LayoutTemplateStore()
+ocr_admission = OCRAdmissionController()
+diagnostic_pipeline = DiagnosticPipeline(ocr_service, diagnostic_service, result_store=result_store,
+                                         layout_templates=layout_templates, admission=ocr_admission)
+ocr_prefetcher = OCRPrefetcher(diagnostic_pipeline.extract_text, key=ocr_service.document_key)
+diagnostic_pipeline.prefetcher = ocr_prefetcher
+batch_extractor = BatchExtractor(ocr_service, admission=ocr_admission)
+
+# Most documents accepted by one batch extraction request
+OCR_BATCH_MAX_FILES = int(os.getenv('OCR_BATCH_MAX_FILES', 10000))
+
+
+def _build_pipeline_context():
+    """
+    Validate a diagnostic request and build its pipeline context
+    
+    Accepts a JSON payload, or multipart/form-data with the same fields and
+    the document in a "file" part.
+    """
+    upload = request.files.get('file')
+    data = request.form if upload else request.get_json(silent=True)
+    if not data:
+        raise PipelineError('No data provided', 400)
+    
+    test_result_id = data.get('testResultId')
+    if not test_result_id:
+        raise PipelineError('testResultId is required', 400)
+    
+    force = data.get('force', False)
+    context = PipelineContext(
+        test_result_id=test_result_id,
+        attachment_url=data.get('attachmentUrl'),
+        file_path=data.get('filePath'),
+        test_type=data.get('testType'),
+        findings=data.get('findings', ''),
+        force=force.lower() == 'true' if isinstance(force, str) else bool(force)
+    )
+    
+    if upload:
+        try:
+            context.attach_upload(
+                ocr_service.open_upload(upload.stream, upload.filename or 'upload', upload.mimetype),
+                upload.filename or 'upload'
+            )
+        except ValueError as e:
+            raise PipelineError(str(e), 400)
+    return context
+
+
+def _parse_timestamp(value):
+    """Parse an ISO date or datetime query parameter into a Unix timestamp"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        raise PipelineError(f'Invalid date: {value}', 400)
+
 
 @diagnostic_bp.route('/generate-insights', methods=['POST'])
 def generate_insights():
@@ -25,86 +93,30 @@ def generate_insights():
     {
         "testResultId": "string",
         "attachmentUrl": "string (optional)",
+        "filePath": "string (optional, path under the shared uploads directory)",
         "testType": "string (optional)",
-        "findings": "string (optional)"
+        "findings": "string (optional)",
+        "force": "boolean (optional, recompute instead of returning a stored result)"
     }
     
+    The document can also be sent as multipart/form-data in a "file" part.
+    
     Returns insights in format matching DiagnosticInsights model
     """
     try:
-        start_time = time.time()
-        
-        # Get request data
-        data = request.get_json()
-        if not data:
-            return jsonify({
-                'success': False,
-                'message': 'No data provided'
-            }), 400
-        
-        test_result_id = data.get('testResultId')
-        attachment_url = data.get('attachmentUrl')
-        test_type = data.get('testType')
-        findings = data.get('findings', '')
-        
-        if not test_result_id:
-            return jsonify({
-                'success': False,
-                'message': 'testResultId is required'
-            }), 400
-        
-        logger.info(f"Generating insights for test result: {test_result_id}")
-        
-        extracted_text = ""
-        ocr_metadata = {}
-        
-        # Extract text from attachment if provided
-        if attachment_url:
-            logger.info(f"Processing attachment: {attachment_url}")
-            ocr_result = ocr_service.extract_text_from_url(attachment_url)
-            
-            if ocr_result['success']:
-                extracted_text = ocr_result['extracted_text']
-                ocr_metadata = ocr_result['metadata']
-                logger.info(f"Successfully extracted {len(extracted_text)} characters")
-            else:
-                logger.error(f"OCR failed: {ocr_result.get('error')}")
-                return jsonify({
-                    'success': False,
-                    'message': f"Failed to extract text: {ocr_result.get('error')}"
-                }), 400
-        
-        # Combine extracted text with existing findings
-        combined_text = f"{extracted_text}\n\nAdditional Findings:\n{findings}".strip()
-        
-        if not combined_text:
-            return jsonify({
-                'success': False,
-                'message': 'No content available for analysis'
-            }), 400
-        
-        # Perform AI analysis
-        analysis_result = diagnostic_service.analyze_diagnostic_report(
-            ocr_text=combined_text,
-            test_type=test_type,
-            findings=findings
-        )
-        
-        if not analysis_result['success']:
-            return jsonify({
-                'success': False,
-                'message': f"AI analysis failed: {analysis_result.get('error')}"
-            }), 500
+        context = _build_pipeline_context()
+        logger.info(f"Generating insights for test result: {context.test_result_id}")
         
-        processing_time = int((time.time() - start_time) * 1000)
+        diagnostic_pipeline.run(context)
         
-        # Format response to match DiagnosticInsights model
-        insights_data = analysis_result['data']
+        processing_time = int(context.elapsed_ms)
+        insights_data = context.analysis
+        ocr_metadata = context.ocr_metadata
         
         # Map the analysis result to match our MongoDB model structure
         formatted_insights = {
-            'testResultId': test_result_id,
-            'extractedText': extracted_text,
+            'testResultId': context.test_result_id,
+            'extractedText': context.extracted_text,
             'structuredData': insights_data.get('structuredData', {}),
             'abnormalFindings': insights_data.get('abnormalFindings', []),
             'aiSummary': insights_data.get('aiSummary', ''),
@@ -114,11 +126,11 @@ def generate_insights():
             }),
             'processingStatus': 'completed',
             'confidence': insights_data.get('confidence', 0.8),
-            'aiModel': 'gemini-1.5-flash',
+            'aiModel': insights_data.get('aiModel', 'gemini-1.5-flash'),
             'sourceFile': {
-                'fileName': ocr_metadata.get('fileName', 'unknown'),
-                'fileType': ocr_metadata.get('fileType', 'unknown'),
-                'fileSize': ocr_metadata.get('fileSize', 0),
+                'fileName': context.file_name or 'unknown',
+                'fileType': ocr_metadata.get('file_type', 'unknown'),
+                'fileSize': ocr_metadata.get('file_size', 0),
                 'processingTime': processing_time
             }
         }
@@ -128,11 +140,18 @@ def generate_insights():
             'data': formatted_insights,
             'metadata': {
                 'processingTime': processing_time,
-                'textLength': len(combined_text),
-                'ocrMetadata': ocr_metadata
+                'textLength': len(context.combined_text),
+                'ocrMetadata': ocr_metadata,
+                'pipeline': context.summary()
             }
         })
         
+    except PipelineError as e:
+        logger.error(f"Insights pipeline failed: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code, e.headers
     except Exception as e:
         logger.error(f"Error generating insights: {str(e)}")
         return jsonify({
@@ -150,109 +169,218 @@ def analyze_diagnostic():
     {
         "testResultId": "string",
         "attachmentUrl": "string (optional)",
+        "filePath": "string (optional, path under the shared uploads directory)",
         "testType": "string (optional)",
-        "findings": "string (optional)"
+        "findings": "string (optional)",
+        "force": "boolean (optional, recompute instead of returning a stored result)"
     }
+    
+    The document can also be sent as multipart/form-data in a "file" part.
     """
     try:
-        start_time = time.time()
+        context = _build_pipeline_context()
+        logger.info(f"Starting diagnostic analysis for test result: {context.test_result_id}")
         
-        # Get request data
-        data = request.get_json()
-        if not data:
-            return jsonify({
-                'success': False,
-                'message': 'No data provided'
-            }), 400
-        
-        test_result_id = data.get('testResultId')
-        attachment_url = data.get('attachmentUrl')
-        test_type = data.get('testType')
-        findings = data.get('findings', '')
+        diagnostic_pipeline.run(context)
         
-        if not test_result_id:
-            return jsonify({
-                'success': False,
-                'message': 'testResultId is required'
-            }), 400
-        
-        logger.info(f"Starting diagnostic analysis for test result: {test_result_id}")
+        # Calculate processing time
+        processing_time = context.elapsed_ms
         
-        extracted_text = ""
-        ocr_metadata = {}
+        # Add metadata to the result
+        result_data = dict(context.analysis)
+        result_data.update({
+            'fileName': context.file_name,
+            'fileType': context.ocr_metadata.get('file_type', 'unknown'),
+            'fileSize': context.ocr_metadata.get('file_size', 0),
+            'processingTime': processing_time,
+            'ocrMetadata': context.ocr_metadata
+        })
         
-        # Extract text from attachment if provided
-        if attachment_url:
-            logger.info(f"Extracting text from attachment: {attachment_url}")
-            ocr_result = ocr_service.extract_text_from_url(attachment_url)
-            
-            if ocr_result['success']:
-                extracted_text = ocr_result['extracted_text']
-                ocr_metadata = ocr_result['metadata']
-                
-                # Validate if this looks like a medical document
-                validation = ocr_service.validate_medical_document(extracted_text)
-                logger.info(f"Document validation: {validation}")
-                
-                if not validation['is_likely_medical']:
-                    logger.warning("Document may not be a medical report")
-            else:
-                logger.error(f"OCR extraction failed: {ocr_result.get('error')}")
-                return jsonify({
-                    'success': False,
-                    'message': f"Failed to extract text from document: {ocr_result.get('error')}"
-                }), 400
+        logger.info(f"Diagnostic analysis completed in {processing_time:.2f}ms")
         
-        # Combine extracted text with existing findings
-        combined_text = f"{extracted_text}\n\nAdditional Findings:\n{findings}".strip()
+        return jsonify({
+            'success': True,
+            'message': 'Diagnostic analysis completed successfully',
+            'data': result_data,
+            'metadata': {
+                'pipeline': context.summary()
+            }
+        })
         
-        if not combined_text:
+    except PipelineError as e:
+        logger.error(f"Diagnostic pipeline failed: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code, e.headers
+    except Exception as e:
+        logger.error(f"Error in diagnostic analysis: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Internal server error during analysis',
+            'error': str(e)
+        }), 500
+
+@diagnostic_bp.route('/ocr-prefetch', methods=['POST'])
+def prefetch_text():
+    """
+    Queue background text extraction of a newly uploaded attachment
+    
+    Returns 202 immediately; a later /generate-insights request for the same
+    attachmentUrl starts from the extracted text.
+    
+    Expected JSON payload:
+    {
+        "attachmentUrl": "string (or filePath, a path under the shared uploads directory)"
+    }
+    """
+    try:
+        data = request.get_json()
+        attachment_url = data and (data.get('filePath') or data.get('attachmentUrl'))
+        if not attachment_url:
             return jsonify({
                 'success': False,
-                'message': 'No text content available for analysis (no attachment or findings provided)'
+                'message': 'attachmentUrl is required'
             }), 400
         
-        logger.info(f"Analyzing {len(combined_text)} characters of text")
+        status = ocr_prefetcher.submit(attachment_url)
+        logger.info(f"OCR prefetch {status} for: {attachment_url}")
         
-        # Perform AI analysis
-        analysis_result = diagnostic_service.analyze_diagnostic_report(
-            ocr_text=combined_text,
-            test_type=test_type,
-            findings=findings
-        )
+        return jsonify({
+            'success': True,
+            'data': {
+                'attachmentUrl': attachment_url,
+                'status': status
+            }
+        }), 202
         
-        if not analysis_result['success']:
-            return jsonify({
-                'success': False,
-                'message': f"AI analysis failed: {analysis_result.get('error')}"
-            }), 500
+    except Exception as e:
+        logger.error(f"Error queuing OCR prefetch: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to queue OCR prefetch',
+            'error': str(e)
+        }), 500
+
+@diagnostic_bp.route('/ocr-prefetch', methods=['GET'])
+def prefetch_status():
+    """Status of a prefetched attachment: pending, ready, failed or not_found"""
+    attachment_url = request.args.get('attachmentUrl')
+    if not attachment_url:
+        return jsonify({
+            'success': False,
+            'message': 'attachmentUrl is required'
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'data': {
+            'attachmentUrl': attachment_url,
+            'status': ocr_prefetcher.status(attachment_url) or 'not_found'
+        }
+    })
+
+@diagnostic_bp.route('/diagnostic-results', methods=['GET'])
+def list_diagnostic_results():
+    """
+    List stored diagnostic analyses created in a date range, newest first
+    
+    Query parameters:
+        from: ISO date or datetime (optional)
+        to: ISO date or datetime (optional)
+        limit: Maximum number of results (default 100, max 1000)
+        includeData: Include the stored analyses when "true"
+    """
+    try:
+        start = _parse_timestamp(request.args.get('from'))
+        end = _parse_timestamp(request.args.get('to'))
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        include_data = request.args.get('includeData', 'false').lower() == 'true'
         
-        # Calculate processing time
-        processing_time = (time.time() - start_time) * 1000  # Convert to milliseconds
+        results = result_store.list_results(start, end, limit=limit, include_payload=include_data)
+        for result in results:
+            result['createdAt'] = datetime.utcfromtimestamp(result['createdAt']).isoformat()
         
-        # Add metadata to the result
-        result_data = analysis_result['data']
-        result_data.update({
-            'fileName': attachment_url.split('/')[-1] if attachment_url else None,
-            'fileType': ocr_metadata.get('file_type', 'unknown'),
-            'fileSize': ocr_metadata.get('file_size', 0),
-            'processingTime': processing_time,
-            'ocrMetadata': ocr_metadata
+        return jsonify({
+            'success': True,
+            'data': results,
+            'count': len(results)
         })
         
-        logger.info(f"Diagnostic analysis completed in {processing_time:.2f}ms")
+    except PipelineError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code, e.headers
+    except Exception as e:
+        logger.error(f"Error listing diagnostic results: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to list diagnostic results',
+            'error': str(e)
+        }), 500
+
+@diagnostic_bp.route('/diagnostic-results/<test_result_id>', methods=['DELETE'])
+def delete_diagnostic_results(test_result_id):
+    """Delete the stored analyses of a test result"""
+    try:
+        removed = result_store.delete_test_result(test_result_id)
+        return jsonify({
+            'success': True,
+            'data': {'removed': removed}
+        })
+        
+    except Exception as e:
+        logger.error(f"Error deleting diagnostic results: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to delete diagnostic results',
+            'error': str(e)
+        }), 500
+
+@diagnostic_bp.route('/layout-templates', methods=['GET'])
+def list_layout_templates():
+    """List learned report layout templates with their sample and use counts"""
+    try:
+        templates = layout_templates.list_templates()
+        for template in templates:
+            template['usable'] = template['samples'] >= layout_templates.min_samples
+            for key in ('createdAt', 'updatedAt'):
+                template[key] = datetime.utcfromtimestamp(template[key]).isoformat()
         
         return jsonify({
             'success': True,
-            'message': 'Diagnostic analysis completed successfully',
-            'data': result_data
+            'data': templates,
+            'count': len(templates)
         })
         
     except Exception as e:
-        logger.error(f"Error in diagnostic analysis: {str(e)}")
+        logger.error(f"Error listing layout templates: {str(e)}")
         return jsonify({
             'success': False,
-            'message': 'Internal server error during analysis',
+            'message': 'Failed to list layout templates',
+            'error': str(e)
+        }), 500
+
+@diagnostic_bp.route('/layout-templates/<int:template_id>', methods=['DELETE'])
+def delete_layout_template(template_id):
+    """Forget a learned layout template"""
+    try:
+        if not layout_templates.delete(template_id):
+            return jsonify({
+                'success': False,
+                'message': 'Layout template not found'
+            }), 404
+        return jsonify({
+            'success': True,
+            'data': {'removed': 1}
+        })
+        
+    except Exception as e:
+        logger.error(f"Error deleting layout template: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': 'Failed to delete layout template',
             'error': str(e)
         }), 500
 
@@ -277,8 +405,9 @@ def extract_text_only():
         file_url = data['fileUrl']
         logger.info(f"Extracting text from: {file_url}")
         
-        # Extract text using OCR
-        ocr_result = ocr_service.extract_text_from_url(file_url)
+        # Extract text using OCR once a slot is free
+        with ocr_admission.admit('extract') as ticket:
+            ocr_result = ocr_service.extract_text_from_url(file_url)
         
         if ocr_result['success']:
             # Validate document
@@ -289,7 +418,8 @@ def extract_text_only():
                 'data': {
                     'extractedText': ocr_result['extracted_text'],
                     'metadata': ocr_result['metadata'],
-                    'validation': validation
+                    'validation': validation,
+                    'admission': ticket['usage']
                 }
             })
         else:
@@ -298,6 +428,11 @@ def extract_text_only():
                 'message': f"Text extraction failed: {ocr_result.get('error')}"
             }), 400
             
+    except OCROverloadedError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.error(f"Error in text extraction: {str(e)}")
         return jsonify({
@@ -306,6 +441,76 @@ def extract_text_only():
             'error': str(e)
         }), 500
 
+@diagnostic_bp.route('/ocr-extract/batch', methods=['POST'])
+def extract_text_batch():
+    """
+    Extract text from many documents, streaming each result as it finishes
+    
+    Expected JSON payload:
+    {
+        "fileUrls": ["string"] (optional),
+        "filePaths": ["string"] (optional, paths under the shared uploads directory)
+    }
+    
+    Responds with NDJSON: one line per document in completion order, with its
+    position in the request as "index", then a final summary line.
+    """
+    data = request.get_json(silent=True) or {}
+    sources = []
+    for key in ('fileUrls', 'filePaths'):
+        values = data.get(key) or []
+        if not isinstance(values, list) or not all(isinstance(value, str) and value for value in values):
+            return jsonify({
+                'success': False,
+                'message': f'{key} must be a list of strings'
+            }), 400
+        sources.extend(values)
+    
+    if not sources:
+        return jsonify({
+            'success': False,
+            'message': 'fileUrls or filePaths is required'
+        }), 400
+    if len(sources) > OCR_BATCH_MAX_FILES:
+        return jsonify({
+            'success': False,
+            'message': f'At most {OCR_BATCH_MAX_FILES} files per request'
+        }), 400
+    
+    # Each document takes an OCR slot while it is extracted; an overloaded
+    # service turns the batch away before it starts
+    try:
+        ocr_admission.check('batch')
+    except OCROverloadedError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 503, {'Retry-After': str(e.retry_after)}
+    
+    logger.info(f"Batch extracting text from {len(sources)} documents")
+    
+    def generate():
+        started = time.perf_counter()
+        succeeded = failed = 0
+        queue_ms = 0.0
+        for result in batch_extractor.extract(sources):
+            if result['success']:
+                succeeded += 1
+                queue_ms += result['queueMs']
+            else:
+                failed += 1
+            yield json.dumps(result, default=str) + '\n'
+        yield json.dumps({
+            'done': True,
+            'total': len(sources),
+            'succeeded': succeeded,
+            'failed': failed,
+            'durationMs': round((time.perf_counter() - started) * 1000, 2),
+            'queueMs': round(queue_ms, 2)
+        }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @diagnostic_bp.route('/validate-document', methods=['POST'])
 def validate_document():
     """
@@ -1,6 +1,7 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, Response, jsonify
 import os
 from datetime import datetime
+from services.metrics import metrics
 
 health_bp = Blueprint('health', __name__)
 
@@ -32,4 +33,9 @@ def health_check():
             'status': 'unhealthy',
             'error': str(e),
             'timestamp': datetime.utcnow().isoformat()
-        }), 500
\ No newline at end of file
+        }), 500
+
+@health_bp.route('/metrics', methods=['GET'])
+def metrics_export():
+    """Export service metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,21 +1,71 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 import logging
+import os
+import queue
+import threading
+import time
 import traceback
 import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Callable, Optional, Tuple
 from services.gemini_service import GeminiAIService
+from pydantic import ValidationError
+from services.llm_schemas import (HEALTH_INSIGHTS_TASK, PERSONALIZED_TIPS_TASK, RISK_SUMMARY_TASK,
+                                  TREND_NARRATIVE_TASK, PersonalizedTip, RiskFactor)
+from services.vitals_trends import VITAL_SERIES, VitalSeries, analyze_trends, sample_readings
+from services.health_scoring import score_patient, score_patients
+from services.insights_cache import InsightsCache, insights_cache_keys
+from routes.vitals import vitals_store
 
 # Create blueprint for health insights
 health_insights_bp = Blueprint('health_insights', __name__)
 
-# Initialize Gemini service
 gemini_service = GeminiAIService()
 
+# Days of stored vitals used when a request references a patient instead of sending vitals
+STORED_VITALS_DAYS = float(os.getenv('HEALTH_INSIGHTS_STORED_VITALS_DAYS', 365))
+
+# Readings per vital included in the prompt; longer series are downsampled
+READINGS_PER_VITAL = int(os.getenv('HEALTH_INSIGHTS_READINGS_PER_VITAL', 24))
+
+# Generated insights per patient, refreshed in the background when the data changes
+insights_cache = InsightsCache() if os.getenv('INSIGHTS_CACHE', 'True').lower() == 'true' else None
+
+# Decomposed mode: per-vital trend narratives, tips and risk summary as concurrent smaller calls
+DECOMPOSE_DEFAULT = os.getenv('HEALTH_INSIGHTS_DECOMPOSE', 'False').lower() == 'true'
+insight_parts = ThreadPoolExecutor(max_workers=int(os.getenv('HEALTH_INSIGHTS_PARALLEL_CALLS', 6)),
+                                   thread_name_prefix='insights-part')
+
+# Readings per vital in the chart series of streamed responses
+CHART_POINTS = int(os.getenv('HEALTH_INSIGHTS_CHART_POINTS', 120))
+# Seconds between keep-alive comments while a stream waits for the AI
+SSE_KEEPALIVE_SECONDS = 15
+
+# Cohort analysis: patients per request, patients scored together, flagging
+# thresholds and concurrent AI narratives across all cohort requests
+COHORT_MAX_PATIENTS = int(os.getenv('COHORT_MAX_PATIENTS', 10000))
+COHORT_BATCH_SIZE = int(os.getenv('COHORT_BATCH_SIZE', 256))
+COHORT_FLAG_SCORE = int(os.getenv('COHORT_FLAG_SCORE', 60))
+COHORT_LLM_CONCURRENCY = int(os.getenv('COHORT_LLM_CONCURRENCY', 4))
+cohort_narratives = ThreadPoolExecutor(max_workers=COHORT_LLM_CONCURRENCY, thread_name_prefix='cohort-narrative')
+
 @health_insights_bp.route('/health-insights', methods=['POST'])
 def generate_health_insights():
     """
     Generate AI-powered health insights from patient data
+    
+    analysis_type 'quick' returns locally computed trends, health score and
+    risk flags without calling the AI service; any other type ('deep',
+    'comprehensive') adds the AI enrichment. AI insights are cached per
+    patient; send force_refresh to regenerate them. decompose splits the AI
+    work into concurrent smaller calls (defaults to HEALTH_INSIGHTS_DECOMPOSE).
+    
+    With "stream": true (or Accept: text/event-stream) the response is a
+    server-sent event stream; see stream_health_insights.
+    
+    Requests without vitals that carry a patient id ("patient_id", or
+    patient.id) use the readings stored through /api/vitals/ingest.
     """
     try:
         # Get request data
@@ -30,6 +80,11 @@ def generate_health_insights():
         analysis_type = data.get('analysis_type', 'comprehensive')
         include_trends = data.get('include_trends', True)
         include_recommendations = data.get('include_recommendations', True)
+        force_refresh = bool(data.get('force_refresh', False))
+        decompose = bool(data.get('decompose', DECOMPOSE_DEFAULT))
+
+        if not patient_data and data.get('patient_id'):
+            patient_data = {'patient_id': data['patient_id']}
 
         # Validate patient data
         if not patient_data:
@@ -38,20 +93,26 @@ def generate_health_insights():
                 'error': 'Patient data is required'
             }), 400
 
-        # Generate insights using Gemini
-        insights = generate_comprehensive_insights(
-            patient_data, 
-            analysis_type,
-            include_trends,
-            include_recommendations
-        )
+        patient_data, vitals_version = resolve_stored_vitals(patient_data)
 
-        return jsonify({
+        if data.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+            return stream_health_insights(patient_data, analysis_type, include_trends, include_recommendations,
+                                          force_refresh, decompose, vitals_version)
+        
+        # Generate insights using Gemini, reusing cached ones for the same data
+        insights, cache_info = cached_insights(patient_data, analysis_type, include_trends,
+                                               include_recommendations, force_refresh, decompose,
+                                               vitals_version=vitals_version)
+
+        response = {
             'success': True,
             'insights': insights,
             'generated_at': datetime.utcnow().isoformat(),
-            'model_used': 'gemini-pro'
-        })
+            'model_used': insights.get('model_used', 'gemini-pro')
+        }
+        if cache_info:
+            response['cache'] = cache_info
+        return jsonify(response)
 
     except Exception as e:
         logging.error(f"Error generating health insights: {str(e)}")
@@ -64,25 +125,416 @@ def generate_health_insights():
         }), 500
 
 
+def cached_insights(
+    patient_data: Dict[str, Any],
+    analysis_type: str,
+    include_trends: bool,
+    include_recommendations: bool,
+    force_refresh: bool = False,
+    decompose: bool = False,
+    all_trends: Optional[Dict[str, Any]] = None,
+    scoring: Optional[Dict[str, Any]] = None,
+    on_part: Optional[Callable[[str, Any], None]] = None,
+    vitals_version: Optional[str] = None
+) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """
+    Insights of a request from the insights cache, generating them if needed
+    
+    For vitals loaded from the store, vitals_version stands in for the
+    readings in the cache key, so they are not hashed on every request.
+    Stale insights, served while the cache regenerates them, get their
+    trends, health score and computed risk factors recomputed from the
+    current data; only the AI tips and risk factors are from the cache.
+    
+    Returns:
+        Tuple of (insights, cache info or None when the cache was not used)
+    """
+    def generate():
+        trends = all_trends if all_trends is not None else compute_trend_analysis(patient_data)
+        scores = scoring if scoring is not None else score_patient(patient_data, trends)
+        insights = generate_comprehensive_insights(
+            patient_data, 
+            analysis_type,
+            include_trends,
+            include_recommendations,
+            trends,
+            scores,
+            decompose=decompose,
+            on_part=on_part
+        )
+        # The AI's own risk factors, kept apart to rebuild stale entries on newer data
+        computed = {risk['condition'].strip().lower() for risk in scores['riskFactors']}
+        return {
+            'insights': insights,
+            'suggestedRiskFactors': [risk for risk in insights['riskFactors']
+                                     if risk['condition'].strip().lower() not in computed]
+        }
+    
+    if analysis_type == 'quick' or insights_cache is None:
+        return generate()['insights'], None
+    options = {
+        'analysis_type': analysis_type,
+        'include_trends': include_trends,
+        'include_recommendations': include_recommendations,
+        'decompose': decompose
+    }
+    keyed_data = patient_data
+    if vitals_version:
+        keyed_data = {key: value for key, value in patient_data.items() if key != 'vitals'}
+    slot, version = insights_cache_keys(keyed_data, options, vitals_version)
+    # Fallback insights are not cached, so the AI is retried on the next request
+    entry, cache_info = insights_cache.get(
+        slot, version, generate,
+        cacheable=lambda value: value['insights'].get('model_used') != 'fallback',
+        force=force_refresh
+    )
+    if cache_info['status'] != 'stale':
+        return entry['insights'], cache_info
+    
+    trends = all_trends if all_trends is not None else compute_trend_analysis(patient_data)
+    scores = scoring if scoring is not None else score_patient(patient_data, trends)
+    insights = dict(
+        entry['insights'],
+        trendAnalysis=trends if include_trends else {},
+        healthScore=scores['healthScore'],
+        riskFactors=merge_risk_factors(scores['riskFactors'], entry['suggestedRiskFactors'])
+    )
+    return insights, cache_info
+
+
+def stream_health_insights(
+    patient_data: Dict[str, Any],
+    analysis_type: str,
+    include_trends: bool,
+    include_recommendations: bool,
+    force_refresh: bool,
+    decompose: bool,
+    vitals_version: Optional[str] = None
+) -> Response:
+    """
+    Stream health insights as server-sent events, local analytics first
+    
+    Events, in order:
+        local: Computed trends, health score, risk factors, local tips and
+            chart series ("charts"), sent before any AI call
+        tip, riskFactor: Each AI tip or additional risk factor as it is generated
+        trend, tips, risks: Each finished part of a decomposed generation
+        insights: The final insights, as in the JSON response
+        error: Generation failed; the local insights stand
+    """
+    all_trends = compute_trend_analysis(patient_data)
+    scoring = score_patient(patient_data, all_trends)
+    trends = all_trends if include_trends else {}
+    local = generate_local_insights(patient_data, trends, analysis_type, scoring)
+    local['charts'] = build_chart_series(patient_data)
+    
+    events = queue.Queue()
+    streaming = threading.Event()
+    
+    def on_part(name, payload):
+        # A background cache refresh may outlive the stream
+        if streaming.is_set():
+            events.put((name, payload))
+    
+    def work():
+        try:
+            insights, cache_info = cached_insights(patient_data, analysis_type, include_trends,
+                                                   include_recommendations, force_refresh, decompose,
+                                                   all_trends, scoring, on_part, vitals_version)
+            result = {
+                'insights': insights,
+                'generated_at': datetime.utcnow().isoformat(),
+                'model_used': insights.get('model_used', 'gemini-pro')
+            }
+            if cache_info:
+                result['cache'] = cache_info
+            events.put(('insights', result))
+        except Exception as e:
+            logging.error(f"Error streaming health insights: {str(e)}")
+            events.put(('error', {'error': 'Failed to generate health insights', 'details': str(e)}))
+        finally:
+            streaming.clear()
+            events.put(None)
+    
+    def generate():
+        yield sse_event('local', local)
+        if analysis_type == 'quick':
+            yield sse_event('insights', {
+                'insights': local,
+                'generated_at': local['generated_at'],
+                'model_used': 'local'
+            })
+            return
+        
+        streaming.set()
+        threading.Thread(target=work, name='insights-stream', daemon=True).start()
+        while True:
+            try:
+                event = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if event is None:
+                return
+            yield sse_event(*event)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def resolve_stored_vitals(patient_data: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Patient data with the stored vitals of the last STORED_VITALS_DAYS days when
+    the request sent none but names a patient that has some. The vitals are
+    VitalSeries over the store's mapped columns, not reading dicts.
+    
+    Returns:
+        Tuple of (patient data, stored vitals version or None if the request's own vitals are used)
+    """
+    if patient_data.get('vitals'):
+        return patient_data, None
+    patient_id = cohort_patient_id(patient_data)
+    if not patient_id:
+        return patient_data, None
+    vitals_version = vitals_store.version(patient_id)
+    if vitals_version is None:
+        return patient_data, None
+    return dict(patient_data, vitals=vitals_store.vitals(patient_id, STORED_VITALS_DAYS)), vitals_version
+
+def sse_event(event: str, data: Any) -> str:
+    """One server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def build_chart_series(patient_data: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Readings per vital downsampled to CHART_POINTS, with the date and series fields only"""
+    vitals = patient_data.get('vitals') or {}
+    charts = {}
+    for vital_type, series in VITAL_SERIES.items():
+        readings = vitals.get(vital_type) if isinstance(vitals, dict) else None
+        if not readings or not isinstance(readings, (list, VitalSeries)):
+            continue
+        if isinstance(readings, list):
+            readings = [r for r in readings if isinstance(r, dict)]
+        fields = ['date'] + [field for _, field, _, _, _ in series]
+        sampled = sample_readings(vital_type, readings, CHART_POINTS)
+        charts[vital_type] = [{field: reading.get(field) for field in fields} for reading in sampled]
+    return charts
+
+@health_insights_bp.route('/health-insights/cohort', methods=['POST'])
+def generate_cohort_insights():
+    """
+    Generate health insights for a cohort of patients, streaming each result
+    
+    Accepts JSON {"patients": [patient_data, ...], "narratives": bool} or NDJSON
+    (Content-Type application/x-ndjson) with one patient_data object per line.
+    Patients sent without vitals use their stored readings, as in /health-insights.
+    Trends, health scores and risk factors are computed locally for every
+    patient, scored in batches of COHORT_BATCH_SIZE. Only flagged patients
+    (a high risk factor or a score below COHORT_FLAG_SCORE) get AI narratives,
+    at most COHORT_LLM_CONCURRENCY at a time; set "narratives" to false to
+    skip them.
+    
+    Responds with NDJSON: one line per patient in completion order, with its
+    position in the request as "index", then a final summary line.
+    """
+    try:
+        patients, narratives = parse_cohort_request()
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    if not patients:
+        return jsonify({
+            'success': False,
+            'error': 'At least one patient is required'
+        }), 400
+    if len(patients) > COHORT_MAX_PATIENTS:
+        return jsonify({
+            'success': False,
+            'error': f'At most {COHORT_MAX_PATIENTS} patients per request'
+        }), 400
+    
+    logging.info(f"Generating cohort insights for {len(patients)} patients")
+    
+    def line(index, patient_data, insights, flagged):
+        return json.dumps({
+            'index': index,
+            'patientId': cohort_patient_id(patient_data),
+            'flagged': flagged,
+            'insights': insights
+        }, default=str) + '\n'
+    
+    def generate():
+        started = time.perf_counter()
+        flagged_count = narrated = failed = 0
+        pending = {}
+        
+        def finished(futures):
+            nonlocal narrated, failed
+            for future in futures:
+                index, patient_data, local = pending.pop(future)
+                try:
+                    insights = future.result()
+                    narrated += insights.get('model_used') != 'fallback'
+                except Exception as e:
+                    logging.error(f"Cohort narrative failed for patient {index}: {str(e)}")
+                    insights = local
+                    failed += 1
+                yield line(index, patient_data, insights, True)
+        
+        try:
+            for start in range(0, len(patients), COHORT_BATCH_SIZE):
+                batch, versions = zip(*(resolve_stored_vitals(patient_data)
+                                        for patient_data in patients[start:start + COHORT_BATCH_SIZE]))
+                trends = [compute_trend_analysis(patient_data) for patient_data in batch]
+                scores = score_patients(list(batch), trends)
+                for offset, (patient_data, patient_trends, scoring) in enumerate(zip(batch, trends, scores)):
+                    index = start + offset
+                    flagged = is_flagged(scoring)
+                    flagged_count += flagged
+                    local = generate_local_insights(patient_data, patient_trends, 'cohort', scoring)
+                    if not (flagged and narratives):
+                        yield line(index, patient_data, local, flagged)
+                        continue
+                    future = cohort_narratives.submit(cohort_narrative, patient_data, patient_trends, scoring,
+                                                      versions[offset])
+                    pending[future] = (index, patient_data, local)
+                
+                # Stream narratives as they finish; wait when too many are queued
+                done = [future for future in pending if future.done()]
+                yield from finished(done)
+                while len(pending) > COHORT_LLM_CONCURRENCY * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from finished(done)
+            
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from finished(done)
+        finally:
+            # Client went away: drop the narratives that have not started
+            for future in pending:
+                future.cancel()
+        
+        yield json.dumps({
+            'done': True,
+            'total': len(patients),
+            'flagged': flagged_count,
+            'narratives': narrated,
+            'failed': failed,
+            'durationMs': round((time.perf_counter() - started) * 1000, 2)
+        }) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def parse_cohort_request() -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Patients and narratives flag of a cohort request, from JSON or NDJSON
+    
+    Raises:
+        ValueError: If the body is malformed
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        patients = []
+        for number, raw in enumerate(request.get_data().splitlines(), 1):
+            if not raw.strip():
+                continue
+            try:
+                patients.append(json.loads(raw))
+            except ValueError:
+                raise ValueError(f'Line {number} is not valid JSON')
+        narratives = request.args.get('narratives', 'true').lower() == 'true'
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise ValueError('No data provided')
+        patients = data.get('patients') or []
+        narratives = bool(data.get('narratives', True))
+    
+    if not isinstance(patients, list) or not all(isinstance(patient, dict) for patient in patients):
+        raise ValueError('patients must be a list of patient data objects')
+    return patients, narratives
+
+
+def cohort_patient_id(patient_data: Dict[str, Any]) -> Optional[str]:
+    """Patient id of a cohort entry, if it has one"""
+    profile = patient_data.get('patient') or {}
+    patient_id = patient_data.get('patient_id') or profile.get('id') or profile.get('_id')
+    return str(patient_id) if patient_id else None
+
+
+def is_flagged(scoring: Dict[str, Any]) -> bool:
+    """Whether a patient's score or risk factors call for an AI narrative"""
+    return scoring['healthScore']['overall'] < COHORT_FLAG_SCORE or \
+        any(risk['riskLevel'] == 'high' for risk in scoring['riskFactors'])
+
+
+def cohort_narrative(patient_data: Dict[str, Any], trends: Dict[str, Any],
+                     scoring: Dict[str, Any], vitals_version: Optional[str] = None) -> Dict[str, Any]:
+    """
+    AI insights of a flagged cohort patient, shared with single-patient
+    requests through the insights cache
+    """
+    insights, _ = cached_insights(patient_data, 'comprehensive', True, True, decompose=DECOMPOSE_DEFAULT,
+                                  all_trends=trends, scoring=scoring, vitals_version=vitals_version)
+    return insights
+
+
 def generate_comprehensive_insights(
     patient_data: Dict[str, Any],
     analysis_type: str = 'comprehensive',
     include_trends: bool = True,
-    include_recommendations: bool = True
+    include_recommendations: bool = True,
+    all_trends: Optional[Dict[str, Any]] = None,
+    scoring: Optional[Dict[str, Any]] = None,
+    decompose: bool = False,
+    on_part: Optional[Callable[[str, Any], None]] = None
 ) -> Dict[str, Any]:
     """
     Generate comprehensive health insights using Gemini AI
+    
+    Vital trends, the health score and risk factors are computed locally
+    and given to the model as context; they replace whatever the model
+    returns for them, and the model's extra risk factors are appended. The
+    'quick' analysis type skips the model and returns the local insights only.
+    Callers that already analyzed the patient pass all_trends and scoring.
+    With decompose the model is called once per part, concurrently; see
+    generate_decomposed_insights. on_part receives (event, payload) for each
+    AI tip and additional risk factor, or each decomposed part, as it arrives.
     """
     
+    if all_trends is None:
+        all_trends = compute_trend_analysis(patient_data)
+    if scoring is None:
+        scoring = score_patient(patient_data, all_trends)
+    trends = all_trends if include_trends else {}
+    
+    if analysis_type == 'quick':
+        return generate_local_insights(patient_data, trends, analysis_type, scoring)
+    
+    if decompose:
+        try:
+            return generate_decomposed_insights(patient_data, analysis_type, include_recommendations,
+                                                trends, scoring, on_part)
+        except Exception as e:
+            logging.error(f"Error in decomposed insights generation: {str(e)}")
+            return generate_fallback_insights(patient_data, trends, analysis_type, scoring)
+    
     # Build the analysis prompt
-    prompt = build_health_insights_prompt(patient_data, analysis_type, include_trends, include_recommendations)
+    prompt = build_health_insights_prompt(patient_data, analysis_type, include_trends, include_recommendations,
+                                          trends, scoring)
     
     try:
-        # Get insights from Gemini (sync call)
-        response = gemini_service.generate_content_sync(prompt)
-        
-        # Parse the structured response
-        insights = parse_gemini_insights_response(response)
+        # Get insights from Gemini, validated through the compiled insights model
+        insights = gemini_service.generate_json(prompt, task=HEALTH_INSIGHTS_TASK,
+                                                item_paths=[('personalizedTips',), ('riskFactors',)] if on_part else (),
+                                                on_item=streamed_item_handler(scoring, on_part))
+        insights['trendAnalysis'] = trends
+        insights['healthScore'] = scoring['healthScore']
+        insights['riskFactors'] = merge_risk_factors(scoring['riskFactors'], insights.get('riskFactors', []))
         
         # Add metadata and validation
         insights['generated_at'] = datetime.utcnow().isoformat()
@@ -94,49 +546,302 @@ def generate_comprehensive_insights(
     except Exception as e:
         logging.error(f"Error in Gemini insights generation: {str(e)}")
         # Return fallback insights
-        return generate_fallback_insights(patient_data)
+        return generate_fallback_insights(patient_data, trends, analysis_type, scoring)
+
+
+def generate_decomposed_insights(
+    patient_data: Dict[str, Any],
+    analysis_type: str,
+    include_recommendations: bool,
+    trends: Dict[str, Any],
+    scoring: Dict[str, Any],
+    on_part: Optional[Callable[[str, Any], None]] = None
+) -> Dict[str, Any]:
+    """
+    Generate AI insights as independent smaller calls run concurrently
+    
+    Each vital trend gets its own narrative call, and the personalized tips
+    and additional risk factors are one call each. Each prompt carries only
+    what its part needs, so the wall-clock time is that of the slowest call.
+    The parts are merged into the local insights: narratives replace the
+    computed trend summaries, tips replace the local ones and the extra risk
+    factors are appended. A part that fails keeps its local content. Each
+    finished part is passed to on_part as 'trend', 'tips' or 'risks'.
+    
+    Raises:
+        RuntimeError: If every part failed
+    """
+    parts = {f'trend:{vital_type}': (build_trend_narrative_prompt(patient_data, vital_type, entry),
+                                     TREND_NARRATIVE_TASK)
+             for vital_type, entry in trends.items()}
+    if include_recommendations:
+        parts['tips'] = (build_tips_prompt(patient_data, trends, scoring), PERSONALIZED_TIPS_TASK)
+    parts['risks'] = (build_risk_summary_prompt(patient_data, trends, scoring), RISK_SUMMARY_TASK)
+    
+    futures = {insight_parts.submit(gemini_service.generate_json, prompt, task=task): name
+               for name, (prompt, task) in parts.items()}
+    results, failed = {}, []
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logging.error(f"Insights part {name} failed: {str(e)}")
+            failed.append(name)
+            continue
+        if on_part:
+            on_part(*decomposed_part_event(name, results[name], trends, scoring))
+    if not results:
+        raise RuntimeError('All insights parts failed')
+    
+    insights = generate_local_insights(patient_data, trends, analysis_type, scoring)
+    insights['trendAnalysis'] = {vital_type: narrated_trend(entry, results.get(f'trend:{vital_type}'))
+                                 for vital_type, entry in trends.items()}
+    if results.get('tips', {}).get('personalizedTips'):
+        insights['personalizedTips'] = results['tips']['personalizedTips']
+    if 'risks' in results:
+        insights['riskFactors'] = merge_risk_factors(scoring['riskFactors'], results['risks']['riskFactors'])
+    
+    insights['model_used'] = 'gemini-pro'
+    insights['decomposition'] = {'calls': len(parts), 'failed': sorted(failed)}
+    return insights
+
+
+def narrated_trend(entry: Dict[str, Any], narrative: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Computed trend entry with the AI narrative's summary and recommendations, if any"""
+    if not narrative or not narrative['summary']:
+        return entry
+    return dict(entry, summary=narrative['summary'],
+                recommendations=narrative['recommendations'] or entry['recommendations'])
+
+
+def decomposed_part_event(name: str, result: Dict[str, Any], trends: Dict[str, Any],
+                          scoring: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Stream event of a finished decomposed part"""
+    if name.startswith('trend:'):
+        vital_type = name.split(':', 1)[1]
+        return 'trend', {'vitalType': vital_type, 'entry': narrated_trend(trends[vital_type], result)}
+    if name == 'tips':
+        return 'tips', {'personalizedTips': result['personalizedTips']}
+    return 'risks', {'riskFactors': merge_risk_factors(scoring['riskFactors'], result['riskFactors'])}
+
+
+def streamed_item_handler(scoring: Dict[str, Any], on_part: Optional[Callable[[str, Any], None]]):
+    """
+    on_item callback passing each streamed tip, and each risk factor not
+    already computed, to on_part
+    """
+    if on_part is None:
+        return None
+    computed = {risk['condition'].strip().lower() for risk in scoring['riskFactors']}
+    
+    def handle_item(path, item):
+        if not isinstance(item, dict):
+            return
+        try:
+            if path[0] == 'personalizedTips':
+                on_part('tip', PersonalizedTip.model_validate(item).model_dump())
+            else:
+                risk = RiskFactor.model_validate(item).model_dump()
+                if risk['condition'].strip().lower() not in computed:
+                    on_part('riskFactor', risk)
+        except ValidationError:
+            pass
+    
+    return handle_item
+
+def compute_trend_analysis(patient_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compute the trend analysis of the patient's vitals from their readings
+    """
+    vitals = patient_data.get('vitals') or {}
+    height = (patient_data.get('patient') or {}).get('height')
+    return analyze_trends(vitals if isinstance(vitals, dict) else {}, height)
+
+
+def merge_risk_factors(computed: List[Dict[str, Any]], suggested: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Computed risk factors followed by the suggested ones for other conditions
+    """
+    known = {risk['condition'].strip().lower() for risk in computed}
+    return computed + [risk for risk in suggested if risk.get('condition', '').strip().lower() not in known]
 
 
 def build_health_insights_prompt(
     patient_data: Dict[str, Any],
     analysis_type: str,
     include_trends: bool,
-    include_recommendations: bool
+    include_recommendations: bool,
+    trends: Optional[Dict[str, Any]] = None,
+    scoring: Optional[Dict[str, Any]] = None
 ) -> str:
     """
     Build a comprehensive prompt for health insights generation
-    """
     
-    patient = patient_data.get('patient', {})
-    vitals = patient_data.get('vitals', {})
-    medications = patient_data.get('medications', [])
-    conditions = patient_data.get('conditions', [])
-    allergies = patient_data.get('allergies', [])
+    When computed trends are given they are included as context, and the
+    model is asked to leave the trend analysis empty. A computed health
+    score and risk factors are included the same way.
+    """
     
     prompt = f"""
 You are an expert medical AI assistant tasked with analyzing patient health data to provide comprehensive insights, trend analysis, and personalized recommendations.
+"""
+    prompt += build_profile_section(patient_data)
+    prompt += build_vitals_section(patient_data)
+    prompt += build_computed_section(trends, scoring)
+    prompt += build_clinical_section(patient_data)
+    
+    if trends is not None:
+        trend_requirement = 'Vital trends have already been computed from the readings above; return "trendAnalysis" as an empty object and use the computed trends when assessing the patient.'
+    else:
+        trend_requirement = 'Provide trend analysis for each vital that has data.'
+    
+    if scoring:
+        score_requirement = 'The health score and risk factors above were computed from the data; return the computed health score and only risk factors that are not already listed.'
+    else:
+        score_requirement = 'Provide a health score (overall and breakdown for vitals, medications and lifestyle) and risk factors.'
+    
+    prompt += f"""
+
+ANALYSIS REQUIREMENTS:
+{trend_requirement} {score_requirement} Provide personalized tips. Return a JSON object following the response schema.
+
+IMPORTANT GUIDELINES:
+1. Only analyze vitals that have data available
+2. Be specific and actionable in recommendations
+3. Consider medication adherence in your analysis
+4. Factor in chronic conditions when assessing trends
+5. Provide realistic and achievable health tips
+6. Base health scores on actual data patterns
+7. Identify genuine risk factors based on the patient's profile
+8. Use medical knowledge but avoid specific diagnoses
+9. Encourage professional medical consultation when appropriate
+10. Return ONLY valid JSON format
+
+Please analyze this patient's health data and provide comprehensive insights:
+"""
+    
+    return prompt
+
+
+def build_trend_narrative_prompt(patient_data: Dict[str, Any], vital_type: str, entry: Dict[str, Any]) -> str:
+    """Prompt for the narrative of one computed vital trend"""
+    prompt = """
+You are an expert medical AI assistant explaining the trend of one of a patient's vital signs.
+"""
+    prompt += build_profile_section(patient_data)
+    prompt += build_vitals_section(patient_data, only=vital_type)
+    prompt += f"\nCOMPUTED TREND: {vital_type}: {entry['trend']}. {entry['summary']}\n"
+    prompt += build_clinical_section(patient_data)
+    prompt += """
+
+ANALYSIS REQUIREMENTS:
+The trend above was computed from the readings; do not contradict it. Summarize it for the patient in two or three sentences, considering their medications and conditions, and give up to three specific recommendations for this vital. Avoid specific diagnoses. Return a JSON object following the response schema.
+"""
+    return prompt
+
 
+def build_tips_prompt(patient_data: Dict[str, Any], trends: Dict[str, Any], scoring: Dict[str, Any]) -> str:
+    """Prompt for the personalized tips, from the computed analysis rather than raw readings"""
+    prompt = """
+You are an expert medical AI assistant writing personalized health tips for a patient.
+"""
+    prompt += build_profile_section(patient_data)
+    prompt += build_computed_section(trends, scoring)
+    prompt += build_clinical_section(patient_data)
+    prompt += """
+
+ANALYSIS REQUIREMENTS:
+Provide three to six personalized tips that are specific, realistic and actionable, prioritizing the risk factors and worsening trends above. Consider medication adherence and chronic conditions, and encourage professional medical consultation when appropriate. Return a JSON object following the response schema.
+"""
+    return prompt
+
+
+def build_risk_summary_prompt(patient_data: Dict[str, Any], trends: Dict[str, Any], scoring: Dict[str, Any]) -> str:
+    """Prompt for risk factors beyond the computed ones"""
+    prompt = """
+You are an expert medical AI assistant identifying health risk factors for a patient.
+"""
+    prompt += build_profile_section(patient_data)
+    prompt += build_computed_section(trends, scoring)
+    prompt += build_clinical_section(patient_data)
+    prompt += """
+
+ANALYSIS REQUIREMENTS:
+The risk factors above were computed from the data. Return only genuine additional risk factors, based on the profile, conditions, medications and allergies, with prevention tips; return an empty list if there are none. Avoid specific diagnoses. Return a JSON object following the response schema.
+"""
+    return prompt
+
+def build_profile_section(patient_data: Dict[str, Any]) -> str:
+    """Patient profile section of an insights prompt"""
+    patient = patient_data.get('patient', {})
+    return f"""
 PATIENT PROFILE:
 - Age: {patient.get('age', 'N/A')}
 - Gender: {patient.get('gender', 'N/A')}
 - Blood Type: {patient.get('bloodType', 'N/A')}
 - Height: {patient.get('height', 'N/A')}
 - Weight: {patient.get('weight', 'N/A')}
+"""
 
+
+def build_vitals_section(patient_data: Dict[str, Any], only: Optional[str] = None) -> str:
+    """Vital readings section of an insights prompt, optionally for one vital type"""
+    vitals = patient_data.get('vitals', {})
+    prompt = f"""
 VITALS DATA:
 """
     
     # Add vitals information
     for vital_type, readings in vitals.items():
+        if only is not None and vital_type != only:
+            continue
         if readings and len(readings) > 0:
-            prompt += f"\n{vital_type.upper()}:\n"
-            # Add recent readings (limit to prevent token overflow)
-            recent_readings = readings[:10] if len(readings) > 10 else readings
+            # Downsample long series to the token budget, keeping their shape, extremes and latest readings
+            if isinstance(readings, VitalSeries):
+                recent_readings = sample_readings(vital_type, readings, READINGS_PER_VITAL)
+            elif vital_type in VITAL_SERIES:
+                recent_readings = sample_readings(vital_type, [r for r in readings if isinstance(r, dict)],
+                                                  READINGS_PER_VITAL)
+            else:
+                recent_readings = readings[:READINGS_PER_VITAL]
+            prompt += f"\n{vital_type.upper()} ({len(recent_readings)} of {len(readings)} readings):\n"
             for reading in recent_readings:
                 if vital_type == 'bloodPressure':
                     prompt += f"  - {reading.get('date', 'N/A')}: {reading.get('systolic', 'N/A')}/{reading.get('diastolic', 'N/A')} mmHg\n"
                 else:
                     prompt += f"  - {reading.get('date', 'N/A')}: {reading.get('value', 'N/A')}\n"
+    return prompt
+
+
+def build_computed_section(trends: Optional[Dict[str, Any]], scoring: Optional[Dict[str, Any]]) -> str:
+    """Locally computed trends, health score and risk factors section of an insights prompt"""
+    prompt = ''
+    
+    # Add the computed trends
+    if trends:
+        prompt += f"\nCOMPUTED VITAL TRENDS:\n"
+        for vital_type, entry in trends.items():
+            prompt += f"  - {vital_type}: {entry['trend']}. {entry['summary']}\n"
+    
+    # Add the computed health score and risk factors
+    if scoring:
+        score = scoring['healthScore']
+        prompt += (f"\nCOMPUTED HEALTH SCORE: {score['overall']} (vitals {score['breakdown']['vitals']}, "
+                   f"medications {score['breakdown']['medications']}, lifestyle {score['breakdown']['lifestyle']})\n")
+        if scoring['riskFactors']:
+            prompt += f"\nCOMPUTED RISK FACTORS:\n"
+            for risk in scoring['riskFactors']:
+                prompt += f"  - {risk['condition']} ({risk['riskLevel']}): {'; '.join(risk['factors'])}\n"
+    return prompt
+
+
+def build_clinical_section(patient_data: Dict[str, Any]) -> str:
+    """Medications, chronic conditions and allergies section of an insights prompt"""
+    medications = patient_data.get('medications', [])
+    conditions = patient_data.get('conditions', [])
+    allergies = patient_data.get('allergies', [])
+    prompt = ''
     
     # Add medications
     if medications:
@@ -158,179 +863,34 @@ VITALS DATA:
         for allergy in allergies:
             prompt += f"  - {allergy.get('allergen', 'N/A')} (Severity: {allergy.get('severity', 'N/A')})\n"
             prompt += f"    Reaction: {allergy.get('reaction', 'N/A')}\n"
-    
-    prompt += f"""
-
-ANALYSIS REQUIREMENTS:
-Please provide a comprehensive health analysis in the following JSON format:
-
-{{
-  "trendAnalysis": {{
-    "bloodPressure": {{
-      "trend": "improving|stable|declining|concerning",
-      "confidence": 0.0-1.0,
-      "summary": "Brief analysis of blood pressure trends",
-      "recommendations": ["specific recommendation 1", "specific recommendation 2"]
-    }},
-    "bloodSugar": {{
-      "trend": "improving|stable|declining|concerning",
-      "confidence": 0.0-1.0,
-      "summary": "Brief analysis of blood sugar trends",
-      "recommendations": ["specific recommendation 1", "specific recommendation 2"]
-    }},
-    "heartRate": {{
-      "trend": "improving|stable|declining|concerning",
-      "confidence": 0.0-1.0,
-      "summary": "Brief analysis of heart rate trends",
-      "recommendations": ["specific recommendation 1", "specific recommendation 2"]
-    }},
-    "weight": {{
-      "trend": "improving|stable|declining|concerning",
-      "confidence": 0.0-1.0,
-      "summary": "Brief analysis of weight trends",
-      "recommendations": ["specific recommendation 1", "specific recommendation 2"]
-    }},
-    "cholesterol": {{
-      "trend": "improving|stable|declining|concerning",
-      "confidence": 0.0-1.0,
-      "summary": "Brief analysis of cholesterol trends",
-      "recommendations": ["specific recommendation 1", "specific recommendation 2"]
-    }}
-  }},
-  "personalizedTips": [
-    {{
-      "category": "medication|lifestyle|diet|exercise|monitoring|general",
-      "priority": "high|medium|low",
-      "title": "Tip title",
-      "description": "Detailed actionable advice",
-      "actionable": true|false
-    }}
-  ],
-  "healthScore": {{
-    "overall": 0-100,
-    "breakdown": {{
-      "vitals": 0-100,
-      "medications": 0-100,
-      "lifestyle": 0-100
-    }}
-  }},
-  "riskFactors": [
-    {{
-      "condition": "Condition name",
-      "riskLevel": "low|moderate|high",
-      "factors": ["factor 1", "factor 2"],
-      "preventionTips": ["prevention tip 1", "prevention tip 2"]
-    }}
-  ]
-}}
-
-IMPORTANT GUIDELINES:
-1. Only analyze vitals that have data available
-2. Be specific and actionable in recommendations
-3. Consider medication adherence in your analysis
-4. Factor in chronic conditions when assessing trends
-5. Provide realistic and achievable health tips
-6. Base health scores on actual data patterns
-7. Identify genuine risk factors based on the patient's profile
-8. Use medical knowledge but avoid specific diagnoses
-9. Encourage professional medical consultation when appropriate
-10. Return ONLY valid JSON format
-
-Please analyze this patient's health data and provide comprehensive insights:
-"""
-    
     return prompt
 
 
-def parse_gemini_insights_response(response: str) -> Dict[str, Any]:
-    """
-    Parse the Gemini response into structured insights
-    """
-    try:
-        # Clean the response - remove any markdown formatting
-        cleaned_response = response.strip()
-        if cleaned_response.startswith('```json'):
-            cleaned_response = cleaned_response[7:]
-        if cleaned_response.endswith('```'):
-            cleaned_response = cleaned_response[:-3]
-        
-        # Parse JSON
-        insights = json.loads(cleaned_response)
-        
-        # Validate the structure
-        validate_insights_structure(insights)
-        
-        return insights
-        
-    except json.JSONDecodeError as e:
-        logging.error(f"Failed to parse Gemini JSON response: {str(e)}")
-        logging.error(f"Response was: {response}")
-        raise ValueError("Invalid JSON response from AI service")
-    except Exception as e:
-        logging.error(f"Error parsing insights response: {str(e)}")
-        raise
-
-
-def validate_insights_structure(insights: Dict[str, Any]) -> None:
+def generate_fallback_insights(patient_data: Dict[str, Any], trends: Optional[Dict[str, Any]] = None,
+                               analysis_type: str = 'comprehensive',
+                               scoring: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
-    Validate that the insights have the expected structure
-    """
-    required_keys = ['trendAnalysis', 'personalizedTips', 'healthScore', 'riskFactors']
-    
-    for key in required_keys:
-        if key not in insights:
-            raise ValueError(f"Missing required key: {key}")
-    
-    # Validate trend analysis structure
-    trend_analysis = insights['trendAnalysis']
-    for vital_type, analysis in trend_analysis.items():
-        if not isinstance(analysis, dict):
-            continue
-        required_trend_keys = ['trend', 'confidence', 'summary', 'recommendations']
-        for trend_key in required_trend_keys:
-            if trend_key not in analysis:
-                insights['trendAnalysis'][vital_type][trend_key] = get_default_trend_value(trend_key)
-    
-    # Validate health score
-    if 'overall' not in insights['healthScore']:
-        insights['healthScore']['overall'] = 75
-    
-    if 'breakdown' not in insights['healthScore']:
-        insights['healthScore']['breakdown'] = {'vitals': 75, 'medications': 75, 'lifestyle': 75}
-
-
-def get_default_trend_value(key: str) -> Any:
-    """
-    Get default values for missing trend analysis keys
+    Generate fallback insights when AI service fails
     """
-    defaults = {
-        'trend': 'stable',
-        'confidence': 0.6,
-        'summary': 'Insufficient data for detailed analysis',
-        'recommendations': ['Continue monitoring', 'Consult with healthcare provider']
-    }
-    return defaults.get(key, 'N/A')
+    insights = generate_local_insights(patient_data, trends, analysis_type, scoring)
+    insights['model_used'] = 'fallback'
+    return insights
 
 
-def generate_fallback_insights(patient_data: Dict[str, Any]) -> Dict[str, Any]:
+def generate_local_insights(patient_data: Dict[str, Any], trends: Optional[Dict[str, Any]] = None,
+                            analysis_type: str = 'quick',
+                            scoring: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
-    Generate fallback insights when AI service fails
+    Generate insights from the patient data alone, without the AI service
     """
     
-    vitals = patient_data.get('vitals', {})
     medications = patient_data.get('medications', [])
     conditions = patient_data.get('conditions', [])
     
-    # Basic trend analysis
-    trend_analysis = {}
-    for vital_type in ['bloodPressure', 'bloodSugar', 'heartRate', 'weight', 'cholesterol']:
-        if vital_type in vitals and vitals[vital_type]:
-            trend_analysis[vital_type] = {
-                'trend': 'stable',
-                'confidence': 0.5,
-                'summary': f'Based on available data, {vital_type} appears stable.',
-                'recommendations': ['Continue regular monitoring', 'Discuss with healthcare provider']
-            }
+    # Trend analysis computed from the readings
+    trend_analysis = trends if trends is not None else compute_trend_analysis(patient_data)
+    if scoring is None:
+        scoring = score_patient(patient_data, trend_analysis)
     
     # Basic personalized tips
     tips = [
@@ -364,15 +924,9 @@ def generate_fallback_insights(patient_data: Dict[str, Any]) -> Dict[str, Any]:
     return {
         'trendAnalysis': trend_analysis,
         'personalizedTips': tips,
-        'healthScore': {
-            'overall': 75,
-            'breakdown': {
-                'vitals': 70,
-                'medications': 80,
-                'lifestyle': 75
-            }
-        },
-        'riskFactors': [],
+        'healthScore': scoring['healthScore'],
+        'riskFactors': scoring['riskFactors'],
         'generated_at': datetime.utcnow().isoformat(),
-        'model_used': 'fallback'
+        'model_used': 'local',
+        'analysis_type': analysis_type
     }
\ No newline at end of file
@@ -0,0 +1,272 @@
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from services.vitals_anomaly import AnomalyStateLockedError, OnlineAnomalyDetector
+from services.vitals_store import VitalsStore
+from services.vitals_trends import VITAL_SERIES
+
+logger = logging.getLogger(__name__)
+vitals_bp = Blueprint('vitals', __name__)
+
+# Columnar vitals per patient, also read by /api/health-insights
+vitals_store = VitalsStore()
+
+# Per-patient baselines of incoming readings, snapshotted to disk; owned by one process
+anomaly_detector = OnlineAnomalyDetector()
+
+VITALS_INGEST_MAX_PATIENTS = int(os.getenv('VITALS_INGEST_MAX_PATIENTS', 10000))
+
+@vitals_bp.route('/vitals/ingest', methods=['POST'])
+def ingest_vitals():
+    """
+    Bulk ingest vital readings into the columnar store
+
+    Accepts JSON {"patient_id": "string", "vitals": {...}}, JSON
+    {"patients": [{"patient_id", "vitals"}, ...]} or NDJSON
+    (Content-Type application/x-ndjson) with one {"patient_id", "vitals"}
+    object per line. vitals are keyed by vital type as in /api/health-insights.
+    Readings already stored are skipped, so ingests can be retried.
+    """
+    started = time.perf_counter()
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            entries = []
+            for number, raw in enumerate(request.get_data().splitlines(), 1):
+                if not raw.strip():
+                    continue
+                try:
+                    entries.append(json.loads(raw))
+                except ValueError:
+                    raise ValueError(f'Line {number} is not valid JSON')
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                raise ValueError('No data provided')
+            entries = data['patients'] if 'patients' in data else [data]
+
+        if not isinstance(entries, list) or not entries:
+            raise ValueError('At least one patient is required')
+        if len(entries) > VITALS_INGEST_MAX_PATIENTS:
+            raise ValueError(f'At most {VITALS_INGEST_MAX_PATIENTS} patients per request')
+        for entry in entries:
+            if not isinstance(entry, dict) or not entry.get('patient_id') or not isinstance(entry.get('vitals'), dict):
+                raise ValueError('Each patient needs a patient_id and a vitals object')
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    try:
+        added = {}
+        for entry in entries:
+            for vital_type, count in vitals_store.ingest(str(entry['patient_id']), entry['vitals']).items():
+                added[vital_type] = added.get(vital_type, 0) + count
+
+        logger.info(f"Ingested {sum(added.values())} readings for {len(entries)} patients")
+        return jsonify({
+            'success': True,
+            'patients': len(entries),
+            'added': added,
+            'durationMs': round((time.perf_counter() - started) * 1000, 2)
+        })
+
+    except Exception as e:
+        logger.error(f"Error ingesting vitals: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': 'Failed to ingest vitals',
+            'details': str(e)
+        }), 500
+
+@vitals_bp.route('/vitals/stream', methods=['POST'])
+def stream_vital_readings():
+    """
+    Score incoming readings for anomalies as they arrive
+
+    Each reading is {"patient_id", "vitalType", "date", <fields>}, e.g.
+    {"patient_id": "p1", "vitalType": "bloodPressure", "date": "...",
+    "systolic": 150, "diastolic": 95}; a missing date means now.
+
+    With NDJSON (Content-Type application/x-ndjson) readings are read one per
+    line and each result line is sent as soon as its reading is scored, so a
+    device gateway can keep one request open. A JSON body holding one reading
+    or {"readings": [...]} gets a JSON response. Readings are also added to
+    the vitals store unless ?store=false.
+
+    Each result carries the per-series scores and any alerts (spike, drift,
+    out_of_range); see OnlineAnomalyDetector.
+    """
+    store = request.args.get('store', 'true').lower() == 'true'
+    # Checked before anything is read, so no reading is stored without being scored
+    try:
+        anomaly_detector.claim()
+    except AnomalyStateLockedError as e:
+        logger.error(str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503
+
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        def generate():
+            for number, raw in enumerate(request.stream, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    entry = json.loads(raw)
+                except ValueError:
+                    entry = None
+                    result = {'line': number, 'error': 'Line is not valid JSON'}
+                if entry is not None:
+                    try:
+                        result = score_reading(entry, store)
+                    except ValueError as e:
+                        result = {'line': number, 'error': str(e)}
+                    except Exception as e:
+                        # e.g. the store failing to write; later readings are still scored
+                        logger.error(f"Error scoring vital reading: {str(e)}")
+                        result = {'line': number, 'error': 'Failed to score reading', 'details': str(e)}
+                yield json.dumps(result, default=str) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({
+            'success': False,
+            'error': 'No data provided'
+        }), 400
+    readings = data['readings'] if 'readings' in data else [data]
+    if not isinstance(readings, list) or not readings:
+        return jsonify({
+            'success': False,
+            'error': 'readings must be a non-empty list'
+        }), 400
+
+    try:
+        results = [score_reading(reading, store) for reading in readings]
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error scoring vital readings: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': 'Failed to score readings',
+            'details': str(e)
+        }), 500
+    return jsonify({
+        'success': True,
+        'results': results,
+        'alerts': sum(len(result['alerts']) for result in results)
+    })
+
+def score_reading(entry, store):
+    """
+    Score one incoming reading and optionally store it
+
+    Raises:
+        ValueError: If the reading lacks a patient or has an unknown vital type
+    """
+    if not isinstance(entry, dict) or not entry.get('patient_id'):
+        raise ValueError('Each reading needs a patient_id')
+    vital_type = entry.get('vitalType')
+    if vital_type not in VITAL_SERIES:
+        raise ValueError(f"Unknown vitalType; expected one of {', '.join(VITAL_SERIES)}")
+
+    patient_id = str(entry['patient_id'])
+    reading = {key: value for key, value in entry.items() if key not in ('patient_id', 'vitalType')}
+    reading.setdefault('date', datetime.utcnow().isoformat())
+    # Stored first, so a reading that failed to store is learned when it is retried
+    if store:
+        vitals_store.append(patient_id, vital_type, [reading])
+    scored = anomaly_detector.score(patient_id, vital_type, reading)
+    return {
+        'patient_id': patient_id,
+        'vitalType': vital_type,
+        'date': reading['date'],
+        'alerts': scored['alerts'],
+        'series': scored['series']
+    }
+
+@vitals_bp.route('/vitals/<patient_id>', methods=['GET'])
+def get_vitals_summary(patient_id):
+    """
+    Reading count and date range per stored vital type of a patient
+    """
+    summary = vitals_store.summary(patient_id)
+    if not summary:
+        return jsonify({
+            'success': False,
+            'error': 'No vitals stored for this patient'
+        }), 404
+    return jsonify({
+        'success': True,
+        'patient_id': patient_id,
+        'vitals': summary
+    })
+
+@vitals_bp.route('/vitals/<patient_id>/<vital_type>', methods=['GET'])
+def get_vital_readings(patient_id, vital_type):
+    """
+    Stored readings of one vital type
+
+    Query parameters:
+        days: Only the last N days (optional, defaults to all readings)
+        aggregate: 'daily' for the mean per day instead of the readings (optional)
+    """
+    if vital_type not in VITAL_SERIES:
+        return jsonify({
+            'success': False,
+            'error': f"Unknown vital type; expected one of {', '.join(VITAL_SERIES)}"
+        }), 400
+
+    days = request.args.get('days', type=float)
+    aggregate = request.args.get('aggregate')
+    if aggregate not in (None, 'daily'):
+        return jsonify({
+            'success': False,
+            'error': "aggregate must be 'daily'"
+        }), 400
+
+    if aggregate == 'daily':
+        readings = vitals_store.daily_means(patient_id, vital_type, days)
+    else:
+        readings = vitals_store.readings(patient_id, vital_type, days)
+    return jsonify({
+        'success': True,
+        'patient_id': patient_id,
+        'vital_type': vital_type,
+        'aggregate': aggregate,
+        'readings': readings
+    })
+
+@vitals_bp.route('/vitals/<patient_id>', methods=['DELETE'])
+def delete_vitals(patient_id):
+    """
+    Drop all stored vitals and the anomaly baselines of a patient
+    """
+    try:
+        anomaly_detector.claim()
+    except AnomalyStateLockedError as e:
+        logger.error(str(e))
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 503
+    deleted = vitals_store.delete(patient_id)
+    if not anomaly_detector.reset(patient_id) and not deleted:
+        return jsonify({
+            'success': False,
+            'error': 'No vitals stored for this patient'
+        }), 404
+    return jsonify({
+        'success': True,
+        'patient_id': patient_id
+    })
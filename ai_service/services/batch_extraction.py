@@ -0,0 +1,192 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('ocr_batch_files_total', 'Files processed by batch text extraction by outcome')
+
+# Pipeline of each OCR worker process, created by _init_worker
+_worker_pipeline = None
+
+
+def _init_worker() -> None:
+    """Create the OCR pipeline of a worker process"""
+    global _worker_pipeline
+    # Each worker OCRs one document at a time; the process pool provides the parallelism
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    # Rasterization and OCR in the workers yield the CPU to request threads
+    if hasattr(os, 'nice'):
+        os.nice(int(os.getenv('OCR_NICE', 10)))
+    from .diagnostic_pipeline import DiagnosticPipeline
+    from .ocr_service import OCRService
+
+    ocr_service = OCRService()
+    ocr_service.region_workers = 1
+    _worker_pipeline = DiagnosticPipeline(ocr_service, diagnostic_service=None)
+
+
+def _extract_in_worker(source: str, document: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    started = time.process_time()
+    result = _worker_pipeline.extract_text(source, document)
+    result['validation'] = _worker_pipeline.ocr_service.validate_medical_document(result['extractedText'])
+    result['cpuMs'] = round((time.process_time() - started) * 1000, 2)
+    return result
+
+
+class BatchExtractor:
+    """
+    Text extraction for many documents at once.
+
+    Remote documents are downloaded on a thread pool; text layer reading,
+    rasterization and OCR run on a process pool, so documents are extracted
+    in parallel without contending for the GIL. The workers are spawned
+    rather than forked, since the service process runs threads whose locks a
+    forked child could inherit held. With an admission controller, each
+    document takes an OCR slot until its extraction finishes, so batches
+    share the OCR_MAX_CONCURRENT limit with single-document requests.
+    Results are yielded as each document finishes, and a failing document
+    only produces an error entry. The number of documents held in memory at
+    once is bounded, so large batches stream in constant memory.
+    """
+
+    def __init__(self, ocr_service, fetch_workers: Optional[int] = None, ocr_workers: Optional[int] = None,
+                 admission=None):
+        """
+        Initialize the extractor; the pools are started on first use
+
+        Args:
+            ocr_service: OCRService used to download documents and check local paths
+            fetch_workers: Concurrent downloads (defaults to OCR_BATCH_FETCH_WORKERS)
+            ocr_workers: OCR worker processes (defaults to OCR_BATCH_WORKERS, or the
+                admission limit, or the CPU count)
+            admission: OCRAdmissionController granting a slot per document (optional)
+        """
+        self.ocr_service = ocr_service
+        self.admission = admission
+        self.fetch_workers = fetch_workers or int(os.getenv('OCR_BATCH_FETCH_WORKERS', 8))
+        # More workers than OCR slots would only sit idle
+        default_workers = admission.max_concurrent if admission else os.cpu_count() or 1
+        self.ocr_workers = ocr_workers or int(os.getenv('OCR_BATCH_WORKERS', default_workers))
+        # Documents downloaded or being extracted at any time
+        self.max_in_flight = self.fetch_workers + 2 * self.ocr_workers
+        self._fetch_executor: Optional[ThreadPoolExecutor] = None
+        self._ocr_executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def extract(self, sources: List[str]) -> Iterator[Dict[str, Any]]:
+        """
+        Extract the text of documents, yielding each result as it completes
+
+        Args:
+            sources: http(s) URLs or paths under the uploads root
+
+        Yields:
+            {'index', 'source', 'success', 'data', 'queueMs'} per document, or
+            {'index', 'source', 'success': False, 'message'} for a failed one
+        """
+        self._start()
+        pending: Dict[Future, Tuple[str, int, str]] = {}
+        # OCR slot of each document being extracted
+        tickets: Dict[Future, Dict[str, Any]] = {}
+        queue = iter(enumerate(sources))
+
+        def fill() -> None:
+            while len(pending) < self.max_in_flight:
+                entry = next(queue, None)
+                if entry is None:
+                    return
+                index, source = entry
+                pending[self._fetch_executor.submit(self._fetch, source)] = ('fetch', index, source)
+
+        try:
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, index, source = pending.pop(future)
+                    ticket = tickets.pop(future, None)
+                    try:
+                        result = future.result()
+                        if stage == 'fetch':
+                            extraction, ticket = self._submit_ocr(*result)
+                            pending[extraction] = ('ocr', index, source)
+                            if ticket:
+                                tickets[extraction] = ticket
+                            continue
+                    except Exception as e:
+                        logger.warning(f"Batch extraction of {source} failed during {stage}: {str(e)}")
+                        metrics.inc('ocr_batch_files_total', outcome='failed')
+                        yield {'index': index, 'source': source, 'success': False,
+                               'message': f"Text extraction failed: {str(e)}"}
+                        continue
+
+                    metrics.inc('ocr_batch_files_total', outcome='completed')
+                    yield {'index': index, 'source': source, 'success': True, 'data': result,
+                           'queueMs': ticket['queueMs'] if ticket else 0.0}
+                fill()
+        finally:
+            # The client went away; drop work that has not started. Slots are
+            # freed as each extraction finishes or is cancelled.
+            for future in pending:
+                future.cancel()
+
+    def _fetch(self, source: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Download a remote document; local paths are only checked here and
+        memory-mapped by the worker
+        """
+        if self.ocr_service.is_remote(source):
+            return source, self.ocr_service.fetch_document(source)
+        path = self.ocr_service.resolve_upload_path(source)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"File not found: {source}")
+        return path, None
+
+    def _submit_ocr(self, source: str,
+                    document: Optional[Dict[str, Any]]) -> Tuple[Future, Optional[Dict[str, Any]]]:
+        """Queue a document for OCR once it has a slot; returns its future and ticket"""
+        # Admitted batches wait for slots rather than being shed mid-stream
+        ticket = self.admission.acquire('batch', background=True) if self.admission else None
+        try:
+            try:
+                future = self._ocr_executor.submit(_extract_in_worker, source, document)
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory); replace the pool for the remaining documents
+                logger.error('OCR worker pool broke, restarting it')
+                with self._lock:
+                    self._ocr_executor = self._process_pool()
+                future = self._ocr_executor.submit(_extract_in_worker, source, document)
+        except Exception:
+            if ticket:
+                self.admission.release(ticket, cpu_seconds=0.0)
+            raise
+        if ticket:
+            # Released from the pool's thread, so the slot is freed even if the stream was abandoned
+            future.add_done_callback(lambda done: self._release(ticket, done))
+        return future, ticket
+
+    def _release(self, ticket: Dict[str, Any], future: Future) -> None:
+        cpu_seconds = 0.0
+        if not future.cancelled() and future.exception() is None:
+            cpu_seconds = future.result()['cpuMs'] / 1000
+        self.admission.release(ticket, cpu_seconds=cpu_seconds)
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.ocr_workers, initializer=_init_worker,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._fetch_executor is None:
+                self._fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_workers,
+                                                          thread_name_prefix='ocr-batch-fetch')
+            if self._ocr_executor is None:
+                self._ocr_executor = self._process_pool()
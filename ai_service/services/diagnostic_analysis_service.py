@@ -1,11 +1,14 @@
-import requests
-import json
-import re
-from typing import Dict, List, Any, Optional
+from typing import Dict, Any, Optional, Callable, Tuple
 import logging
+from pydantic import ValidationError
+from .streaming_json import MalformedJSONError
+from .llm_schemas import DIAGNOSTIC_ANALYSIS_TASK, TestValue
 
 logger = logging.getLogger(__name__)
 
+# Path of the test values array inside the analysis response
+TEST_VALUES_PATH = ('structuredData', 'testValues')
+
 class DiagnosticAnalysisService:
     def __init__(self, gemini_service):
         """
@@ -17,7 +20,8 @@ class DiagnosticAnalysisService:
         self.gemini_service = gemini_service
         
     def analyze_diagnostic_report(self, ocr_text: str, test_type: str = None, 
-                                findings: str = None) -> Dict[str, Any]:
+                                findings: str = None,
+                                on_test_value: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
         """
         Analyze diagnostic test report using AI
         
@@ -25,19 +29,22 @@ class DiagnosticAnalysisService:
             ocr_text: Text extracted from the diagnostic report via OCR
             test_type: Type of diagnostic test (optional)
             findings: Additional findings from the report (optional)
+            on_test_value: Callback receiving each validated test value as soon
+                as it has been generated (optional)
             
         Returns:
             Dictionary containing structured analysis results
         """
         try:
             # Create comprehensive prompt for Gemini
-            analysis_prompt = self._create_analysis_prompt(ocr_text, test_type, findings)
-            
-            # Get AI analysis from Gemini
-            ai_response = self.gemini_service.generate_response(analysis_prompt)
+            analysis_prompt = self.create_analysis_prompt(ocr_text, test_type, findings)
             
-            # Parse and structure the AI response
-            structured_result = self._parse_ai_response(ai_response)
+            try:
+                document = self.request_analysis(analysis_prompt, on_test_value=on_test_value)
+                structured_result, _ = self.parse_analysis(document)
+            except MalformedJSONError as e:
+                logger.error(f"Failed to parse AI response as JSON: {str(e)}")
+                structured_result = self._unparsed_response(e.document)
             
             return {
                 'success': True,
@@ -52,7 +59,50 @@ class DiagnosticAnalysisService:
                 'data': None
             }
     
-    def _create_analysis_prompt(self, ocr_text: str, test_type: str = None, 
+    def request_analysis(self, analysis_prompt: str,
+                         on_test_value: Optional[Callable[[Dict[str, Any]], None]] = None,
+                         stats: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Stream the analysis from Gemini
+        
+        Args:
+            analysis_prompt: Prompt built by create_analysis_prompt
+            on_test_value: Callback receiving each validated test value as soon
+                as it has been generated (optional)
+            stats: Dictionary filled with attempts and token usage (optional)
+            
+        Returns:
+            The raw JSON document, checked structurally while it streamed
+        """
+        # Test values are surfaced as they stream in, before the document is finished
+        def handle_test_value(path, item):
+            if isinstance(item, dict):
+                on_test_value(TestValue.model_validate(item).model_dump())
+        
+        return self.gemini_service.generate_json(
+            analysis_prompt,
+            task=DIAGNOSTIC_ANALYSIS_TASK,
+            item_paths=[TEST_VALUES_PATH] if on_test_value else (),
+            on_item=handle_test_value,
+            validate=False,
+            stats=stats
+        )
+    
+    def parse_analysis(self, document: str) -> Tuple[Dict[str, Any], bool]:
+        """
+        Validate a raw analysis document through the compiled task model
+        
+        Returns:
+            Tuple of (analysis, whether the document validated); a document that
+            fails validation gives the unparsed fallback
+        """
+        try:
+            return self._structure_response(DIAGNOSTIC_ANALYSIS_TASK.validate_json(document)), True
+        except ValidationError as e:
+            logger.error(f"AI response failed validation: {str(e)}")
+            return self._unparsed_response(document), False
+    
+    def create_analysis_prompt(self, ocr_text: str, test_type: str = None, 
                               findings: str = None) -> str:
         """Create a comprehensive prompt for diagnostic analysis"""
         
@@ -67,48 +117,7 @@ ADDITIONAL CONTEXT:
 - Clinical Findings: {findings or 'Not provided'}
 
 INSTRUCTIONS:
-Please provide a comprehensive analysis in the following JSON format:
-
-{{
-  "extractedText": "cleaned and formatted version of the OCR text",
-  "structuredData": {{
-    "testValues": [
-      {{
-        "parameter": "test parameter name",
-        "value": "measured value",
-        "unit": "unit of measurement",
-        "referenceRange": "normal reference range",
-        "isAbnormal": true/false
-      }}
-    ],
-    "patientInfo": {{
-      "name": "patient name if found",
-      "age": "patient age if found",
-      "gender": "patient gender if found",
-      "testDate": "test date if found"
-    }},
-    "laboratoryInfo": {{
-      "name": "lab name if found",
-      "address": "lab address if found",
-      "phone": "lab phone if found"
-    }}
-  }},
-  "abnormalFindings": [
-    {{
-      "parameter": "abnormal parameter name",
-      "value": "abnormal value",
-      "severity": "low/moderate/high/critical",
-      "description": "detailed description of the abnormality",
-      "recommendation": "clinical recommendation for this finding"
-    }}
-  ],
-  "aiSummary": "comprehensive natural language summary of the test results, highlighting key findings and their clinical significance",
-  "riskAssessment": {{
-    "level": "low/moderate/high/critical",
-    "description": "overall risk assessment based on all findings"
-  }},
-  "confidence": 0.85
-}}
+Please provide a comprehensive analysis as a JSON object following the response schema.
 
 ANALYSIS GUIDELINES:
 1. Extract all numerical test values with their reference ranges
@@ -119,103 +128,26 @@ ANALYSIS GUIDELINES:
 6. If information is unclear or missing, indicate this appropriately
 7. Confidence score should reflect how clearly the data could be extracted and analyzed
 
-Please respond ONLY with the JSON object, no additional text.
+Respond ONLY with the JSON object, no additional text.
 """
         
         return prompt
     
-    def _parse_ai_response(self, ai_response: str) -> Dict[str, Any]:
-        """Parse and validate the AI response"""
-        try:
-            # Try to extract JSON from the response
-            json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                parsed_data = json.loads(json_str)
-            else:
-                # If no JSON found, try parsing the entire response
-                parsed_data = json.loads(ai_response)
-            
-            # Validate and structure the response
-            structured_result = {
-                'extractedText': parsed_data.get('extractedText', ''),
-                'structuredData': self._validate_structured_data(parsed_data.get('structuredData', {})),
-                'abnormalFindings': self._validate_abnormal_findings(parsed_data.get('abnormalFindings', [])),
-                'aiSummary': parsed_data.get('aiSummary', ''),
-                'riskAssessment': self._validate_risk_assessment(parsed_data.get('riskAssessment', {})),
-                'confidence': max(0.0, min(1.0, float(parsed_data.get('confidence', 0.0)))),
-                'aiModel': 'gemini-1.5-flash'
-            }
-            
-            return structured_result
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse AI response as JSON: {str(e)}")
-            # Return a basic structure with the raw response
-            return {
-                'extractedText': ai_response,
-                'structuredData': {'testValues': [], 'patientInfo': {}, 'laboratoryInfo': {}},
-                'abnormalFindings': [],
-                'aiSummary': f"AI analysis completed but response formatting failed. Raw response: {ai_response[:500]}...",
-                'riskAssessment': {'level': 'low', 'description': 'Unable to determine risk level due to parsing error'},
-                'confidence': 0.1,
-                'aiModel': 'gemini-1.5-flash'
-            }
-        except Exception as e:
-            logger.error(f"Error parsing AI response: {str(e)}")
-            raise
+    def _structure_response(self, validated_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Add service metadata to a response validated by the task model"""
+        validated_data['aiModel'] = 'gemini-1.5-flash'
+        return validated_data
     
-    def _validate_structured_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Validate and clean structured data"""
-        return {
-            'testValues': [
-                {
-                    'parameter': str(tv.get('parameter', '')),
-                    'value': str(tv.get('value', '')),
-                    'unit': str(tv.get('unit', '')),
-                    'referenceRange': str(tv.get('referenceRange', '')),
-                    'isAbnormal': bool(tv.get('isAbnormal', False))
-                }
-                for tv in data.get('testValues', [])
-                if isinstance(tv, dict)
-            ],
-            'patientInfo': {
-                'name': str(data.get('patientInfo', {}).get('name', '')),
-                'age': str(data.get('patientInfo', {}).get('age', '')),
-                'gender': str(data.get('patientInfo', {}).get('gender', '')),
-                'testDate': str(data.get('patientInfo', {}).get('testDate', ''))
-            },
-            'laboratoryInfo': {
-                'name': str(data.get('laboratoryInfo', {}).get('name', '')),
-                'address': str(data.get('laboratoryInfo', {}).get('address', '')),
-                'phone': str(data.get('laboratoryInfo', {}).get('phone', ''))
-            }
-        }
-    
-    def _validate_abnormal_findings(self, findings: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Validate and clean abnormal findings"""
-        valid_severities = ['low', 'moderate', 'high', 'critical']
-        
-        return [
-            {
-                'parameter': str(finding.get('parameter', '')),
-                'value': str(finding.get('value', '')),
-                'severity': finding.get('severity', 'moderate') if finding.get('severity') in valid_severities else 'moderate',
-                'description': str(finding.get('description', '')),
-                'recommendation': str(finding.get('recommendation', ''))
-            }
-            for finding in findings
-            if isinstance(finding, dict) and finding.get('parameter')
-        ]
-    
-    def _validate_risk_assessment(self, assessment: Dict[str, Any]) -> Dict[str, Any]:
-        """Validate and clean risk assessment"""
-        valid_levels = ['low', 'moderate', 'high', 'critical']
-        level = assessment.get('level', 'low')
-        
+    def _unparsed_response(self, ai_response: str) -> Dict[str, Any]:
+        """Return a basic structure with the raw response when it could not be parsed"""
         return {
-            'level': level if level in valid_levels else 'low',
-            'description': str(assessment.get('description', ''))
+            'extractedText': ai_response,
+            'structuredData': {'testValues': [], 'patientInfo': {}, 'laboratoryInfo': {}},
+            'abnormalFindings': [],
+            'aiSummary': f"AI analysis completed but response formatting failed. Raw response: {ai_response[:500]}...",
+            'riskAssessment': {'level': 'low', 'description': 'Unable to determine risk level due to parsing error'},
+            'confidence': 0.1,
+            'aiModel': 'gemini-1.5-flash'
         }
     
     def extract_key_metrics(self, structured_data: Dict[str, Any]) -> Dict[str, Any]:
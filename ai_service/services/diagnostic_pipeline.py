@@ -0,0 +1,613 @@
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .layout_templates import LayoutTemplateStore, build_analysis, denormalize_box, page_layout
+from .metrics import metrics
+from .ocr_admission import OCRAdmissionController, OCROverloadedError
+from .ocr_prefetch import OCRPrefetcher
+from .result_store import DiagnosticResultStore, content_hash, input_hash
+from .streaming_json import MalformedJSONError
+from .text_compaction import compact_text
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('diagnostic_pipeline_stage_seconds', 'Time spent in each diagnostic pipeline stage')
+metrics.describe('diagnostic_pipeline_stage_bytes_total', 'Bytes or characters flowing through each pipeline stage')
+metrics.describe('diagnostic_pipeline_llm_tokens_total', 'LLM tokens used by diagnostic analyses')
+metrics.describe('diagnostic_pipeline_seconds', 'End-to-end diagnostic pipeline time')
+metrics.describe('diagnostic_result_store_lookups_total', 'Stored diagnostic result lookups by outcome')
+metrics.describe('diagnostic_layout_template_lookups_total', 'Layout template lookups by outcome')
+metrics.describe('diagnostic_pipeline_compaction_chars_saved_total', 'Characters of boilerplate removed before prompting')
+
+
+class PipelineError(Exception):
+    """A pipeline failure that maps onto an HTTP error response"""
+
+    def __init__(self, message: str, status_code: int = 400, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        # Extra response headers, such as Retry-After when OCR work was shed
+        self.headers = headers or {}
+
+
+class PipelineContext:
+    """State threaded through the stages of one diagnostic analysis"""
+
+    def __init__(self, test_result_id: str, attachment_url: Optional[str] = None,
+                 test_type: Optional[str] = None, findings: str = '', force: bool = False,
+                 file_path: Optional[str] = None):
+        self.test_result_id = test_result_id
+        self.attachment_url = attachment_url
+        # Path under the shared uploads root, read instead of downloading
+        self.file_path = file_path
+        # Client-side name of a document uploaded with the request
+        self.upload_name: Optional[str] = None
+        self.test_type = test_type
+        self.findings = findings or ''
+        # Recompute even if a stored result exists
+        self.force = force
+
+        self.document: Optional[Dict[str, Any]] = None
+        self.images: List[Any] = []
+        # True once the page images went through OCR preprocessing
+        self.preprocessed = False
+        self.extracted_text = ''
+        self.ocr_metadata: Dict[str, Any] = {}
+        self.ocr_passes: Dict[str, Any] = {}
+        # Fingerprint and OCR words of an unrecognized page layout, kept for learning
+        self.layout: Optional[Dict[str, Any]] = None
+        self.validation: Optional[Dict[str, Any]] = None
+        self.combined_text = ''
+        self.prompt = ''
+        self.response_document: Optional[str] = None
+        self.analysis: Optional[Dict[str, Any]] = None
+        # True when the analysis is the unparsed fallback; such results are not stored
+        self.degraded = False
+
+        self.input_hash = input_hash(test_type, self.findings)
+        self.content_hash: Optional[str] = None
+        # True when the text came from an upload-time prefetch
+        self.prefetched = False
+        self.cache: Dict[str, Any] = {'status': 'bypass' if force else 'miss'}
+        # Background work (prefetching) waits for OCR capacity instead of being shed
+        self.background = False
+        self.admission_ticket: Optional[Dict[str, Any]] = None
+        # Queue and CPU time of the OCR work, once its slot was released
+        self.admission: Optional[Dict[str, Any]] = None
+
+        # Set by a stage to skip all remaining stages
+        self.done = False
+        self.stages: List[Dict[str, Any]] = []
+        self._started = time.perf_counter()
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+    @property
+    def source(self) -> Optional[str]:
+        """Identifies the document for stored results and prefetching"""
+        if self.file_path or self.attachment_url:
+            return self.file_path or self.attachment_url
+        return f'upload:{self.upload_name}' if self.upload_name else None
+
+    @property
+    def file_name(self) -> Optional[str]:
+        if self.upload_name:
+            return self.upload_name
+        return self.source.replace('\\', '/').split('/')[-1] if self.source else None
+
+    def attach_upload(self, document: Dict[str, Any], file_name: str) -> None:
+        """Use a document uploaded with the request instead of fetching one"""
+        self.document = document
+        self.upload_name = file_name
+
+    def release(self) -> None:
+        """Unmap a memory-mapped document once the stages are done with it"""
+        if self.document and not isinstance(self.document['content'], bytes):
+            self.document['content'].close()
+
+    def summary(self) -> Dict[str, Any]:
+        """Per-stage timings and counts for response metadata"""
+        summary = {
+            'stages': self.stages,
+            'totalMs': round(self.elapsed_ms, 2),
+            'cache': self.cache
+        }
+        if self.admission:
+            summary['admission'] = self.admission
+        return summary
+
+    def restore(self, record: Dict[str, Any], match: str) -> None:
+        """Load a stored result into the context and skip the remaining stages"""
+        payload = record['payload']
+        self.analysis = payload['analysis']
+        self.extracted_text = payload.get('extractedText', '')
+        self.ocr_metadata = payload.get('ocrMetadata', {})
+        self.validation = payload.get('validation')
+        self.combined_text = combine_text(self.extracted_text, self.findings)
+        self.cache = {
+            'status': 'hit',
+            'match': match,
+            'storedAt': datetime.utcfromtimestamp(record['createdAt']).isoformat()
+        }
+        self.done = True
+
+    def to_payload(self) -> Dict[str, Any]:
+        """The parts of a completed analysis kept by the result store"""
+        return {
+            'analysis': self.analysis,
+            'extractedText': self.extracted_text,
+            'ocrMetadata': self.ocr_metadata,
+            'validation': self.validation
+        }
+
+
+def combine_text(extracted_text: str, findings: str) -> str:
+    """Combine extracted text with existing findings"""
+    return f"{extracted_text}\n\nAdditional Findings:\n{findings}".strip()
+
+
+Stage = Callable[[PipelineContext, Dict[str, Any]], None]
+
+
+class DiagnosticPipeline:
+    """
+    Composable download -> OCR -> validate -> LLM -> parse pipeline shared by the
+    diagnostic endpoints.
+
+    With a result store, completed analyses are saved and repeat requests are
+    answered from it, first by test result and then, once the document has
+    been fetched, by its content hash. With a prefetcher, text extracted when
+    the attachment was uploaded replaces the fetch and OCR stages. With layout
+    templates, single-page reports in a learned layout are read field by
+    field and skip the OCR and LLM stages; other layouts are learned from
+    their LLM analyses. With an admission controller, rasterization and OCR
+    only run once an OCR slot is free, and requests are shed with a 503 when
+    the server is overloaded.
+
+    Each stage receives the context and its own stage record, which it can
+    annotate with counts (bytesIn, bytesOut, pages, tokens...) or mark as
+    skipped. Timings are recorded per stage, returned in the response metadata
+    and exported to the metrics registry.
+    """
+
+    STAGE_NAMES = ['lookup', 'prefetch', 'fetch', 'content_lookup', 'text_layer', 'rasterize', 'template',
+                   'ocr', 'validate', 'compact', 'prompt', 'llm', 'parse', 'learn', 'store']
+    # Stages run by extract_text for prefetching
+    EXTRACTION_STAGE_NAMES = ['fetch', 'text_layer', 'rasterize', 'ocr']
+
+    def __init__(self, ocr_service, diagnostic_service,
+                 stages: Optional[List[Tuple[str, Stage]]] = None,
+                 result_store: Optional[DiagnosticResultStore] = None,
+                 prefetcher: Optional[OCRPrefetcher] = None,
+                 layout_templates: Optional[LayoutTemplateStore] = None,
+                 admission: Optional[OCRAdmissionController] = None):
+        """
+        Initialize the pipeline
+
+        Args:
+            ocr_service: OCRService used for fetching and text extraction
+            diagnostic_service: DiagnosticAnalysisService used for the LLM analysis
+            stages: Custom (name, stage) list; defaults to the standard stages
+            result_store: Store used to reuse and save completed analyses (optional)
+            prefetcher: Source of text extracted ahead of the request (optional)
+            layout_templates: Store of learned report layouts (optional)
+            admission: Admission control for rasterization and OCR (optional)
+        """
+        self.ocr_service = ocr_service
+        self.diagnostic_service = diagnostic_service
+        self.result_store = result_store
+        self.prefetcher = prefetcher
+        self.layout_templates = layout_templates
+        self.admission = admission
+        self.compaction_enabled = os.getenv('TEXT_COMPACTION', 'True').lower() == 'true'
+        # A request waits this long for a running prefetch, then extracts the text itself
+        self.prefetch_wait_seconds = float(os.getenv('OCR_PREFETCH_WAIT_SECONDS', 5))
+        self.stages = stages if stages is not None else [
+            (name, getattr(self, f'_{name}')) for name in self.STAGE_NAMES
+        ]
+
+    def run(self, context: PipelineContext) -> PipelineContext:
+        """
+        Run every stage over the context
+
+        Raises:
+            PipelineError: If a stage fails in a way the caller should report
+        """
+        try:
+            for name, stage in self.stages:
+                self._run_stage(context, name, stage)
+        finally:
+            self._release_admission(context)
+            context.release()
+            metrics.observe('diagnostic_pipeline_seconds', context.elapsed_ms / 1000)
+        return context
+
+    def extract_text(self, source: str, document: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Run only the fetch and OCR stages over an attachment URL or uploads path
+
+        Args:
+            source: Attachment URL or path under the uploads root
+            document: Already downloaded document of the source (optional)
+
+        Returns:
+            Dictionary with the extracted text, OCR metadata and document content hash
+
+        Raises:
+            PipelineError: If the document could not be fetched or read
+        """
+        context = PipelineContext(test_result_id='', attachment_url=source)
+        context.document = document
+        context.background = True
+        try:
+            for name in self.EXTRACTION_STAGE_NAMES:
+                self._run_stage(context, name, getattr(self, f'_{name}'))
+        finally:
+            self._release_admission(context)
+            context.release()
+        return {
+            'extractedText': context.extracted_text,
+            'ocrMetadata': context.ocr_metadata,
+            'contentHash': context.content_hash
+        }
+
+    def _run_stage(self, context: PipelineContext, name: str, stage: Stage) -> None:
+        record = {'name': name, 'status': 'completed'}
+        started = time.perf_counter()
+        try:
+            if context.done:
+                record['status'] = 'skipped'
+            else:
+                stage(context, record)
+        except Exception:
+            record['status'] = 'failed'
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            record['durationMs'] = round(duration * 1000, 2)
+            context.stages.append(record)
+
+            metrics.observe('diagnostic_pipeline_stage_seconds', duration, stage=name, status=record['status'])
+            for direction in ('in', 'out'):
+                count = record.get(f'bytes{direction.capitalize()}')
+                if count:
+                    metrics.inc('diagnostic_pipeline_stage_bytes_total', count, stage=name, direction=direction)
+
+    # --- Stages ------------------------------------------------------------
+
+    def _lookup(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        # Uploaded documents are only matched by content
+        if not self.result_store or context.force or context.document:
+            record['status'] = 'skipped'
+            return
+
+        stored = self.result_store.find_by_test_result(
+            context.test_result_id, context.source, context.input_hash
+        )
+        record['hit'] = stored is not None
+        metrics.inc('diagnostic_result_store_lookups_total', match='testResult',
+                    outcome='hit' if stored else 'miss')
+        if stored:
+            logger.info(f"Serving stored analysis for test result: {context.test_result_id}")
+            context.restore(stored, 'testResult')
+
+    def _prefetch(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not self.prefetcher or not context.source or context.document:
+            record['status'] = 'skipped'
+            return
+
+        prefetched = self.prefetcher.get(context.source, timeout=self.prefetch_wait_seconds)
+        record['hit'] = prefetched is not None
+        if prefetched:
+            context.extracted_text = prefetched['extractedText']
+            context.ocr_metadata = dict(prefetched['ocrMetadata'])
+            context.content_hash = prefetched['contentHash']
+            context.prefetched = True
+            record['bytesOut'] = len(context.extracted_text)
+
+    def _fetch(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if context.prefetched or not (context.source or context.document):
+            record['status'] = 'skipped'
+            return
+
+        if context.document is None:
+            logger.info(f"Processing attachment: {context.source}")
+            try:
+                context.document = self.ocr_service.load_document(context.source)
+            except Exception as e:
+                logger.error(f"OCR failed: {str(e)}")
+                raise PipelineError(f"Failed to extract text from document: {str(e)}", 400)
+
+        context.ocr_metadata = {
+            'file_type': context.document['file_type'],
+            'file_size': context.document['file_size']
+        }
+        context.content_hash = content_hash(context.document['content'])
+        record['bytesOut'] = context.document['file_size']
+        record['local'] = 'path' in context.document
+
+    def _content_lookup(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not self.result_store or not context.content_hash or context.force:
+            record['status'] = 'skipped'
+            return
+
+        stored = self.result_store.find_by_content(context.content_hash, context.input_hash)
+        record['hit'] = stored is not None
+        metrics.inc('diagnostic_result_store_lookups_total', match='content',
+                    outcome='hit' if stored else 'miss')
+        if stored:
+            logger.info(f"Serving stored analysis of identical document for test result: {context.test_result_id}")
+            file_details = {key: context.ocr_metadata.get(key) for key in ('file_type', 'file_size')}
+            context.restore(stored, 'content')
+            # Keep this request's file details; the stored ones may name another upload
+            context.ocr_metadata = dict(context.ocr_metadata, **file_details)
+            self._save(context)
+
+    def _text_layer(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not context.document or context.document['file_type'] != 'pdf':
+            record['status'] = 'skipped'
+            return
+
+        record['bytesIn'] = context.document['file_size']
+        try:
+            direct_text, page_count = self.ocr_service.extract_pdf_text_layer(context.document['content'])
+        except Exception as e:
+            logger.warning(f"Direct PDF text extraction failed, using OCR: {str(e)}")
+            return
+
+        context.ocr_metadata['pages_processed'] = page_count
+        record['pages'] = page_count
+        record['bytesOut'] = len(direct_text)
+
+        # If we got reasonable text directly, OCR is not needed
+        if self.ocr_service.has_usable_text_layer(direct_text):
+            context.extracted_text = direct_text.strip()
+            context.ocr_metadata['extraction_method'] = 'direct'
+
+    def _rasterize(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not context.document or context.extracted_text:
+            record['status'] = 'skipped'
+            return
+
+        record['bytesIn'] = context.document['file_size']
+        self._admit(context, record)
+        try:
+            if context.document['file_type'] == 'pdf':
+                context.images, page_sources = self.ocr_service.load_pdf_pages(context.document['content'],
+                                                                               context.document.get('path'))
+                context.ocr_metadata['page_sources'] = page_sources
+                record['embeddedPages'] = page_sources['embedded']
+                record['rasterizedPages'] = page_sources['rasterized']
+            else:
+                image = self.ocr_service.load_image(context.document['content'])
+                context.images = [image]
+                context.ocr_metadata['image_dimensions'] = image.size
+        except Exception as e:
+            logger.error(f"OCR failed: {str(e)}")
+            raise PipelineError(f"Failed to extract text from document: {str(e)}", 400)
+
+        record['pages'] = len(context.images)
+        record['pixels'] = sum(image.size[0] * image.size[1] for image in context.images)
+
+    def _admit(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        """Wait for an OCR slot before rasterizing"""
+        if not self.admission or context.admission_ticket:
+            return
+        try:
+            context.admission_ticket = self.admission.acquire('prefetch' if context.background else 'analysis',
+                                                              background=context.background)
+        except OCROverloadedError as e:
+            raise PipelineError(str(e), 503, headers={'Retry-After': str(e.retry_after)})
+        record['queueMs'] = context.admission_ticket['queueMs']
+
+    def _release_admission(self, context: PipelineContext) -> None:
+        if context.admission_ticket:
+            context.admission = self.admission.release(context.admission_ticket)
+            context.admission_ticket = None
+
+    def _template(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        # Findings and forced reanalysis need the LLM; templates cover single pages
+        if (not self.layout_templates or context.force or context.findings.strip()
+                or len(context.images) != 1):
+            record['status'] = 'skipped'
+            return
+
+        page = context.images[0]
+        if self.ocr_service.preprocess_method != 'none':
+            page = self.ocr_service.preprocess_image(page, context.ocr_passes)
+        context.images = [page]
+        context.preprocessed = True
+        regions = self.ocr_service.find_text_regions(page, {})
+        if not regions:
+            record['status'] = 'skipped'
+            return
+
+        header_text, _ = self.ocr_service.read_boxes(page, regions[:1], single_line=False)[0]
+        layout = page_layout(page.size, regions, header_text)
+        template = self.layout_templates.find(layout) if layout else None
+        record['matched'] = template is not None
+        if template is None:
+            metrics.inc('diagnostic_layout_template_lookups_total', outcome='miss')
+            context.layout = layout
+            return
+
+        record['templateId'] = template['id']
+        readings = self.ocr_service.read_boxes(
+            page, [denormalize_box(field['box'], page.size) for field in template['fields']]
+        )
+        record['fields'] = len(readings)
+        analysis = build_analysis(template, readings)
+        self.layout_templates.record_use(template['id'], analysis is not None)
+        if analysis is None:
+            logger.warning(f"Layout template {template['id']} reads were unreliable, using OCR and the LLM")
+            metrics.inc('diagnostic_layout_template_lookups_total', outcome='rejected')
+            record['rejected'] = True
+            context.layout = layout
+            return
+
+        metrics.inc('diagnostic_layout_template_lookups_total', outcome='hit')
+        context.analysis = analysis
+        context.extracted_text = analysis['extractedText']
+        context.ocr_metadata['extraction_method'] = 'template'
+        context.ocr_metadata['layout_template'] = template['id']
+        context.images = []
+        record['bytesOut'] = len(context.extracted_text)
+
+    def _ocr(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not context.images:
+            # Template reads end the OCR work too
+            self._release_admission(context)
+            record['status'] = 'skipped'
+            return
+
+        record['pages'] = len(context.images)
+        ocr_passes = context.ocr_passes
+        # Word boxes of an unrecognized layout are kept to learn it
+        words = [] if context.layout is not None else None
+        preprocess = not context.preprocessed
+        try:
+            if context.document['file_type'] == 'pdf':
+                page_words = [] if words is not None else None
+                extracted_text = self.ocr_service.ocr_pages(context.images, ocr_passes, preprocess, page_words)
+                if page_words:
+                    words.extend(page_words[0])
+            else:
+                extracted_text = self.ocr_service.ocr_page(context.images[0], ocr_passes, preprocess, words)
+        except Exception as e:
+            logger.error(f"OCR failed: {str(e)}")
+            raise PipelineError(f"Failed to extract text from document: {str(e)}", 400)
+        finally:
+            # Page bitmaps are large; release them as soon as OCR is done
+            context.images = []
+            self._release_admission(context)
+
+        context.extracted_text = extracted_text.strip()
+        context.ocr_metadata['extraction_method'] = 'ocr'
+        if words:
+            context.layout['words'] = words
+        if ocr_passes:
+            context.ocr_metadata['ocr_passes'] = ocr_passes
+            record['lowConfidenceLines'] = ocr_passes.get('low_confidence_lines')
+            record['improvedLines'] = ocr_passes.get('improved_lines')
+            record['regions'] = ocr_passes.get('regions')
+        record['bytesOut'] = len(context.extracted_text)
+
+    def _validate(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if context.extracted_text:
+            logger.info(f"Successfully extracted {len(context.extracted_text)} characters")
+            # Validate if this looks like a medical document
+            context.validation = self.ocr_service.validate_medical_document(context.extracted_text)
+            record['isLikelyMedical'] = context.validation['is_likely_medical']
+            if not context.validation['is_likely_medical']:
+                logger.warning("Document may not be a medical report")
+
+        if not context.extracted_text and not context.findings.strip():
+            raise PipelineError('No text content available for analysis (no attachment or findings provided)', 400)
+
+        context.combined_text = combine_text(context.extracted_text, context.findings)
+        record['bytesIn'] = len(context.extracted_text)
+        record['bytesOut'] = len(context.combined_text)
+
+    def _compact(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        # The prompt gets the compacted text; extracted_text stays raw for auditing
+        if not self.compaction_enabled or not context.extracted_text or context.analysis is not None:
+            record['status'] = 'skipped'
+            return
+
+        compacted, stats = compact_text(context.extracted_text)
+        context.ocr_metadata['compaction'] = stats
+        context.combined_text = combine_text(compacted, context.findings)
+        record['bytesIn'] = stats['chars_in']
+        record['bytesOut'] = stats['chars_out']
+        record['boilerplateLines'] = stats['boilerplate_lines']
+        record['duplicateLines'] = stats['duplicate_lines']
+        if stats['chars_saved'] > 0:
+            metrics.inc('diagnostic_pipeline_compaction_chars_saved_total', stats['chars_saved'])
+
+    def _prompt(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        # Analyses read from a layout template need no LLM
+        if context.analysis is not None:
+            record['status'] = 'skipped'
+            return
+
+        context.prompt = self.diagnostic_service.create_analysis_prompt(
+            context.combined_text, context.test_type, context.findings
+        )
+        record['bytesIn'] = len(context.combined_text)
+        record['bytesOut'] = len(context.prompt)
+        # Rough estimate; the provider's count is reported by the llm stage
+        record['tokensEstimated'] = len(context.prompt) // 4
+
+    def _llm(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if context.analysis is not None:
+            record['status'] = 'skipped'
+            return
+
+        logger.info(f"Analyzing {len(context.combined_text)} characters of text")
+        stats: Dict[str, Any] = {}
+        try:
+            context.response_document = self.diagnostic_service.request_analysis(context.prompt, stats=stats)
+        except MalformedJSONError as e:
+            logger.error(f"Failed to parse AI response as JSON: {str(e)}")
+            # The parse stage turns the raw text into a degraded result
+            context.response_document = e.document
+            context.degraded = True
+        except Exception as e:
+            raise PipelineError(f"AI analysis failed: {str(e)}", 500)
+        finally:
+            record['attempts'] = stats.get('attempts')
+            record['tokensIn'] = stats.get('prompt_tokens')
+            record['tokensOut'] = stats.get('completion_tokens')
+            record['bytesIn'] = len(context.prompt)
+            record['bytesOut'] = stats.get('response_chars')
+
+        for kind in ('In', 'Out'):
+            if record[f'tokens{kind}']:
+                metrics.inc('diagnostic_pipeline_llm_tokens_total', record[f'tokens{kind}'],
+                            kind='prompt' if kind == 'In' else 'completion')
+
+    def _parse(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if context.analysis is not None:
+            record['status'] = 'skipped'
+            return
+
+        record['bytesIn'] = len(context.response_document or '')
+        context.analysis, parsed = self.diagnostic_service.parse_analysis(context.response_document or '')
+        # The fallback must not be stored or learned from
+        context.degraded = context.degraded or not parsed
+        record['testValues'] = len(context.analysis.get('structuredData', {}).get('testValues', []))
+
+    def _learn(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not self.layout_templates or not context.layout or not context.layout['words'] or context.degraded:
+            record['status'] = 'skipped'
+            return
+
+        # Learning is an optimization; it must not fail the analysis
+        try:
+            template = self.layout_templates.learn(context.layout, context.analysis)
+        except Exception as e:
+            logger.error(f"Failed to learn layout template: {str(e)}")
+            template = None
+        record['learned'] = template is not None
+        if template:
+            record['templateId'] = template['id']
+            record['samples'] = template['samples']
+
+    def _store(self, context: PipelineContext, record: Dict[str, Any]) -> None:
+        if not self.result_store or context.degraded:
+            record['status'] = 'skipped'
+            return
+        self._save(context)
+
+    def _save(self, context: PipelineContext) -> None:
+        # A store failure must not fail an analysis that has already completed
+        try:
+            self.result_store.save(context.test_result_id, context.source, context.input_hash,
+                                   context.content_hash, context.to_payload())
+        except Exception as e:
+            logger.error(f"Failed to store diagnostic result: {str(e)}")
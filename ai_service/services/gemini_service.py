@@ -3,12 +3,17 @@ import os
 import logging
 import json
 from datetime import datetime
+from pydantic import ValidationError
+from .streaming_json import IncrementalJSONParser, MalformedJSONError
+from .llm_schemas import QUESTIONNAIRE_TASK, rejects_structured_output
 
 class GeminiAIService:
     def __init__(self):
         self.api_key = os.getenv('OPENROUTER_API_KEY')
         self.base_url = 'https://openrouter.ai/api/v1/chat/completions'
         self.model = os.getenv('GEMINI_MODEL', 'google/gemini-2.0-flash-exp:free')
+        # Ask the provider to enforce response schemas; switched off if the model rejects it
+        self.structured_output = os.getenv('LLM_STRUCTURED_OUTPUT', 'true').lower() == 'true'
         
         if not self.api_key:
             raise ValueError("OpenRouter API key not found in environment variables")
@@ -21,14 +26,9 @@ class GeminiAIService:
             # Create the prompt for questionnaire generation
             prompt = self._create_questionnaire_prompt(reason_for_visit, patient_history)
             
-            # Make request to OpenRouter API
-            response = self._make_api_request(prompt)
-            
-            if response and 'choices' in response:
-                content = response['choices'][0]['message']['content']
-                return self._parse_questionnaire_response(content, reason_for_visit)
-            else:
-                return self._generate_fallback_questionnaire(reason_for_visit)
+            # Stream the response so malformed generations are aborted early
+            questionnaire_data = self.generate_json(prompt, task=QUESTIONNAIRE_TASK)
+            return self._parse_questionnaire_response(questionnaire_data, reason_for_visit)
                 
         except Exception as e:
             logging.error(f"Error generating questionnaire: {str(e)}")
@@ -47,23 +47,7 @@ class GeminiAIService:
         - Yes/No questions for medical history
         - Scale questions for pain/severity ratings (1-10)
 
-        Format your response as a JSON object with this exact structure:
-        {{
-            "title": "Pre-Visit Questionnaire: [Reason for Visit]",
-            "urgency_level": "Low|Medium|High|Critical",
-            "estimated_duration": "5-10 minutes",
-            "questions": [
-                {{
-                    "id": 1,
-                    "type": "text|multiple_choice|yes_no|scale",
-                    "question": "The actual question text",
-                    "required": true|false,
-                    "options": ["option1", "option2"] // only for multiple_choice
-                }}
-            ],
-            "preparation_notes": "What the patient should prepare or bring",
-            "urgency_notes": "Any urgent symptoms to watch for"
-        }}
+        Title the questionnaire "Pre-Visit Questionnaire: [Reason for Visit]" and respond with a JSON object following the response schema.
 
         Make the questions medically relevant, easy to understand, and focused on gathering information that would be valuable for the doctor to know before the appointment.
         """
@@ -73,8 +57,13 @@ class GeminiAIService:
         
         return prompt
     
-    def _make_api_request(self, prompt):
-        """Make the actual API request to OpenRouter"""
+    def _build_request(self, prompt, task=None, structured=True):
+        """Build the headers and payload for an OpenRouter chat completion"""
+        structured = task is not None and structured and self.structured_output
+        if task is not None and not structured:
+            # The schema has to travel in the prompt instead
+            prompt += task.schema_instructions()
+        
         headers = {
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json',
@@ -98,45 +87,124 @@ class GeminiAIService:
             'max_tokens': 2000
         }
         
+        if structured:
+            data['response_format'] = task.response_format
+        
+        return headers, data
+    
+    def _make_api_request(self, prompt, task=None):
+        """Make the actual API request to OpenRouter"""
+        headers, data = self._build_request(prompt, task)
+        
         response = requests.post(self.base_url, headers=headers, json=data, timeout=30)
         response.raise_for_status()
         
         return response.json()
     
-    def _parse_questionnaire_response(self, content, reason_for_visit):
-        """Parse the AI response into structured questionnaire data"""
-        try:
-            # Try to extract JSON from the response
-            json_start = content.find('{')
-            json_end = content.rfind('}') + 1
+    def _stream_api_request(self, prompt, task=None, usage=None, structured=True):
+        """Make a streaming API request to OpenRouter, yielding content deltas as they arrive"""
+        headers, data = self._build_request(prompt, task, structured)
+        data['stream'] = True
+        # Token usage is reported in the final chunk of the stream
+        data['usage'] = {'include': True}
+        
+        with requests.post(self.base_url, headers=headers, json=data, timeout=30, stream=True) as response:
+            if not response.ok:
+                # Read the error body while the connection is open; the caller inspects it
+                response.content
+            response.raise_for_status()
             
-            if json_start != -1 and json_end > json_start:
-                json_content = content[json_start:json_end]
-                questionnaire_data = json.loads(json_content)
-                
-                # Validate and enhance the questionnaire
-                if 'questions' not in questionnaire_data:
-                    raise ValueError("No questions found in response")
-                
-                # Add metadata
-                questionnaire_data['ai_generated'] = True
-                questionnaire_data['generated_at'] = datetime.now().isoformat()
-                questionnaire_data['model_used'] = self.model
-                questionnaire_data['reason_for_visit'] = reason_for_visit
+            for line in response.iter_lines():
+                # Server-sent events; OpenRouter also sends ': keep-alive' comments
+                if not line or not line.startswith(b'data:'):
+                    continue
+                payload = line[5:].strip()
+                if payload == b'[DONE]':
+                    break
                 
-                # Ensure required fields exist
-                if 'urgency_level' not in questionnaire_data:
-                    questionnaire_data['urgency_level'] = 'Medium'
-                if 'estimated_duration' not in questionnaire_data:
-                    questionnaire_data['estimated_duration'] = '5-10 minutes'
-                
-                return questionnaire_data
-            else:
-                raise ValueError("No valid JSON found in response")
-                
-        except (json.JSONDecodeError, ValueError) as e:
-            logging.error(f"Error parsing questionnaire response: {str(e)}")
-            return self._generate_fallback_questionnaire(reason_for_visit)
+                event = json.loads(payload)
+                if usage is not None and event.get('usage'):
+                    usage.update(event['usage'])
+                choices = event.get('choices') or []
+                if choices:
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+    
+    def generate_json(self, prompt, task=None, schema=None, item_paths=(), on_item=None, max_attempts=2,
+                      validate=True, stats=None):
+        """
+        Generate a JSON response, validating it incrementally while it streams
+        
+        When a task from llm_schemas is given, its compiled schema is requested as
+        provider structured output and the finished document is validated through
+        the task model, returning the validated dict. With validate=False the raw
+        JSON document is returned instead, leaving model validation to the caller.
+        
+        If a stats dict is passed it receives the attempt count, the response size
+        and the token usage reported by the provider.
+        
+        Malformed generations are aborted at the first invalid token and retried.
+        Completed values under item_paths are passed to on_item before the document
+        is finished; values from an aborted attempt may already have been surfaced.
+        """
+        if task is not None:
+            schema = task.json_schema
+        last_error = None
+        attempt = 0
+        structured = True
+        
+        while attempt < max_attempts:
+            attempt += 1
+            parser = IncrementalJSONParser(schema=schema, item_paths=item_paths, on_item=on_item,
+                                           coerce_scalars=task is not None)
+            usage = {}
+            stream = self._stream_api_request(prompt, task, usage, structured=structured)
+            try:
+                for delta in stream:
+                    parser.feed(delta)
+                    if parser.done:
+                        break
+                if task is None:
+                    return parser.close()
+                parser.close()
+                if not validate:
+                    return parser.document
+                return task.validate_json(parser.document)
+            except requests.exceptions.HTTPError as e:
+                if task is None or not structured or not self.structured_output or \
+                        not rejects_structured_output(e.response):
+                    raise
+                # Only this request falls back; set LLM_STRUCTURED_OUTPUT=False for models that never support it
+                logging.warning(f"Model {self.model} rejected structured output, retrying with the schema in the prompt")
+                structured = False
+                attempt -= 1
+            except MalformedJSONError as e:
+                logging.warning(f"Aborted malformed generation (attempt {attempt}/{max_attempts}): {str(e)}")
+                last_error = e
+            except ValidationError as e:
+                logging.warning(f"Response failed {task.name} validation (attempt {attempt}/{max_attempts}): {str(e)}")
+                last_error = MalformedJSONError(str(e), document=parser.text)
+            finally:
+                # Closing the generator releases the HTTP connection
+                stream.close()
+                if stats is not None:
+                    stats['attempts'] = attempt
+                    stats['response_chars'] = len(parser.text)
+                    stats['prompt_tokens'] = usage.get('prompt_tokens')
+                    stats['completion_tokens'] = usage.get('completion_tokens')
+        
+        raise last_error
+    
+    def _parse_questionnaire_response(self, questionnaire_data, reason_for_visit):
+        """Enhance the parsed AI response into structured questionnaire data"""
+        # Add metadata
+        questionnaire_data['ai_generated'] = True
+        questionnaire_data['generated_at'] = datetime.now().isoformat()
+        questionnaire_data['model_used'] = self.model
+        questionnaire_data['reason_for_visit'] = reason_for_visit
+        
+        return questionnaire_data
     
     def _generate_fallback_questionnaire(self, reason_for_visit):
         """Generate a basic fallback questionnaire when AI fails"""
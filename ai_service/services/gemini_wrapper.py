@@ -1,5 +1,7 @@
 from .gemini_service import GeminiAIService
+from .llm_schemas import LLMTask
 import logging
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +35,36 @@ class GeminiService:
         except Exception as e:
             logger.error(f"Error generating response: {str(e)}")
             raise
-    
+
+    def generate_json(self, prompt: str, task: Optional[LLMTask] = None,
+                      schema: Optional[Dict[str, Any]] = None,
+                      item_paths: Iterable[Tuple] = (),
+                      on_item: Optional[Callable[[Tuple, Any], None]] = None,
+                      validate: bool = True,
+                      stats: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Generate a JSON response, parsing and validating it while it streams
+
+        Args:
+            prompt: The prompt to send to Gemini
+            task: Structured LLM task whose model validates the response (optional)
+            schema: Expected JSON schema of the response when no task is given (optional)
+            item_paths: Paths whose completed children are surfaced early
+            on_item: Callback receiving (path, value) for each surfaced child
+            validate: Validate through the task model; False returns the raw JSON document
+            stats: Dictionary filled with attempts, response size and token usage
+
+        Returns:
+            The parsed JSON document, validated through the task model if given
+        """
+        try:
+            return self.gemini_ai.generate_json(prompt, task=task, schema=schema,
+                                                item_paths=item_paths, on_item=on_item,
+                                                validate=validate, stats=stats)
+        except Exception as e:
+            logger.error(f"Error generating JSON response: {str(e)}")
+            raise
+
     def is_available(self) -> bool:
         """
         Check if the Gemini service is available
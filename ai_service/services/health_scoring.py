@@ -0,0 +1,259 @@
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .vitals_trends import analyze_trends, risk_flags
+
+logger = logging.getLogger(__name__)
+
+# Features scored per patient; missing ones are NaN and add no penalty
+FEATURES = ['age', 'bmi', 'systolic', 'diastolic', 'bloodSugar', 'heartRate', 'cholesterol',
+            'timeInRange', 'readings', 'weightChange', 'medications', 'meanAdherence', 'minAdherence',
+            'activeConditions']
+
+# Trend statistics series -> feature holding its recent level
+LEVEL_FEATURES = {
+    'systolic': 'systolic',
+    'diastolic': 'diastolic',
+    'blood sugar': 'bloodSugar',
+    'heart rate': 'heartRate',
+    'cholesterol': 'cholesterol',
+}
+
+# Penalty rules: (feature, start, full, points). The penalty grows linearly
+# from 0 at ``start`` to ``points`` at ``full``; full < start penalizes low values
+VITALS_PENALTIES = [
+    ('systolic', 120, 160, 25),
+    ('systolic', 90, 80, 15),
+    ('diastolic', 80, 100, 15),
+    ('bloodSugar', 140, 250, 25),
+    ('bloodSugar', 70, 55, 20),
+    ('heartRate', 100, 130, 10),
+    ('heartRate', 50, 40, 10),
+    ('cholesterol', 200, 280, 15),
+    ('timeInRange', 1.0, 0.0, 20),
+]
+LIFESTYLE_PENALTIES = [
+    ('bmi', 25, 40, 30),
+    ('bmi', 18.5, 15, 20),
+    # Share of body weight gained or lost per month
+    ('weightChange', 0.01, 0.05, 15),
+    # Few readings means little self-monitoring
+    ('readings', 10, 0, 20),
+]
+MEDICATION_PENALTIES = [
+    ('meanAdherence', 100, 40, 60),
+    ('minAdherence', 80, 40, 20),
+    ('medications', 5, 10, 15),
+]
+CONDITION_PENALTY = 3
+MAX_CONDITION_PENALTY = 15
+
+# Overall score weights of the breakdown scores
+WEIGHTS = {'vitals': 0.5, 'medications': 0.25, 'lifestyle': 0.25}
+
+# Scores when there is nothing to score
+DEFAULT_SCORE = 75
+
+# Risk rules: (condition, vital type, feature, moderate threshold, high threshold, prevention tips).
+# A risk is raised when the feature reaches the moderate threshold; when the high
+# threshold is the lower one, values below the thresholds are flagged
+RISK_RULES: List[Tuple[str, Optional[str], str, float, float, List[str]]] = [
+    ('Hypertension', 'bloodPressure', 'systolic', 130, 140,
+     ['Reduce salt intake', 'Exercise regularly', 'Monitor blood pressure at home']),
+    ('Diastolic hypertension', 'bloodPressure', 'diastolic', 80, 90,
+     ['Reduce salt and alcohol intake', 'Monitor blood pressure at home']),
+    ('Hyperglycemia', 'bloodSugar', 'bloodSugar', 140, 200,
+     ['Limit refined carbohydrates', 'Check blood sugar regularly', 'Discuss diabetes screening with your provider']),
+    ('Hypoglycemia', 'bloodSugar', 'bloodSugar', 70, 54,
+     ['Keep a fast-acting sugar source at hand', 'Review medication doses with your provider']),
+    ('Tachycardia', 'heartRate', 'heartRate', 100, 120,
+     ['Limit caffeine and stimulants', 'Report palpitations or dizziness']),
+    ('Bradycardia', 'heartRate', 'heartRate', 50, 40,
+     ['Report fainting or fatigue', 'Review heart-rate-lowering medications']),
+    ('High cholesterol', 'cholesterol', 'cholesterol', 200, 240,
+     ['Limit saturated fats', 'Increase fiber intake', 'Recheck lipids as advised']),
+    ('Obesity', 'weight', 'bmi', 30, 35,
+     ['Aim for gradual weight loss', 'Increase daily physical activity']),
+    ('Low medication adherence', None, 'minAdherence', 80, 50,
+     ['Use reminders or a pill organizer', 'Discuss side effects or costs with your provider']),
+]
+
+# Age from which raised blood pressure or cholesterol is flagged as cardiovascular risk
+CARDIOVASCULAR_AGE = 55
+
+RULE_INDEX = {rule[0]: index for index, rule in enumerate(RISK_RULES)}
+
+# Feature -> (label, unit) in risk factor descriptions
+FEATURE_LABELS = {
+    'systolic': ('Recent systolic blood pressure', 'mmHg'),
+    'diastolic': ('Recent diastolic blood pressure', 'mmHg'),
+    'bloodSugar': ('Recent blood sugar', 'mg/dL'),
+    'heartRate': ('Recent heart rate', 'bpm'),
+    'cholesterol': ('Recent cholesterol', 'mg/dL'),
+    'bmi': ('BMI', 'kg/m2'),
+    'minAdherence': ('Lowest medication adherence', '%'),
+}
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _patient_features(patient_data: Dict[str, Any], trends: Dict[str, Any]) -> List[float]:
+    """Feature row of one patient"""
+    profile = patient_data.get('patient') or {}
+    row = dict.fromkeys(FEATURES, np.nan)
+    row['age'] = _number(profile.get('age'))
+
+    in_range, readings = [], 0
+    for vital_type, entry in trends.items():
+        for name, stats in entry.get('statistics', {}).items():
+            if name in LEVEL_FEATURES:
+                row[LEVEL_FEATURES[name]] = stats['rollingMean']
+                in_range.append(stats['timeInRange'])
+            readings = max(readings, stats['count'])
+            if name == 'weight' and stats['mean']:
+                row['weightChange'] = abs(stats['slopePer30Days']) / stats['mean']
+    if in_range:
+        row['timeInRange'] = sum(in_range) / len(in_range)
+    if trends:
+        row['readings'] = readings
+
+    weight = trends.get('weight', {}).get('statistics', {}).get('weight', {}).get('rollingMean') \
+        or _number(profile.get('weight'))
+    height = _number(profile.get('height'))
+    if height and height > 0:
+        row['bmi'] = weight / (height / 100) ** 2
+
+    medications = [med for med in patient_data.get('medications') or [] if isinstance(med, dict)]
+    row['medications'] = len(medications)
+    adherence = [value for value in (_number(med.get('adherence')) for med in medications) if value == value]
+    if adherence:
+        row['meanAdherence'] = sum(adherence) / len(adherence)
+        row['minAdherence'] = min(adherence)
+
+    conditions = [condition for condition in patient_data.get('conditions') or [] if isinstance(condition, dict)]
+    row['activeConditions'] = sum(1 for condition in conditions
+                                  if str(condition.get('status', 'active')).lower() not in ('resolved', 'inactive'))
+    return [row[name] for name in FEATURES]
+
+
+def _penalties(matrix: np.ndarray, rules: List[Tuple[str, float, float, float]]) -> np.ndarray:
+    """Total penalty per patient of a list of linear penalty rules"""
+    total = np.zeros(len(matrix))
+    for feature, start, full, points in rules:
+        column = matrix[:, FEATURES.index(feature)]
+        share = np.clip((column - start) / (full - start), 0, 1)
+        total += np.nan_to_num(share) * points
+    return total
+
+
+def _component(matrix: np.ndarray, rules, present: np.ndarray) -> np.ndarray:
+    """0-100 component score; patients with none of its features get the default"""
+    score = np.clip(100 - _penalties(matrix, rules), 0, 100)
+    return np.where(present, score, DEFAULT_SCORE)
+
+
+def _risk_levels(column: np.ndarray, moderate: float, high: float) -> np.ndarray:
+    """0 (no risk), 1 (moderate) or 2 (high) per patient; missing values are no risk"""
+    if high >= moderate:
+        return np.select([column >= high, column >= moderate], [2, 1], 0)
+    return np.select([column < high, column < moderate], [2, 1], 0)
+
+
+def score_patients(patients: List[Dict[str, Any]],
+                   trends: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Health scores and risk factors of a list of patients
+
+    Features are extracted per patient; the rules are applied to the whole
+    feature matrix at once.
+
+    Args:
+        patients: Patient data as sent to /api/health-insights
+        trends: trendAnalysis of each patient; computed from the vitals when omitted
+
+    Returns:
+        {'healthScore', 'riskFactors'} per patient, in order
+    """
+    if trends is None:
+        trends = [analyze_trends(patient.get('vitals') or {}, (patient.get('patient') or {}).get('height'))
+                  for patient in patients]
+    matrix = np.array([_patient_features(patient, patient_trends)
+                       for patient, patient_trends in zip(patients, trends)], dtype=np.float64)
+    if not len(matrix):
+        return []
+    matrix = matrix.reshape(len(patients), len(FEATURES))
+
+    def present(*features):
+        return np.isfinite(matrix[:, [FEATURES.index(feature) for feature in features]]).any(axis=1)
+
+    vitals = _component(matrix, VITALS_PENALTIES, present(*LEVEL_FEATURES.values()))
+    lifestyle = _component(matrix, LIFESTYLE_PENALTIES, present('bmi', 'readings'))
+    # Patients without medications have nothing to miss
+    no_medications = matrix[:, FEATURES.index('medications')] == 0
+    medications = _component(matrix, MEDICATION_PENALTIES, present('meanAdherence') | no_medications)
+
+    conditions = np.minimum(matrix[:, FEATURES.index('activeConditions')] * CONDITION_PENALTY,
+                            MAX_CONDITION_PENALTY)
+    overall = np.clip(WEIGHTS['vitals'] * vitals + WEIGHTS['medications'] * medications
+                      + WEIGHTS['lifestyle'] * lifestyle - conditions, 0, 100)
+
+    levels = np.stack([_risk_levels(matrix[:, FEATURES.index(feature)], moderate, high)
+                       for _, _, feature, moderate, high, _ in RISK_RULES], axis=1)
+    age = matrix[:, FEATURES.index('age')]
+    cardiovascular_levels = levels[:, [RULE_INDEX['Hypertension'], RULE_INDEX['High cholesterol']]].max(axis=1)
+    cardiovascular = (np.nan_to_num(age) >= CARDIOVASCULAR_AGE) & (cardiovascular_levels > 0)
+
+    results = []
+    for index in range(len(patients)):
+        risks, covered = [], set()
+        for rule, level in zip(RISK_RULES, levels[index]):
+            if not level:
+                continue
+            condition, vital_type, feature, moderate, _, tips = rule
+            value = matrix[index, FEATURES.index(feature)]
+            label, unit = FEATURE_LABELS[feature]
+            risks.append({
+                'condition': condition,
+                'riskLevel': 'high' if level == 2 else 'moderate',
+                'factors': [f"{label} {value:.0f} {unit} (threshold {moderate:g})"],
+                'preventionTips': tips
+            })
+            covered.add(vital_type)
+        if cardiovascular[index]:
+            risks.append({
+                'condition': 'Cardiovascular disease',
+                'riskLevel': 'high' if cardiovascular_levels[index] == 2 else 'moderate',
+                'factors': [f'Age {age[index]:.0f}', 'Raised blood pressure or cholesterol'],
+                'preventionTips': ['Discuss cardiovascular risk assessment with your provider',
+                                   'Stay active and avoid smoking']
+            })
+        # Worsening trends of vitals not already flagged by level
+        flags = risk_flags({vital_type: entry for vital_type, entry in trends[index].items()
+                            if vital_type not in covered})
+        risks.extend(flags)
+        risks.sort(key=lambda risk: risk['riskLevel'] != 'high')
+
+        results.append({
+            'healthScore': {
+                'overall': int(round(overall[index])),
+                'breakdown': {
+                    'vitals': int(round(vitals[index])),
+                    'medications': int(round(medications[index])),
+                    'lifestyle': int(round(lifestyle[index]))
+                }
+            },
+            'riskFactors': risks
+        })
+    return results
+
+
+def score_patient(patient_data: Dict[str, Any], trends: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Health score and risk factors of one patient; see score_patients"""
+    return score_patients([patient_data], None if trends is None else [trends])[0]
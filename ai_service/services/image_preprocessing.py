@@ -0,0 +1,208 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Pixels darker than the binarization threshold are ink (value 0 in the output)
+INK, PAPER = 0, 255
+
+# Deskew search range and final resolution in degrees
+MAX_SKEW_DEGREES = 10.0
+SKEW_STEP_DEGREES = 0.1
+
+# Ink pixels sampled for the skew estimate
+SKEW_SAMPLE_PIXELS = 30000
+
+# Working width for illumination and skew estimation
+ESTIMATION_WIDTH = 800
+
+
+def to_gray_array(image: Image.Image) -> np.ndarray:
+    """Grayscale uint8 array of an image"""
+    return np.asarray(image if image.mode == 'L' else image.convert('L'), dtype=np.uint8)
+
+
+def normalize_illumination(gray: np.ndarray, block: int = 32) -> np.ndarray:
+    """
+    Flatten uneven lighting by dividing by an estimate of the paper background
+
+    The background is the 90th percentile brightness of each block of a 4x
+    downsampled page, interpolated back to full size, so shadows and gradients
+    from phone photos are removed while the ink stays dark.
+    """
+    height, width = gray.shape
+    reduced = np.asarray(Image.fromarray(gray).reduce(4)) if min(height, width) >= 4 * block else gray
+    cell = max(1, block * reduced.shape[0] // height)
+    rows, cols = max(1, reduced.shape[0] // cell), max(1, reduced.shape[1] // cell)
+    cells = reduced[:rows * cell, :cols * cell].reshape(rows, cell, cols, cell)
+    cells = cells.transpose(0, 2, 1, 3).reshape(rows, cols, -1)
+    rank = int(0.9 * (cells.shape[2] - 1))
+    background = np.partition(cells, rank, axis=2)[:, :, rank]
+    background = np.asarray(
+        Image.fromarray(background).resize((width, height), Image.Resampling.BILINEAR),
+        dtype=np.float32
+    )
+    np.maximum(background, 1.0, out=background)
+    normalized = gray * (255.0 / background)
+    return np.minimum(normalized, 255, out=normalized).astype(np.uint8)
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Global threshold maximizing the between-class variance of the histogram"""
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weights = np.cumsum(histogram)
+    means = np.cumsum(histogram * np.arange(256))
+    total_weight, total_mean = weights[-1], means[-1]
+    background_weight = weights[:-1]
+    foreground_weight = total_weight - background_weight
+    valid = (background_weight > 0) & (foreground_weight > 0)
+    variance = np.zeros(255)
+    variance[valid] = (total_mean * background_weight[valid] - means[:-1][valid] * total_weight) ** 2 / (
+        background_weight[valid] * foreground_weight[valid])
+    return int(np.argmax(variance))
+
+
+def adaptive_threshold(gray: np.ndarray, window: int = 31, offset: int = 10) -> np.ndarray:
+    """
+    Local mean thresholding using an integral image
+
+    Returns:
+        Boolean ink mask
+    """
+    half = window // 2
+    # Unsigned arithmetic wraps modulo 2**32, so window sums stay exact even
+    # where the running totals of a large page overflow
+    padded = np.pad(gray, half, mode='edge').astype(np.uint32)
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.uint32)
+    np.cumsum(padded, axis=0, out=padded)
+    np.cumsum(padded, axis=1, out=integral[1:, 1:])
+    sums = (integral[window:, window:] - integral[:-window, window:]
+            - integral[window:, :-window] + integral[:-window, :-window]).astype(np.int32)
+    return gray.astype(np.int32) * (window * window) < sums - offset * window * window
+
+
+def binarize(gray: np.ndarray, method: str = 'otsu') -> np.ndarray:
+    """
+    Ink mask of a grayscale page
+
+    Args:
+        gray: Grayscale page
+        method: 'otsu' for a global threshold, 'adaptive' for a local one
+
+    Returns:
+        Boolean array, True for ink
+    """
+    if method == 'adaptive':
+        return adaptive_threshold(gray)
+    return gray <= otsu_threshold(gray)
+
+
+def _projection_scores(ys: np.ndarray, xs: np.ndarray, angles: np.ndarray) -> np.ndarray:
+    """Sharpness of the row histogram of the ink pixels sheared by each angle"""
+    tangents = np.tan(np.radians(angles))
+    # rows[i, j]: projected row of pixel j for angle i
+    rows = np.rint(ys[None, :] - xs[None, :] * tangents[:, None]).astype(np.int64)
+    rows -= rows.min(axis=1, keepdims=True)
+    width = int(rows.max()) + 1
+    offsets = (np.arange(len(angles)) * width)[:, None]
+    histograms = np.bincount((rows + offsets).ravel(), minlength=len(angles) * width)
+    return (histograms.reshape(len(angles), width).astype(np.float64) ** 2).sum(axis=1)
+
+
+def estimate_skew(ink: np.ndarray, max_degrees: float = MAX_SKEW_DEGREES,
+                  step: float = SKEW_STEP_DEGREES) -> float:
+    """
+    Skew angle in degrees of the text rows (positive: rows rise to the right)
+
+    Every ink pixel is projected onto the vertical axis for each candidate
+    angle; the angle whose row histogram is sharpest (largest sum of squares)
+    aligns the text lines. A coarse 1 degree search is refined around its best
+    angle.
+    """
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 50:
+        return 0.0
+    # Keep the estimate cheap on dense pages
+    if len(ys) > SKEW_SAMPLE_PIXELS:
+        keep = np.random.default_rng(0).choice(len(ys), SKEW_SAMPLE_PIXELS, replace=False)
+        ys, xs = ys[keep], xs[keep]
+    # Image rows grow downwards; flip so positive angles rise to the right
+    ys = -ys
+
+    coarse = np.arange(-max_degrees, max_degrees + 0.5, 1.0)
+    best = coarse[int(np.argmax(_projection_scores(ys, xs, coarse)))]
+    fine = np.arange(best - 1.0, best + 1.0 + step / 2, step)
+    # Adding 0.0 turns -0.0 into 0.0
+    return round(float(fine[int(np.argmax(_projection_scores(ys, xs, fine)))]), 2) + 0.0
+
+
+def content_box(ink: np.ndarray, margin: int = 20, border_fraction: float = 0.5) -> Tuple[int, int, int, int]:
+    """
+    Bounding box (left, top, right, bottom) of the page content
+
+    Dark scanner borders (rows or columns at the edges that are mostly ink)
+    are stripped before the ink bounding box is taken.
+    """
+    height, width = ink.shape
+    row_fill, col_fill = ink.mean(axis=1), ink.mean(axis=0)
+
+    def inner_range(fill: np.ndarray) -> Tuple[int, int]:
+        light = np.nonzero(fill < border_fraction)[0]
+        return (int(light[0]), int(light[-1]) + 1) if len(light) else (0, len(fill))
+
+    top, bottom = inner_range(row_fill)
+    left, right = inner_range(col_fill)
+    inner = ink[top:bottom, left:right]
+    rows, cols = np.nonzero(inner.any(axis=1))[0], np.nonzero(inner.any(axis=0))[0]
+    if not len(rows):
+        return 0, 0, width, height
+    return (max(0, left + int(cols[0]) - margin), max(0, top + int(rows[0]) - margin),
+            min(width, left + int(cols[-1]) + 1 + margin), min(height, top + int(rows[-1]) + 1 + margin))
+
+
+def remove_specks(ink: np.ndarray, min_neighbours: int = 2) -> np.ndarray:
+    """Drop ink pixels with fewer than ``min_neighbours`` inked 8-neighbours"""
+    padded = np.pad(ink, 1).astype(np.uint8)
+    height, width = ink.shape
+    neighbours = sum(
+        padded[1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx
+    )
+    return ink & (neighbours >= min_neighbours)
+
+
+def preprocess_page(image: Image.Image, method: str = 'otsu',
+                    stats: Optional[Dict[str, Any]] = None) -> Image.Image:
+    """
+    Prepare a page image for Tesseract: flatten lighting, binarize, deskew,
+    crop borders and remove specks
+
+    Args:
+        image: Page image
+        method: Binarization method, 'otsu' or 'adaptive'
+        stats: Dictionary receiving the skew angle and crop box (optional)
+
+    Returns:
+        Black-on-white binary page image
+    """
+    ink = binarize(normalize_illumination(to_gray_array(image)), method)
+
+    # Estimate skew on a downsampled ink mask
+    step = max(1, int(np.ceil(ink.shape[1] / ESTIMATION_WIDTH)))
+    angle = estimate_skew(ink[::step, ::step])
+    if abs(angle) >= SKEW_STEP_DEGREES:
+        # PIL rotates counter-clockwise; rows rising to the right are turned back clockwise
+        rotated = Image.fromarray(np.where(ink, INK, PAPER).astype(np.uint8)).rotate(
+            -angle, resample=Image.Resampling.NEAREST, expand=True, fillcolor=PAPER)
+        ink = np.asarray(rotated) == INK
+
+    left, top, right, bottom = content_box(ink)
+    ink = remove_specks(ink[top:bottom, left:right])
+
+    if stats is not None:
+        stats['skew_degrees'] = angle
+        stats['crop_box'] = [left, top, right, bottom]
+    return Image.fromarray(np.where(ink, INK, PAPER).astype(np.uint8))
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('health_insights_cache_lookups_total', 'Health insights cache lookups by outcome')
+
+
+def fingerprint(value: Any) -> str:
+    """Hash of the canonical JSON form of a value, independent of key order"""
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def insights_cache_keys(patient_data: Dict[str, Any], options: Dict[str, Any],
+                        data_version: Optional[str] = None) -> Tuple[Optional[str], str]:
+    """
+    Cache slot and version of a health insights request
+
+    The slot identifies the patient by the id the data carries. The version
+    covers all of the data, so a new reading changes the version but not the
+    slot. Data without a patient id gets no slot: patients with the same
+    profile would share one and be served each other's insights.
+
+    Args:
+        patient_data: Patient data of the request
+        options: Request options shaping the insights (analysis type, includes)
+        data_version: Version of data held outside patient_data (e.g. stored vitals)
+
+    Returns:
+        Tuple of (slot or None, version)
+    """
+    profile = patient_data.get('patient') or {}
+    patient_id = patient_data.get('patient_id') or profile.get('id') or profile.get('_id')
+    slot = fingerprint([{'patientId': str(patient_id)}, options]) if patient_id else None
+    return slot, fingerprint([patient_data, options, data_version])
+
+
+class InsightsCache:
+    """
+    In-memory cache of generated health insights with stale-while-revalidate.
+
+    Insights are kept per patient slot together with the version of the data
+    they were generated from. A request with the same version within
+    ``ttl_seconds`` is a hit. After that, or once the data changed (a new
+    reading), the cached insights are still served for up to
+    ``stale_seconds`` while a background refresh regenerates them; older
+    entries are regenerated in the request. Requests without a slot are
+    cached by version and never served stale. Concurrent requests for the
+    same slot and version share one generation.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None,
+                 stale_seconds: Optional[float] = None, max_workers: Optional[int] = None):
+        """
+        Initialize the cache
+
+        Args:
+            max_entries: Patients kept, least recently used dropped first (defaults to INSIGHTS_CACHE_MAX_ENTRIES)
+            ttl_seconds: Age until which an entry is fresh (defaults to INSIGHTS_CACHE_TTL_SECONDS)
+            stale_seconds: Age until which an outdated entry is served while refreshing
+                (defaults to INSIGHTS_CACHE_STALE_SECONDS)
+            max_workers: Concurrent background refreshes (defaults to INSIGHTS_CACHE_REFRESH_WORKERS)
+        """
+        self.max_entries = max_entries or int(os.getenv('INSIGHTS_CACHE_MAX_ENTRIES', 1024))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            float(os.getenv('INSIGHTS_CACHE_TTL_SECONDS', 3600))
+        self.stale_seconds = stale_seconds if stale_seconds is not None else \
+            float(os.getenv('INSIGHTS_CACHE_STALE_SECONDS', 86400))
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv('INSIGHTS_CACHE_REFRESH_WORKERS', 2)),
+            thread_name_prefix='insights-refresh'
+        )
+        self._lock = threading.Lock()
+        # slot -> {'version', 'value', 'stored_at', 'started'}
+        self._entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        # (slot, version) -> generation in progress
+        self._pending: Dict[Tuple[str, str], Future] = {}
+
+    def get(self, slot: Optional[str], version: str, compute: Callable[[], Dict[str, Any]],
+            cacheable: Callable[[Dict[str, Any]], bool] = lambda value: True,
+            force: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Cached insights of a slot, generating them if needed
+
+        Args:
+            slot: Patient slot from insights_cache_keys; None caches by version without stale serving
+            version: Data version from insights_cache_keys
+            compute: Generates the insights of the current data
+            cacheable: Whether generated insights may be cached (e.g. not fallbacks)
+            force: Regenerate in the request even if a fresh entry exists
+
+        Returns:
+            Tuple of (insights, cache info with status 'hit', 'stale', 'miss' or
+            'bypass' and the age of served entries in seconds)
+        """
+        serve_stale = slot is not None
+        slot = slot or version
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(slot)
+            if entry is not None and not force:
+                age = now - entry['stored_at']
+                self._entries.move_to_end(slot)
+                if entry['version'] == version and age < self.ttl_seconds:
+                    metrics.inc('health_insights_cache_lookups_total', outcome='hit')
+                    return entry['value'], {'status': 'hit', 'ageSeconds': round(age, 1)}
+                if serve_stale and age < self.stale_seconds:
+                    self._refresh(slot, version, compute, cacheable)
+                    metrics.inc('health_insights_cache_lookups_total', outcome='stale')
+                    return entry['value'], {
+                        'status': 'stale',
+                        'ageSeconds': round(age, 1),
+                        'reason': 'expired' if entry['version'] == version else 'data_changed'
+                    }
+
+            future = self._pending.get((slot, version))
+            owner = future is None
+            if owner:
+                future = self._pending[(slot, version)] = Future()
+
+        status = 'bypass' if force else 'miss'
+        metrics.inc('health_insights_cache_lookups_total', outcome=status if owner else 'joined')
+        if not owner:
+            # Another request is generating the same insights
+            return future.result(), {'status': 'miss'}
+        self._generate(slot, version, compute, cacheable, future)
+        return future.result(), {'status': status}
+
+    def invalidate(self, slot: str) -> bool:
+        """Drop a slot's cached insights; returns whether there were any"""
+        with self._lock:
+            return self._entries.pop(slot, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'refreshing': len(self._pending),
+                'maxEntries': self.max_entries,
+                'ttlSeconds': self.ttl_seconds,
+                'staleSeconds': self.stale_seconds
+            }
+
+    def _refresh(self, slot: str, version: str, compute: Callable[[], Dict[str, Any]],
+                 cacheable: Callable[[Dict[str, Any]], bool]) -> None:
+        """Start a background generation unless one is running; called with the lock held"""
+        if (slot, version) in self._pending:
+            return
+        future = self._pending[(slot, version)] = Future()
+        self._executor.submit(self._generate, slot, version, compute, cacheable, future)
+
+    def _generate(self, slot: str, version: str, compute: Callable[[], Dict[str, Any]],
+                  cacheable: Callable[[Dict[str, Any]], bool], future: Future) -> None:
+        started = time.monotonic()
+        try:
+            value = compute()
+        except Exception as e:
+            logger.error(f"Health insights generation failed: {str(e)}")
+            with self._lock:
+                self._pending.pop((slot, version), None)
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._pending.pop((slot, version), None)
+            current = self._entries.get(slot)
+            # A slow refresh of older data must not replace insights generated after it started
+            if cacheable(value) and (current is None or current['started'] <= started):
+                self._entries[slot] = {'version': version, 'value': value, 'stored_at': time.time(),
+                                       'started': started}
+                self._entries.move_to_end(slot)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
@@ -0,0 +1,556 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .llm_schemas import DIAGNOSTIC_ANALYSIS_TASK, RISK_LEVELS
+from .result_store import DEFAULT_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS layout_templates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    header_hash TEXT NOT NULL,
+    header_text TEXT NOT NULL,
+    geometry TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    laboratory TEXT NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 1,
+    hits INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_layout_templates_header
+    ON layout_templates (header_hash);
+"""
+
+# Analyses produced from a template report this model
+TEMPLATE_MODEL = 'layout-template'
+
+# Largest difference in normalized coordinates between boxes of the same layout
+GEOMETRY_TOLERANCE = 0.03
+
+# A template is learned only if at least this many test values, and this
+# share of all test values, were found on the page
+MIN_TEMPLATE_FIELDS = 3
+MIN_LOCATED_SHARE = 0.8
+
+# Template reads are rejected below this mean word confidence or with more
+# than this share of unreadable values
+MIN_READ_CONFIDENCE = 60.0
+MAX_UNREADABLE_SHARE = 0.1
+
+# Templates failing this many times, and more often than they succeed, are no longer used
+MAX_FAILURES = 3
+
+# Words that must appear on the line of each patient detail
+PATIENT_LABELS = {
+    'name': ('name', 'patient'),
+    'age': ('age', 'age/sex', 'age/gender'),
+    'gender': ('gender', 'sex', 'age/sex', 'age/gender'),
+    'testDate': ('date', 'collected', 'reported')
+}
+
+# Patient details read from a template must look like their kind; values
+# moved by longer text earlier on the line are dropped rather than misread
+PATIENT_PATTERNS = {
+    'name': re.compile(r'^[^\d]+$'),
+    'age': re.compile(r'\d'),
+    'gender': re.compile(r'^[A-Za-z/]+$'),
+    'testDate': re.compile(r'\d')
+}
+
+NUMBER = re.compile(r'^[<>]?\s*-?\d+(?:[.,]\d+)*$')
+RANGE = re.compile(r'(-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)')
+BOUND = re.compile(r'(<=|>=|<|>|≤|≥)\s*(-?\d+(?:\.\d+)?)')
+
+
+def normalize_header(text: str) -> str:
+    """
+    Letter-only words of the first line of a report header
+
+    Only the first line (usually the laboratory name) is used, and digits are
+    dropped, so patient details, dates and IDs do not change it.
+    """
+    for line in text.splitlines():
+        header = ' '.join(word for word in re.findall(r'[A-Z]+', line.upper()) if len(word) >= 3)
+        if header:
+            return header
+    return ''
+
+
+def page_layout(size: Tuple[int, int], regions: Sequence[Box], header_text: str) -> Optional[Dict[str, Any]]:
+    """
+    Fingerprint of a preprocessed page
+
+    Region geometry is the left, top and bottom edge of each region; right
+    edges move with the length of names and values.
+
+    Args:
+        size: (width, height) of the page
+        regions: Text regions of the page, top to bottom
+        header_text: OCR text of the first region
+
+    Returns:
+        Layout with the header hash, normalized region geometry and an empty
+        word list filled by OCR, or None if the header has no readable text
+    """
+    header = normalize_header(header_text)
+    if not header:
+        return None
+    return {
+        'size': tuple(size),
+        'header': header,
+        'headerHash': hashlib.sha256(header.encode('utf-8')).hexdigest(),
+        'geometry': [[left, top, bottom] for left, top, _, bottom in (normalize_box(box, size) for box in regions)],
+        'words': []
+    }
+
+
+def normalize_box(box: Sequence[float], size: Tuple[int, int]) -> List[float]:
+    """Box as fractions of the page size, clamped to the page"""
+    width, height = size
+    return [round(min(1.0, max(0.0, coordinate / extent)), 4)
+            for coordinate, extent in zip(box, (width, height, width, height))]
+
+
+def denormalize_box(box: Sequence[float], size: Tuple[int, int]) -> Box:
+    """Page pixel box of a normalized box"""
+    width, height = size
+    return (int(box[0] * width), int(box[1] * height), int(round(box[2] * width)), int(round(box[3] * height)))
+
+
+def _box_distance(a: Sequence[float], b: Sequence[float]) -> float:
+    return max(abs(x - y) for x, y in zip(a, b))
+
+
+def geometry_distance(a: Sequence[Sequence[float]], b: Sequence[Sequence[float]]) -> float:
+    """Largest coordinate difference between the regions of two layouts; infinite if they differ in count"""
+    if len(a) != len(b):
+        return float('inf')
+    return max((_box_distance(x, y) for x, y in zip(a, b)), default=0.0)
+
+
+# --- Learning --------------------------------------------------------------
+
+def _token(text: str) -> str:
+    return text.strip().strip(':;,|').lower()
+
+
+def _tokens(text: str) -> List[str]:
+    return [token for token in (_token(part) for part in str(text).split()) if token]
+
+
+def _lines(words: List[Dict[str, Any]]) -> List[List[int]]:
+    """Word indices grouped by OCR line, each line ordered left to right"""
+    lines: Dict[Any, List[int]] = {}
+    for index, word in enumerate(words):
+        lines.setdefault(tuple(word['line']), []).append(index)
+    return [sorted(line, key=lambda index: words[index]['box'][0]) for line in lines.values()]
+
+
+def _find_sequence(tokens: List[str], target: List[str]) -> int:
+    for start in range(len(tokens) - len(target) + 1):
+        if tokens[start:start + len(target)] == target:
+            return start
+    return -1
+
+
+def _field_box(words: List[Dict[str, Any]], line: List[int], start: int, count: int) -> Box:
+    """
+    Box of words on a line, widened halfway to the neighbouring words so that
+    longer values of the same field still fit
+    """
+    chosen = [words[index]['box'] for index in line[start:start + count]]
+    left, top = min(box[0] for box in chosen), min(box[1] for box in chosen)
+    right, bottom = max(box[2] for box in chosen), max(box[3] for box in chosen)
+    height = bottom - top
+    previous_right = words[line[start - 1]]['box'][2] if start > 0 else left - 2 * height
+    next_left = words[line[start + count]]['box'][0] if start + count < len(line) else right + 4 * height
+    margin = int(0.3 * height)
+    return ((previous_right + left) // 2, top - margin, (right + next_left) // 2, bottom + margin)
+
+
+def _locate(words: List[Dict[str, Any]], lines: List[List[int]], value: str,
+            labels: Sequence[str]) -> Optional[Box]:
+    """
+    Box of a value on the line sharing most words with one of its labels
+
+    At least half of the words of a label must appear on the line.
+    """
+    value_tokens = _tokens(value)
+    label_tokens = [set(_tokens(label)) for label in labels if _tokens(label)]
+    if not value_tokens or not label_tokens:
+        return None
+    best, best_score = None, 0.0
+    for line in lines:
+        tokens = [_token(words[index]['text']) for index in line]
+        start = _find_sequence(tokens, value_tokens)
+        if start < 0:
+            continue
+        score = max(len(label & set(tokens)) / len(label) for label in label_tokens)
+        if score >= 0.5 and score > best_score:
+            best, best_score = _field_box(words, line, start, len(value_tokens)), score
+    return best
+
+
+def locate_fields(layout: Dict[str, Any], analysis: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Find where the values of a successful analysis sit on the page
+
+    Test values are located on the line naming their parameter and patient
+    details on a line carrying their label. Parameter names, units and
+    reference ranges are printed the same on every report of a layout, so
+    they are kept from the analysis rather than read again.
+
+    Returns:
+        Template fields with normalized boxes, or None if too few test values were found
+    """
+    words, size = layout['words'], layout['size']
+    lines = _lines(words)
+    structured = analysis.get('structuredData') or {}
+    test_values = [value for value in structured.get('testValues') or []
+                   if value.get('parameter') and value.get('value')]
+
+    fields = []
+    for test_value in test_values:
+        box = _locate(words, lines, test_value['value'], [test_value['parameter']])
+        if box is None:
+            continue
+        fields.append({
+            'section': 'testValues',
+            'parameter': test_value['parameter'],
+            'unit': test_value.get('unit', ''),
+            'referenceRange': test_value.get('referenceRange', ''),
+            'numeric': bool(NUMBER.match(test_value['value'].strip())),
+            'box': normalize_box(box, size)
+        })
+    if len(fields) < MIN_TEMPLATE_FIELDS or len(fields) < MIN_LOCATED_SHARE * len(test_values):
+        return None
+
+    patient = structured.get('patientInfo') or {}
+    for key, labels in PATIENT_LABELS.items():
+        box = _locate(words, lines, patient.get(key) or '', labels)
+        if box is not None:
+            fields.append({'section': 'patientInfo', 'key': key, 'box': normalize_box(box, size)})
+    return fields
+
+
+def _field_key(field: Dict[str, Any]) -> Tuple[str, str]:
+    return field['section'], field.get('parameter') or field.get('key')
+
+
+def _merge_fields(old: List[Dict[str, Any]], new: List[Dict[str, Any]],
+                  samples: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Average the boxes of a repeat sample into a template
+
+    Returns:
+        Merged fields, or None if the sample disagrees with the template
+    """
+    old_by_key = {_field_key(field): field for field in old}
+    new_by_key = {_field_key(field): field for field in new}
+    test_keys = {key for key in old_by_key if key[0] == 'testValues'}
+    if test_keys != {key for key in new_by_key if key[0] == 'testValues'}:
+        return None
+
+    merged = []
+    for key, field in old_by_key.items():
+        other = new_by_key.get(key)
+        if other is None:
+            merged.append(field)
+            continue
+        if _box_distance(field['box'], other['box']) > GEOMETRY_TOLERANCE:
+            return None
+        merged.append(dict(field, box=[round((a * samples + b) / (samples + 1), 4)
+                                       for a, b in zip(field['box'], other['box'])]))
+    merged.extend(field for key, field in new_by_key.items() if key not in old_by_key)
+    return merged
+
+
+# --- Extraction ------------------------------------------------------------
+
+def _to_number(text: str) -> Optional[float]:
+    try:
+        return float(text.lstrip('<> ').replace(',', ''))
+    except ValueError:
+        return None
+
+
+def range_deviation(value: str, reference_range: str) -> Optional[float]:
+    """
+    How far a value lies outside its reference range, relative to the range
+
+    Returns:
+        0 inside the range, a positive fraction outside it, or None if either
+        the value or the range could not be read
+    """
+    number = _to_number(value)
+    if number is None or not reference_range:
+        return None
+    match = RANGE.search(reference_range)
+    if match:
+        low, high = float(match.group(1)), float(match.group(2))
+        scale = (high - low) or abs(high) or 1.0
+        if number < low:
+            return (low - number) / scale
+        return (number - high) / scale if number > high else 0.0
+    match = BOUND.search(reference_range)
+    if match:
+        bound = float(match.group(2))
+        scale = abs(bound) or 1.0
+        if match.group(1) in ('<', '<=', '≤'):
+            return max(0.0, number - bound) / scale
+        return max(0.0, bound - number) / scale
+    return None
+
+
+def _severity(deviation: float) -> str:
+    if deviation <= 0.1:
+        return 'low'
+    return 'moderate' if deviation <= 0.5 else 'high'
+
+
+def build_analysis(template: Dict[str, Any], readings: List[Tuple[str, float]]) -> Optional[Dict[str, Any]]:
+    """
+    Turn the OCR reads of a template's field boxes into a diagnostic analysis
+
+    Abnormal values are flagged against the template's reference ranges and
+    the summary and risk level are derived from them, in the same shape as an
+    LLM analysis.
+
+    Args:
+        template: Matched template
+        readings: (text, confidence) read from each template field, in order
+
+    Returns:
+        Validated analysis, or None if the reads are too unreliable to use
+    """
+    test_values, patient = [], {}
+    confidences, value_fields, unreadable = [], 0, 0
+    for field, (text, confidence) in zip(template['fields'], readings):
+        text = text.strip()
+        if field['section'] == 'patientInfo':
+            if text and PATIENT_PATTERNS[field['key']].search(text):
+                patient[field['key']] = text
+            continue
+        value_fields += 1
+        if not text or (field['numeric'] and not NUMBER.match(text)):
+            unreadable += 1
+            continue
+        confidences.append(confidence)
+        deviation = range_deviation(text, field['referenceRange'])
+        test_values.append({
+            'parameter': field['parameter'],
+            'value': text,
+            'unit': field['unit'],
+            'referenceRange': field['referenceRange'],
+            'isAbnormal': bool(deviation),
+            'deviation': deviation
+        })
+
+    mean_confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    if not test_values or unreadable > MAX_UNREADABLE_SHARE * value_fields or mean_confidence < MIN_READ_CONFIDENCE:
+        return None
+
+    findings = [{
+        'parameter': value['parameter'],
+        'value': value['value'],
+        'severity': _severity(value['deviation']),
+        'description': f"{value['parameter']} is {value['value']} {value['unit']}".strip() +
+                       f", outside the reference range {value['referenceRange']}",
+        'recommendation': 'Discuss this result with your healthcare provider.'
+    } for value in test_values if value['isAbnormal']]
+    level = max((finding['severity'] for finding in findings), key=RISK_LEVELS.index, default='low')
+
+    if findings:
+        summary = (f"{len(findings)} of {len(test_values)} test values are outside their reference ranges: "
+                   f"{', '.join(finding['parameter'] for finding in findings)}.")
+    else:
+        summary = f"All {len(test_values)} test values are within their reference ranges."
+
+    lines = [f"{key}: {value}" for key, value in patient.items()]
+    lines += [f"{value['parameter']}: {value['value']} {value['unit']} (Ref: {value['referenceRange']})"
+              for value in test_values]
+
+    analysis = DIAGNOSTIC_ANALYSIS_TASK.validate({
+        'extractedText': '\n'.join(lines),
+        'structuredData': {
+            'testValues': test_values,
+            'patientInfo': patient,
+            'laboratoryInfo': template['laboratory']
+        },
+        'abnormalFindings': findings,
+        'aiSummary': summary,
+        'riskAssessment': {
+            'level': level,
+            'description': f"Based on {len(findings)} out-of-range values in a recognized report layout"
+        },
+        'confidence': round(mean_confidence / 100, 2)
+    })
+    analysis['aiModel'] = TEMPLATE_MODEL
+    return analysis
+
+
+class LayoutTemplateStore:
+    """
+    SQLite store of learned lab report layouts.
+
+    A layout is fingerprinted by the hash of its header text and the geometry
+    of its text regions. After a successful LLM analysis the positions of the
+    extracted values are learned from the OCR word boxes; once the same layout
+    has been learned consistently ``min_samples`` times, later reports of it
+    are read field by field from those positions instead of being OCRed whole
+    and sent to the LLM.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, min_samples: Optional[int] = None):
+        """
+        Initialize the store, creating the database if needed
+
+        Args:
+            db_path: SQLite file path (defaults to LAYOUT_TEMPLATE_PATH or the result store database)
+            min_samples: Consistent analyses needed before a template is used
+                (defaults to LAYOUT_TEMPLATE_MIN_SAMPLES)
+        """
+        self.db_path = db_path or os.getenv('LAYOUT_TEMPLATE_PATH', DEFAULT_DB_PATH)
+        self.min_samples = min_samples or int(os.getenv('LAYOUT_TEMPLATE_MIN_SAMPLES', 2))
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def find(self, layout: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Usable template of a page layout
+
+        Returns:
+            The closest confirmed template within the geometry tolerance, or None
+        """
+        template = self._closest(layout)
+        if template is None or template['samples'] < self.min_samples:
+            return None
+        if template['failures'] >= MAX_FAILURES and template['failures'] > template['hits']:
+            return None
+        return template
+
+    def learn(self, layout: Dict[str, Any], analysis: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Learn field positions from a successful analysis of a page
+
+        A sample agreeing with the stored template of its layout confirms it
+        and refines its boxes; a disagreeing one replaces it.
+
+        Returns:
+            The stored template, or None if the page could not be learned
+        """
+        fields = locate_fields(layout, analysis)
+        if fields is None:
+            return None
+        laboratory = (analysis.get('structuredData') or {}).get('laboratoryInfo') or {}
+        now = time.time()
+
+        with self._lock:
+            existing = self._closest(layout)
+            with self._connect() as connection:
+                if existing is None:
+                    template_id = connection.execute(
+                        'INSERT INTO layout_templates '
+                        '(header_hash, header_text, geometry, fields, laboratory, created_at, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (layout['headerHash'], layout['header'], json.dumps(layout['geometry']),
+                         json.dumps(fields), json.dumps(laboratory), now, now)
+                    ).lastrowid
+                else:
+                    template_id = existing['id']
+                    merged = _merge_fields(existing['fields'], fields, existing['samples'])
+                    if merged is not None:
+                        connection.execute(
+                            'UPDATE layout_templates SET fields = ?, samples = samples + 1, updated_at = ? '
+                            'WHERE id = ?', (json.dumps(merged), now, template_id)
+                        )
+                    else:
+                        logger.info(f"Relearning layout template {template_id}: sample disagrees with it")
+                        connection.execute(
+                            'UPDATE layout_templates SET geometry = ?, fields = ?, laboratory = ?, '
+                            'samples = 1, hits = 0, failures = 0, updated_at = ? WHERE id = ?',
+                            (json.dumps(layout['geometry']), json.dumps(fields), json.dumps(laboratory),
+                             now, template_id)
+                        )
+        return self.get(template_id)
+
+    def record_use(self, template_id: int, success: bool) -> None:
+        """Count a template read as a hit, or as a failure when it fell back to the LLM"""
+        column = 'hits' if success else 'failures'
+        with self._connect() as connection:
+            connection.execute(f'UPDATE layout_templates SET {column} = {column} + 1 WHERE id = ?',
+                               (template_id,))
+
+    def get(self, template_id: int) -> Optional[Dict[str, Any]]:
+        with self._connect() as connection:
+            row = connection.execute('SELECT * FROM layout_templates WHERE id = ?', (template_id,)).fetchone()
+        return self._to_record(row)
+
+    def list_templates(self) -> List[Dict[str, Any]]:
+        """All learned templates, most recently updated first"""
+        with self._connect() as connection:
+            rows = connection.execute('SELECT * FROM layout_templates ORDER BY updated_at DESC').fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def delete(self, template_id: int) -> bool:
+        """Forget a template; its layout is learned again from later analyses"""
+        with self._connect() as connection:
+            return connection.execute('DELETE FROM layout_templates WHERE id = ?', (template_id,)).rowcount > 0
+
+    def _closest(self, layout: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT * FROM layout_templates WHERE header_hash = ?',
+                                      (layout['headerHash'],)).fetchall()
+        best, best_distance = None, GEOMETRY_TOLERANCE
+        for template in map(self._to_record, rows):
+            distance = geometry_distance(layout['geometry'], template['geometry'])
+            if distance <= best_distance:
+                best, best_distance = template, distance
+        return best
+
+    @staticmethod
+    def _to_record(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'headerHash': row['header_hash'],
+            'header': row['header_text'],
+            'geometry': json.loads(row['geometry']),
+            'fields': json.loads(row['fields']),
+            'laboratory': json.loads(row['laboratory']),
+            'samples': row['samples'],
+            'hits': row['hits'],
+            'failures': row['failures'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at']
+        }
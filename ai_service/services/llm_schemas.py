@@ -0,0 +1,346 @@
+import json
+from typing import Annotated, Any, Dict, List, Literal, Optional, Union
+
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, field_validator
+
+from .streaming_json import IncrementalJSONParser
+
+RISK_LEVELS = ['low', 'moderate', 'high', 'critical']
+TREND_VALUES = ['improving', 'stable', 'declining', 'concerning']
+
+
+def _to_text(value: Any) -> str:
+    """Coerce scalars to text the same way the old hand-written validators did"""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _to_flag(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', '1', 'y')
+    return bool(value)
+
+
+def _to_unit_interval(value: Any) -> float:
+    try:
+        return max(0.0, min(1.0, float(value)))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _to_score(value: Any) -> int:
+    try:
+        return int(max(0.0, min(100.0, float(value))))
+    except (TypeError, ValueError):
+        return 75
+
+
+def Choice(valid: List[str], default: str, normalize=str.lower):
+    """Enum field type that maps anything outside ``valid`` to ``default`` instead of failing"""
+    def coerce(value: Any) -> str:
+        value = normalize(str(value).strip()) if value is not None else ''
+        return value if value in valid else default
+    return Annotated[Literal[tuple(valid)], BeforeValidator(coerce)]
+
+
+def _dicts_only(value: Any) -> Any:
+    return [item for item in value if isinstance(item, dict)] if isinstance(value, list) else []
+
+
+Text = Annotated[str, BeforeValidator(_to_text)]
+Flag = Annotated[bool, BeforeValidator(_to_flag)]
+UnitInterval = Annotated[float, BeforeValidator(_to_unit_interval)]
+Score = Annotated[int, BeforeValidator(_to_score)]
+TextList = Annotated[List[Text], BeforeValidator(lambda v: v if isinstance(v, list) else [])]
+
+# Enum fields; built here rather than inside annotations so linters and type checkers can read them
+FindingSeverity = Choice(RISK_LEVELS, 'moderate')
+RiskLevel = Choice(RISK_LEVELS, 'low')
+Trend = Choice(TREND_VALUES, 'stable')
+TipCategory = Choice(['medication', 'lifestyle', 'diet', 'exercise', 'monitoring', 'general'], 'general')
+TipPriority = Choice(['high', 'medium', 'low'], 'medium')
+RiskFactorLevel = Choice(['low', 'moderate', 'high'], 'moderate')
+QuestionType = Choice(['text', 'multiple_choice', 'yes_no', 'scale'], 'text')
+UrgencyLevel = Choice(['Low', 'Medium', 'High', 'Critical'], 'Medium', normalize=str.capitalize)
+DiagnosisSeverity = Choice(['mild', 'moderate', 'severe'], 'moderate')
+MedicationPriority = Choice(['primary', 'secondary', 'alternative'], 'secondary')
+CostLevel = Choice(['low', 'moderate', 'high'], 'moderate')
+WarningSeverity = Choice(['low', 'medium', 'high', 'critical'], 'medium')
+
+
+class _ResponseModel(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+
+# --- Diagnostic analysis -------------------------------------------------
+
+class TestValue(_ResponseModel):
+    parameter: Text = Field('', description='Test parameter name')
+    value: Text = Field('', description='Measured value')
+    unit: Text = Field('', description='Unit of measurement')
+    referenceRange: Text = Field('', description='Normal reference range')
+    isAbnormal: Flag = False
+
+
+class PatientInfo(_ResponseModel):
+    name: Text = ''
+    age: Text = ''
+    gender: Text = ''
+    testDate: Text = ''
+
+
+class LaboratoryInfo(_ResponseModel):
+    name: Text = ''
+    address: Text = ''
+    phone: Text = ''
+
+
+class StructuredData(_ResponseModel):
+    testValues: Annotated[List[TestValue], BeforeValidator(_dicts_only)] = []
+    patientInfo: PatientInfo = PatientInfo()
+    laboratoryInfo: LaboratoryInfo = LaboratoryInfo()
+
+
+class AbnormalFinding(_ResponseModel):
+    parameter: Text
+    value: Text = ''
+    severity: FindingSeverity = Field(
+        'moderate', description='low (slightly abnormal), moderate (concerning), '
+                                'high (requires attention) or critical (urgent)')
+    description: Text = ''
+    recommendation: Text = ''
+
+
+class RiskAssessment(_ResponseModel):
+    level: RiskLevel = 'low'
+    description: Text = ''
+
+
+class DiagnosticAnalysis(_ResponseModel):
+    extractedText: Text = Field('', description='Cleaned and formatted version of the report text')
+    structuredData: StructuredData = StructuredData()
+    abnormalFindings: List[AbnormalFinding] = []
+    aiSummary: Text = Field('', description='Natural language summary of the results and their clinical significance')
+    riskAssessment: RiskAssessment = RiskAssessment()
+    confidence: UnitInterval = Field(0.0, description='How clearly the data could be extracted and analyzed, 0-1')
+
+    @field_validator('abnormalFindings', mode='before')
+    @classmethod
+    def _keep_named_findings(cls, value: Any) -> Any:
+        return [item for item in _dicts_only(value) if item.get('parameter')]
+
+
+# --- Health insights -----------------------------------------------------
+
+class TrendAnalysisEntry(_ResponseModel):
+    trend: Trend = 'stable'
+    confidence: UnitInterval = 0.6
+    summary: Text = 'Insufficient data for detailed analysis'
+    recommendations: TextList = ['Continue monitoring', 'Consult with healthcare provider']
+
+
+class PersonalizedTip(_ResponseModel):
+    category: TipCategory = 'general'
+    priority: TipPriority = 'medium'
+    title: Text = ''
+    description: Text = Field('', description='Detailed actionable advice')
+    actionable: Flag = True
+
+
+class ScoreBreakdown(_ResponseModel):
+    vitals: Score = 75
+    medications: Score = 75
+    lifestyle: Score = 75
+
+
+class HealthScore(_ResponseModel):
+    overall: Score = Field(75, description='0-100, based on actual data patterns')
+    breakdown: ScoreBreakdown = ScoreBreakdown()
+
+
+class RiskFactor(_ResponseModel):
+    condition: Text
+    riskLevel: RiskFactorLevel = 'moderate'
+    factors: TextList = []
+    preventionTips: TextList = []
+
+
+class HealthInsights(_ResponseModel):
+    trendAnalysis: Dict[str, TrendAnalysisEntry] = Field(
+        description='Keyed by vital type; only vitals that have data')
+    personalizedTips: Annotated[List[PersonalizedTip], BeforeValidator(_dicts_only)]
+    healthScore: HealthScore
+    riskFactors: Annotated[List[RiskFactor], BeforeValidator(_dicts_only)]
+
+    @field_validator('trendAnalysis', mode='before')
+    @classmethod
+    def _keep_trend_objects(cls, value: Any) -> Any:
+        if not isinstance(value, dict):
+            return {}
+        return {key: entry for key, entry in value.items() if isinstance(entry, dict)}
+
+
+# Parts of a decomposed health insights request, generated concurrently
+class TrendNarrative(_ResponseModel):
+    summary: Text = Field('', description='Two or three sentences on the trend of this vital')
+    recommendations: TextList = []
+
+
+class PersonalizedTips(_ResponseModel):
+    personalizedTips: Annotated[List[PersonalizedTip], BeforeValidator(_dicts_only)]
+
+
+class RiskSummary(_ResponseModel):
+    riskFactors: Annotated[List[RiskFactor], BeforeValidator(_dicts_only)] = Field(
+        description='Only risk factors not already listed')
+
+
+# --- Pre-visit questionnaire ---------------------------------------------
+
+class Question(_ResponseModel):
+    id: Union[int, Text] = 0
+    type: QuestionType = 'text'
+    question: Text
+    required: Flag = False
+    options: Optional[TextList] = Field(None, description='Only for multiple_choice questions')
+
+
+class Questionnaire(_ResponseModel):
+    title: Text = ''
+    urgency_level: UrgencyLevel = 'Medium'
+    estimated_duration: Text = '5-10 minutes'
+    questions: Annotated[List[Question], BeforeValidator(_dicts_only)] = Field(min_length=1)
+    preparation_notes: Text = Field('', description='What the patient should prepare or bring')
+    urgency_notes: Text = Field('', description='Any urgent symptoms to watch for')
+
+
+# --- Medication recommendations ------------------------------------------
+
+class MedicationAnalysis(_ResponseModel):
+    primary_diagnosis: Text = ''
+    severity: DiagnosisSeverity = 'moderate'
+    risk_factors: TextList = []
+    contraindications: TextList = []
+
+
+class MedicationRecommendation(_ResponseModel):
+    medication_name: Text = Field(description='Generic name of medication')
+    brand_names: TextList = []
+    dosage: Text
+    frequency: Text
+    duration: Text = ''
+    route: Text = Field('', description='oral, topical, injection, etc')
+    indication: Text
+    rationale: Text
+    monitoring: Text = ''
+    side_effects: TextList = []
+    priority: MedicationPriority = 'secondary'
+    estimated_cost: CostLevel = 'moderate'
+
+
+class MedicationWarning(_ResponseModel):
+    type: Text = Field('', description='allergy, interaction, contraindication or monitoring')
+    message: Text = ''
+    severity: WarningSeverity = 'medium'
+
+
+class FollowUp(_ResponseModel):
+    timeline: Text = ''
+    parameters_to_monitor: TextList = []
+    red_flags: TextList = []
+
+
+class MedicationRecommendations(_ResponseModel):
+    analysis: MedicationAnalysis
+    recommendations: List[MedicationRecommendation]
+    warnings: Annotated[List[MedicationWarning], BeforeValidator(_dicts_only)]
+    lifestyle_recommendations: TextList = []
+    follow_up: FollowUp
+    confidence_score: UnitInterval = 0.0
+
+
+def _compact_schema(node: Any) -> Any:
+    """Drop the per-node titles pydantic generates; they only cost prompt tokens"""
+    if isinstance(node, list):
+        return [_compact_schema(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    compact = {}
+    for key, value in node.items():
+        if key == 'title':
+            continue
+        if key in ('properties', '$defs'):
+            compact[key] = {name: _compact_schema(child) for name, child in value.items()}
+        else:
+            compact[key] = _compact_schema(value)
+    return compact
+
+
+class LLMTask:
+    """A structured LLM task: its response model and the JSON schema compiled from it"""
+
+    def __init__(self, name: str, model: type):
+        self.name = name
+        self.model = model
+        self.json_schema = _compact_schema(model.model_json_schema())
+        self.schema_text = json.dumps(self.json_schema, separators=(',', ':'))
+
+    @property
+    def response_format(self) -> Dict[str, Any]:
+        """OpenAI-compatible structured output request parameter"""
+        return {
+            'type': 'json_schema',
+            'json_schema': {'name': self.name, 'strict': False, 'schema': self.json_schema}
+        }
+
+    def schema_instructions(self) -> str:
+        """Prompt suffix used when the provider cannot enforce the schema itself"""
+        return f"\n\nRespond ONLY with a JSON object matching this JSON schema:\n{self.schema_text}"
+
+    def validate_json(self, document: str) -> Dict[str, Any]:
+        """
+        Validate a raw JSON document against the task model
+
+        Raises:
+            pydantic.ValidationError: If the document does not fit the model
+        """
+        return self.model.model_validate_json(document).model_dump()
+
+    def parse(self, text: str) -> Dict[str, Any]:
+        """
+        Locate the JSON document in a complete response and validate it
+
+        Raises:
+            MalformedJSONError: If the response holds no well-formed document
+            pydantic.ValidationError: If the document does not fit the model
+        """
+        parser = IncrementalJSONParser(schema=self.json_schema, max_preamble=None, coerce_scalars=True)
+        parser.feed(text)
+        parser.close()
+        return self.validate_json(parser.document)
+
+    def validate(self, data: Any) -> Dict[str, Any]:
+        """Validate already decoded data against the task model"""
+        return self.model.model_validate(data).model_dump()
+
+
+def rejects_structured_output(response) -> bool:
+    """Whether an HTTP error response is the provider refusing the structured output parameter"""
+    if response is None or response.status_code != 400:
+        return False
+    body = response.text.lower()
+    return 'response_format' in body or 'json_schema' in body
+
+
+# Compiled once at import so every request reuses the same validators and schemas
+DIAGNOSTIC_ANALYSIS_TASK = LLMTask('diagnostic_analysis', DiagnosticAnalysis)
+HEALTH_INSIGHTS_TASK = LLMTask('health_insights', HealthInsights)
+TREND_NARRATIVE_TASK = LLMTask('trend_narrative', TrendNarrative)
+PERSONALIZED_TIPS_TASK = LLMTask('personalized_tips', PersonalizedTips)
+RISK_SUMMARY_TASK = LLMTask('risk_summary', RiskSummary)
+QUESTIONNAIRE_TASK = LLMTask('previsit_questionnaire', Questionnaire)
+MEDICATION_RECOMMENDATIONS_TASK = LLMTask('medication_recommendations', MedicationRecommendations)
+
@@ -3,12 +3,18 @@ import os
 import logging
 import json
 from datetime import datetime
+from .streaming_json import MalformedJSONError
+from pydantic import ValidationError
+from .llm_schemas import MEDICATION_RECOMMENDATIONS_TASK, rejects_structured_output
+
+RECOMMENDATION_DISCLAIMER = "These are AI-generated recommendations for clinical consideration only. Final prescribing decisions should always be made by a licensed healthcare provider."
 
 class MedicationRecommendationService:
     def __init__(self):
         self.api_key = os.getenv('OPENROUTER_API_KEY')
         self.base_url = 'https://openrouter.ai/api/v1/chat/completions'
         self.model = os.getenv('GEMINI_MODEL', 'google/gemini-2.0-flash-exp:free')
+        self.structured_output = os.getenv('LLM_STRUCTURED_OUTPUT', 'true').lower() == 'true'
         
         if not self.api_key:
             raise ValueError("OpenRouter API key not found in environment variables")
@@ -110,57 +116,20 @@ class MedicationRecommendationService:
         6. Suggest monitoring parameters if needed
         7. Include any warnings or precautions
 
-        Provide your response in the following JSON format:
-        {{
-            "analysis": {{
-                "primary_diagnosis": "Most likely diagnosis based on presented data",
-                "severity": "mild|moderate|severe",
-                "risk_factors": ["list of identified risk factors"],
-                "contraindications": ["list of contraindications found"]
-            }},
-            "recommendations": [
-                {{
-                    "medication_name": "Generic name of medication",
-                    "brand_names": ["Common brand names"],
-                    "dosage": "Recommended dosage",
-                    "frequency": "How often to take",
-                    "duration": "Recommended duration",
-                    "route": "oral|topical|injection|etc",
-                    "indication": "What this medication treats",
-                    "rationale": "Why this medication is recommended",
-                    "monitoring": "What to monitor while on this medication",
-                    "side_effects": ["Common side effects to watch for"],
-                    "priority": "primary|secondary|alternative",
-                    "estimated_cost": "low|moderate|high"
-                }}
-            ],
-            "warnings": [
-                {{
-                    "type": "allergy|interaction|contraindication|monitoring",
-                    "message": "Specific warning message",
-                    "severity": "low|medium|high|critical"
-                }}
-            ],
-            "lifestyle_recommendations": [
-                "Non-pharmacological recommendations"
-            ],
-            "follow_up": {{
-                "timeline": "When to follow up",
-                "parameters_to_monitor": ["What to check at follow-up"],
-                "red_flags": ["Symptoms that require immediate attention"]
-            }},
-            "confidence_score": 0.85,
-            "generated_at": "{datetime.now().isoformat()}",
-            "disclaimer": "These are AI-generated recommendations for clinical consideration only. Final prescribing decisions should always be made by a licensed healthcare provider."
-        }}
+        Provide your response as a JSON object following the response schema.
 
         IMPORTANT: Ensure all recommendations are safe given the patient's allergies and current medications. If insufficient data is available for safe recommendations, indicate this in the analysis.
         """
         
         return prompt
     
-    def _make_api_request(self, prompt):
+    def _make_api_request(self, prompt, structured=True):
         """Make request to OpenRouter API"""
+        task = MEDICATION_RECOMMENDATIONS_TASK
+        structured = structured and self.structured_output
+        if not structured:
+            prompt += task.schema_instructions()
+        
         headers = {
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
@@ -182,8 +151,14 @@ class MedicationRecommendationService:
             'max_tokens': 4000
         }
         
+        if structured:
+            data['response_format'] = task.response_format
+        
         try:
             response = requests.post(self.base_url, headers=headers, json=data, timeout=30)
+            if structured and rejects_structured_output(response):
+                logging.warning(f"Model {self.model} rejected structured output, retrying with the schema in the prompt")
+                return self._make_api_request(prompt, structured=False)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -193,52 +168,19 @@ class MedicationRecommendationService:
     def _parse_medication_response(self, content):
         """Parse and validate the AI response"""
         try:
-            # Try to extract JSON from the response
-            start_idx = content.find('{')
-            end_idx = content.rfind('}') + 1
-            
-            if start_idx != -1 and end_idx != -1:
-                json_str = content[start_idx:end_idx]
-                recommendations = json.loads(json_str)
+            # Extract the JSON document and validate it through the compiled model
+            recommendations = MEDICATION_RECOMMENDATIONS_TASK.parse(content)
+            recommendations['generated_at'] = datetime.now().isoformat()
+            recommendations['disclaimer'] = RECOMMENDATION_DISCLAIMER
+            return recommendations
                 
-                # Validate required fields
-                if self._validate_recommendations(recommendations):
-                    return recommendations
-                else:
-                    logging.warning("Invalid recommendation format received")
-                    return self._generate_fallback_recommendations()
-            else:
-                logging.warning("No valid JSON found in response")
-                return self._generate_fallback_recommendations()
-                
-        except json.JSONDecodeError as e:
+        except ValidationError as e:
+            logging.warning(f"Invalid recommendation format received: {str(e)}")
+            return self._generate_fallback_recommendations()
+        except (MalformedJSONError, json.JSONDecodeError, ValueError) as e:
             logging.error(f"Failed to parse JSON response: {str(e)}")
             return self._generate_fallback_recommendations()
     
-    def _validate_recommendations(self, recommendations):
-        """Validate the structure of recommendations"""
-        required_fields = ['analysis', 'recommendations', 'warnings', 'follow_up']
-        
-        if not isinstance(recommendations, dict):
-            return False
-        
-        for field in required_fields:
-            if field not in recommendations:
-                return False
-        
-        # Validate recommendations array
-        if not isinstance(recommendations['recommendations'], list):
-            return False
-        
-        # Validate each recommendation has required fields
-        for rec in recommendations['recommendations']:
-            required_rec_fields = ['medication_name', 'dosage', 'frequency', 'indication', 'rationale']
-            for req_field in required_rec_fields:
-                if req_field not in rec:
-                    return False
-        
-        return True
-    
     def _generate_fallback_recommendations(self):
         """Generate fallback recommendations when AI fails"""
         return {
@@ -0,0 +1,114 @@
+import threading
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text format.
+
+    Counters, gauges and histograms are created on first use; labels are
+    passed as keyword arguments.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help: Dict[str, str] = {}
+        self._counters: Dict[str, Dict[LabelSet, float]] = {}
+        self._gauges: Dict[str, Dict[LabelSet, float]] = {}
+        self._histograms: Dict[str, Dict[LabelSet, List[float]]] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        """Register the HELP text of a metric"""
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        """Increase a counter"""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge"""
+        key = self._labels(labels)
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a histogram observation"""
+        key = self._labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            # Per-bucket counts followed by the running sum and count
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [0.0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Counter and gauge values and histogram sums/counts keyed by metric and label string"""
+        result: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            for name, series in list(self._counters.items()) + list(self._gauges.items()):
+                for key, value in series.items():
+                    result.setdefault(name, {})[self._format_labels(key)] = value
+            for name, series in self._histograms.items():
+                for key, state in series.items():
+                    labels = self._format_labels(key)
+                    result.setdefault(f'{name}_sum', {})[labels] = state[-2]
+                    result.setdefault(f'{name}_count', {})[labels] = state[-1]
+        return result
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                lines.extend(self._header(name, 'counter'))
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f'{name}{self._format_labels(key)} {value:g}')
+            for name in sorted(self._gauges):
+                lines.extend(self._header(name, 'gauge'))
+                for key, value in sorted(self._gauges[name].items()):
+                    lines.append(f'{name}{self._format_labels(key)} {value:g}')
+            for name in sorted(self._histograms):
+                lines.extend(self._header(name, 'histogram'))
+                for key, state in sorted(self._histograms[name].items()):
+                    for index, bound in enumerate(self.buckets):
+                        lines.append(f'{name}_bucket{self._format_labels(key, le=f"{bound:g}")} {state[index]:g}')
+                    lines.append(f'{name}_bucket{self._format_labels(key, le="+Inf")} {state[-1]:g}')
+                    lines.append(f'{name}_sum{self._format_labels(key)} {state[-2]:g}')
+                    lines.append(f'{name}_count{self._format_labels(key)} {state[-1]:g}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, metric_type: str) -> List[str]:
+        header = []
+        if name in self._help:
+            header.append(f'# HELP {name} {self._help[name]}')
+        header.append(f'# TYPE {name} {metric_type}')
+        return header
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> LabelSet:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def _format_labels(key: LabelSet, **extra) -> str:
+        pairs = list(key) + list(extra.items())
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+# Shared registry exported at /api/metrics
+metrics = MetricsRegistry()
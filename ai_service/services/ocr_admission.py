@@ -0,0 +1,233 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('ocr_admission_requests_total', 'OCR admission decisions by outcome')
+metrics.describe('ocr_admission_queue_seconds', 'Time OCR work waited for a slot')
+metrics.describe('ocr_admission_cpu_seconds_total', 'CPU time of admitted OCR work, in the request thread and in OCR subprocesses')
+metrics.describe('ocr_admission_running', 'OCR jobs currently running')
+metrics.describe('ocr_admission_queued', 'OCR jobs currently waiting for a slot')
+
+# Bounds of the Retry-After hint in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+
+class OCROverloadedError(Exception):
+    """OCR work was shed; the client should retry after ``retry_after`` seconds"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _children_cpu_seconds() -> float:
+    """CPU time of finished child processes (Tesseract, poppler) of this process"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class OCRAdmissionController:
+    """
+    Admission control for CPU-bound OCR work sharing the process with
+    lightweight endpoints.
+
+    At most ``max_concurrent`` OCR jobs run at once, leaving cores free for
+    triage and pharmacy requests. Further jobs wait in a queue of at most
+    ``max_queue`` entries for up to ``queue_timeout`` seconds. Jobs are shed
+    with OCROverloadedError when the queue is full, the wait times out or the
+    load average per core is above ``max_load_per_core`` while OCR is
+    already running. Background jobs (prefetching) wait instead of being
+    shed.
+
+    Each admitted job records its queue time and its CPU time, both in the
+    request thread and in child processes. Child CPU time is taken from the
+    process-wide counter of finished children, so it is approximate when jobs
+    overlap.
+    """
+
+    def __init__(self, max_concurrent: Optional[int] = None, max_queue: Optional[int] = None,
+                 queue_timeout: Optional[float] = None, max_load_per_core: Optional[float] = None):
+        """
+        Initialize the controller
+
+        Args:
+            max_concurrent: OCR jobs running at once (defaults to OCR_MAX_CONCURRENT, or half the cores)
+            max_queue: Jobs allowed to wait for a slot (defaults to OCR_MAX_QUEUE)
+            queue_timeout: Seconds a job waits before it is shed (defaults to OCR_QUEUE_TIMEOUT_SECONDS)
+            max_load_per_core: 1-minute load average per core above which new jobs are shed
+                (defaults to OCR_MAX_LOAD_PER_CORE; 0 disables load shedding)
+        """
+        cores = os.cpu_count() or 1
+        self.max_concurrent = max_concurrent or int(os.getenv('OCR_MAX_CONCURRENT', max(1, cores // 2)))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('OCR_MAX_QUEUE', 8))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else \
+            float(os.getenv('OCR_QUEUE_TIMEOUT_SECONDS', 30))
+        self.max_load_per_core = max_load_per_core if max_load_per_core is not None else \
+            float(os.getenv('OCR_MAX_LOAD_PER_CORE', 1.5))
+        self.cores = cores
+
+        self._condition = threading.Condition()
+        self._running = 0
+        self._queued = 0
+        # Moving average of job durations, used for the Retry-After hint
+        self._average_seconds = 5.0
+
+    def acquire(self, kind: str = 'ocr', background: bool = False) -> Dict[str, Any]:
+        """
+        Wait for an OCR slot
+
+        Args:
+            kind: Label of the work for metrics
+            background: Wait as long as needed instead of being shed
+
+        Returns:
+            Ticket to pass to release
+
+        Raises:
+            OCROverloadedError: If the job was shed
+        """
+        queued_at = time.perf_counter()
+        with self._condition:
+            if not background:
+                self._check_capacity(kind)
+
+            self._queued += 1
+            self._update_gauges()
+            deadline = None if background else queued_at + self.queue_timeout
+            try:
+                while self._running >= self.max_concurrent:
+                    remaining = None if deadline is None else deadline - time.perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        self._shed(kind, 'timeout', 'Timed out waiting for document processing capacity')
+                    self._condition.wait(remaining)
+            finally:
+                self._queued -= 1
+                self._update_gauges()
+            self._running += 1
+            self._update_gauges()
+
+        queue_seconds = time.perf_counter() - queued_at
+        metrics.inc('ocr_admission_requests_total', kind=kind, outcome='admitted')
+        metrics.observe('ocr_admission_queue_seconds', queue_seconds, kind=kind)
+        return {
+            'kind': kind,
+            'queueMs': round(queue_seconds * 1000, 2),
+            'started': time.perf_counter(),
+            'threadCpu': time.thread_time(),
+            'childCpu': _children_cpu_seconds()
+        }
+
+    def check(self, kind: str = 'ocr') -> None:
+        """
+        Shed new work now if acquire would, without taking a slot
+
+        Raises:
+            OCROverloadedError: If work of this kind would be shed
+        """
+        with self._condition:
+            self._check_capacity(kind)
+
+    def release(self, ticket: Dict[str, Any], cpu_seconds: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Free the slot of an admitted job
+
+        Args:
+            ticket: Ticket returned by acquire
+            cpu_seconds: CPU time the job measured itself, e.g. in a worker process. It
+                replaces the thread and child counters, which only hold when the job
+                ran in the thread that acquired and releases the slot
+
+        Returns:
+            Usage of the job: queue, wall-clock and CPU time in milliseconds
+        """
+        duration = time.perf_counter() - ticket['started']
+        if cpu_seconds is None:
+            thread_cpu = time.thread_time() - ticket['threadCpu']
+            child_cpu = _children_cpu_seconds() - ticket['childCpu']
+        else:
+            thread_cpu, child_cpu = 0.0, cpu_seconds
+        with self._condition:
+            self._running -= 1
+            self._average_seconds = 0.8 * self._average_seconds + 0.2 * duration
+            self._update_gauges()
+            self._condition.notify()
+
+        metrics.inc('ocr_admission_cpu_seconds_total', thread_cpu, kind=ticket['kind'], source='thread')
+        metrics.inc('ocr_admission_cpu_seconds_total', child_cpu, kind=ticket['kind'], source='children')
+        return {
+            'queueMs': ticket['queueMs'],
+            'wallMs': round(duration * 1000, 2),
+            'cpuMs': round(thread_cpu * 1000, 2),
+            'childCpuMs': round(child_cpu * 1000, 2)
+        }
+
+    @contextmanager
+    def admit(self, kind: str = 'ocr', background: bool = False) -> Iterator[Dict[str, Any]]:
+        """Hold an OCR slot for the duration of a block; the usage is added to the ticket on exit"""
+        ticket = self.acquire(kind, background)
+        try:
+            yield ticket
+        finally:
+            ticket['usage'] = self.release(ticket)
+
+    def retry_after(self) -> int:
+        """Seconds after which the current backlog should have drained"""
+        with self._condition:
+            backlog = self._running + self._queued
+            seconds = self._average_seconds * max(1, backlog) / self.max_concurrent
+        return int(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(seconds))))
+
+    def status(self) -> Dict[str, Any]:
+        """Current running and queued jobs, limits and load"""
+        with self._condition:
+            return {
+                'running': self._running,
+                'queued': self._queued,
+                'maxConcurrent': self.max_concurrent,
+                'maxQueue': self.max_queue,
+                'loadPerCore': self._load_per_core(),
+                'averageSeconds': round(self._average_seconds, 2)
+            }
+
+    def _check_capacity(self, kind: str) -> None:
+        # Called with the condition held
+        load = self._load_per_core()
+        if self.max_load_per_core and load is not None and load > self.max_load_per_core and self._running:
+            self._shed(kind, 'load', f"Server is busy (load {load:.1f} per core)")
+        if self._running >= self.max_concurrent and self._queued >= self.max_queue:
+            self._shed(kind, 'queue_full', 'Too many documents are being processed')
+
+    def _shed(self, kind: str, reason: str, message: str) -> None:
+        # Called with the condition held; its lock is reentrant
+        metrics.inc('ocr_admission_requests_total', kind=kind, outcome=f'shed_{reason}')
+        retry_after = self.retry_after()
+        logger.warning(f"Shedding {kind} work ({reason}); retry after {retry_after}s")
+        raise OCROverloadedError(message, retry_after)
+
+    def _load_per_core(self) -> Optional[float]:
+        if not hasattr(os, 'getloadavg'):
+            return None
+        try:
+            return os.getloadavg()[0] / self.cores
+        except OSError:
+            return None
+
+    def _update_gauges(self) -> None:
+        metrics.set('ocr_admission_running', self._running)
+        metrics.set('ocr_admission_queued', self._queued)
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('ocr_prefetch_requests_total', 'OCR prefetch requests by outcome')
+metrics.describe('ocr_prefetch_lookups_total', 'Prefetched text lookups by the diagnostic pipeline')
+
+
+class OCRPrefetcher:
+    """
+    Background text extraction for freshly uploaded attachments.
+
+    Extractions run on a small thread pool and are cached by attachment, so a
+    later analysis of the same attachment starts from ready-made text. A
+    lookup while the extraction is still running waits for it (up to its
+    timeout) instead of starting a second one.
+    """
+
+    def __init__(self, extract: Callable[[str], Dict[str, Any]], max_workers: Optional[int] = None,
+                 max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None,
+                 key: Optional[Callable[[str], str]] = None):
+        """
+        Initialize the prefetcher
+
+        Args:
+            extract: Function extracting {'extractedText', 'ocrMetadata', 'contentHash'} from a URL
+            max_workers: Concurrent extractions (defaults to OCR_PREFETCH_WORKERS)
+            max_entries: Cached extractions kept, oldest dropped first (defaults to OCR_PREFETCH_MAX_ENTRIES)
+            ttl_seconds: Time an extraction stays cached (defaults to OCR_PREFETCH_TTL_SECONDS)
+            key: Maps an attachment URL to its cache key, e.g. relative and full URLs
+                of one upload to the same key (defaults to the URL itself)
+        """
+        self.extract = extract
+        self.key = key or (lambda attachment_url: attachment_url)
+        self.max_entries = max_entries or int(os.getenv('OCR_PREFETCH_MAX_ENTRIES', 64))
+        self.ttl_seconds = ttl_seconds or float(os.getenv('OCR_PREFETCH_TTL_SECONDS', 3600))
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv('OCR_PREFETCH_WORKERS', 2)),
+            thread_name_prefix='ocr-prefetch'
+        )
+        self._lock = threading.Lock()
+        # attachment key -> (submitted at, future)
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+
+    def submit(self, attachment_url: str) -> str:
+        """
+        Queue an extraction unless one is cached or already running
+
+        Returns:
+            'queued', 'pending', 'ready' or 'failed'
+        """
+        key = self.key(attachment_url)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None:
+                status = self._status(entry[1])
+                if status != 'failed':
+                    metrics.inc('ocr_prefetch_requests_total', outcome='duplicate')
+                    return status
+
+            future = self._executor.submit(self._run, attachment_url)
+            self._entries[key] = (time.time(), future)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                dropped.cancel()
+
+        metrics.inc('ocr_prefetch_requests_total', outcome='queued')
+        return 'queued'
+
+    def status(self, attachment_url: str) -> Optional[str]:
+        """Current status of an attachment's extraction, or None if it was never prefetched"""
+        key = self.key(attachment_url)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+        return self._status(entry[1]) if entry else None
+
+    def get(self, attachment_url: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Prefetched extraction of an attachment, waiting for it if still running
+
+        Args:
+            attachment_url: URL passed to submit, or another URL of the same attachment
+            timeout: Maximum seconds to wait for a running extraction
+
+        Returns:
+            The extraction, or None if it was not prefetched, failed or timed out
+        """
+        key = self.key(attachment_url)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+        if entry is None:
+            metrics.inc('ocr_prefetch_lookups_total', outcome='miss')
+            return None
+
+        try:
+            result = entry[1].result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning(f"Timed out waiting for prefetched text of {attachment_url}")
+            metrics.inc('ocr_prefetch_lookups_total', outcome='timeout')
+            return None
+        except Exception:
+            metrics.inc('ocr_prefetch_lookups_total', outcome='failed')
+            return None
+
+        metrics.inc('ocr_prefetch_lookups_total', outcome='hit')
+        return result
+
+    def _run(self, attachment_url: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = self.extract(attachment_url)
+        except Exception as e:
+            logger.error(f"Prefetch of {attachment_url} failed: {str(e)}")
+            raise
+        logger.info(f"Prefetched {len(result['extractedText'])} characters from {attachment_url} "
+                    f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return result
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        while self._entries:
+            key, (submitted_at, future) = next(iter(self._entries.items()))
+            if submitted_at >= cutoff or not future.done():
+                break
+            del self._entries[key]
+
+    @staticmethod
+    def _status(future: Future) -> str:
+        if not future.done():
+            return 'pending'
+        return 'failed' if future.cancelled() or future.exception() is not None else 'ready'
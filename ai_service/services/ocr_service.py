@@ -1,16 +1,61 @@
 import os
+import posixpath
+import re
+import mmap
 import tempfile
 import logging
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, BinaryIO, Callable, List, Optional, Tuple, Union
+from urllib.parse import unquote, urlsplit, urlunsplit
 import requests
 from PIL import Image
 import pytesseract
 import pdf2image
 from pypdf import PdfReader
+from pypdf.generic import ContentStream
+from .image_preprocessing import preprocess_page
+from .text_regions import detect_text_regions
+from concurrent.futures import ThreadPoolExecutor
 import io
 
 logger = logging.getLogger(__name__)
 
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']
+
+# Minimum characters of embedded text before a PDF is trusted without OCR
+MIN_TEXT_LAYER_CHARS = 100
+
+# Only the first pages of long PDFs are rasterized for OCR
+MAX_OCR_PAGES = 5
+
+# The fast OCR pass runs on pages scaled down to at most this width
+FAST_PASS_WIDTH = 1300
+
+# Padding in pixels around a low-confidence line cropped for the high-quality pass
+REFINE_PADDING = 6
+
+# Pages split into more text regions than this are OCRed whole
+MAX_TEXT_REGIONS = 40
+
+# Content stream operators allowed on a page that only draws one scanned image
+SCAN_PAGE_OPERATORS = {b'q', b'Q', b'cm', b'Do', b'gs'}
+
+# Root of the uploads directory shared with the Node server
+DEFAULT_UPLOADS_ROOT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'server', 'uploads'
+)
+
+# Document content: bytes, or a read-only memory map of a local file
+DocumentContent = Union[bytes, mmap.mmap]
+
+
+def _content_stream(file_content: DocumentContent) -> BinaryIO:
+    """File-like view of document content without copying a memory map"""
+    if isinstance(file_content, mmap.mmap):
+        file_content.seek(0)
+        return file_content
+    return io.BytesIO(file_content)
+
 class OCRService:
     def __init__(self):
         """Initialize OCR service with Tesseract configuration"""
@@ -20,6 +65,31 @@ class OCRService:
         # OCR configuration for better medical document processing
         self.tesseract_config = '--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,()/:- '
         
+        # Two-pass cascade: a fast LSTM-only pass over a downscaled page, then the
+        # full configuration on single low-confidence lines at full resolution
+        whitelist = self.tesseract_config.split(' -c ', 1)[1]
+        self.fast_tesseract_config = f'--oem 1 --psm 6 -c {whitelist}'
+        self.line_tesseract_config = f'--oem 3 --psm 7 -c {whitelist}'
+        self.cascade_enabled = os.getenv('OCR_CASCADE', 'True').lower() == 'true'
+        self.refine_confidence = float(os.getenv('OCR_REFINE_CONFIDENCE', 80))
+        
+        # NumPy page cleanup before Tesseract: 'otsu', 'adaptive' or 'none'
+        self.preprocess_method = os.getenv('OCR_PREPROCESS', 'otsu').lower()
+        
+        # OCR only detected text regions, several at a time
+        self.region_detection = os.getenv('OCR_REGION_DETECTION', 'True').lower() == 'true'
+        self.region_workers = int(os.getenv('OCR_REGION_WORKERS', min(4, os.cpu_count() or 1)))
+        self._region_executor: Optional[ThreadPoolExecutor] = None
+        if self.region_workers > 1:
+            # Parallelism comes from concurrent regions; keep each Tesseract process single-threaded
+            os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+        
+        # Tesseract runs at this lower scheduling priority so lightweight endpoints stay responsive
+        self.tesseract_nice = int(os.getenv('OCR_NICE', 10))
+        
+        # Local paths are only read from inside this directory
+        self.uploads_root = os.path.realpath(os.getenv('UPLOADS_ROOT', DEFAULT_UPLOADS_ROOT))
+        
     def extract_text_from_url(self, file_url: str) -> Dict[str, Any]:
         """
         Extract text from a file URL (supports PDF and images)
@@ -31,25 +101,12 @@ class OCRService:
             Dictionary with extracted text and metadata
         """
         try:
-            # Download the file
-            response = requests.get(file_url, timeout=30)
-            response.raise_for_status()
-            
-            # Determine file type from content-type or URL
-            content_type = response.headers.get('content-type', '').lower()
-            file_extension = os.path.splitext(file_url.lower())[1]
-            
-            file_content = response.content
-            file_size = len(file_content)
+            document = self.fetch_document(file_url)
             
             # Process based on file type
-            if 'pdf' in content_type or file_extension == '.pdf':
-                return self._extract_from_pdf(file_content, file_size)
-            elif any(img_type in content_type for img_type in ['image/', 'jpeg', 'png', 'jpg', 'tiff']) or \
-                 file_extension in ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']:
-                return self._extract_from_image(file_content, file_size)
-            else:
-                raise ValueError(f"Unsupported file type: {content_type} or {file_extension}")
+            if document['file_type'] == 'pdf':
+                return self._extract_from_pdf(document['content'], document['file_size'])
+            return self._extract_from_image(document['content'], document['file_size'])
                 
         except Exception as e:
             logger.error(f"Error extracting text from URL {file_url}: {str(e)}")
@@ -60,7 +117,168 @@ class OCRService:
                 'metadata': {}
             }
     
-    def _extract_from_pdf(self, file_content: bytes, file_size: int) -> Dict[str, Any]:
+    def fetch_document(self, file_url: str) -> Dict[str, Any]:
+        """
+        Download a document and determine its type
+        
+        Args:
+            file_url: URL of the file to download
+            
+        Returns:
+            Dictionary with the file content, size, content type and file type
+        """
+        response = requests.get(file_url, timeout=30)
+        response.raise_for_status()
+        
+        # Determine file type from content-type or URL
+        content_type = response.headers.get('content-type', '').lower()
+        file_content = response.content
+        
+        return {
+            'content': file_content,
+            'file_size': len(file_content),
+            'content_type': content_type,
+            'file_type': self.detect_file_type(file_url, content_type)
+        }
+    
+    def load_document(self, source: str) -> Dict[str, Any]:
+        """
+        Load a document from an http(s) URL or from a path under the uploads root
+        
+        Relative attachment URLs such as "/uploads/diagnostics/report.pdf", as
+        stored by the Node server, are read from the shared uploads directory
+        instead of being downloaded.
+        
+        Raises:
+            ValueError: If a local path is outside the uploads root or unsupported
+        """
+        if self.is_remote(source):
+            return self.fetch_document(source)
+        return self.open_local_document(self.resolve_upload_path(source))
+    
+    def is_remote(self, source: str) -> bool:
+        """Whether a document source is an http(s) URL"""
+        return source.lower().startswith(('http://', 'https://'))
+    
+    def document_key(self, source: str) -> str:
+        """
+        Canonical form of a document source, so one attachment matches however it is referenced
+        
+        Upload paths become their absolute path under the uploads root. URLs
+        under /uploads/ serve the same shared files and map to that path when
+        the file is present locally; other URLs are normalized. Invalid paths
+        are returned unchanged.
+        """
+        if self.is_remote(source):
+            parts = urlsplit(source)
+            path = posixpath.normpath(unquote(parts.path)) if parts.path else '/'
+            if path.startswith('/uploads/'):
+                local = self.document_key(path)
+                if os.path.isfile(local):
+                    return local
+            return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ''))
+        try:
+            return self.resolve_upload_path(source)
+        except ValueError:
+            return source
+    
+    def resolve_upload_path(self, path: str) -> str:
+        """
+        Resolve a path relative to the uploads root, rejecting anything outside it
+        
+        Accepts "diagnostics/x.pdf", "uploads/diagnostics/x.pdf" and
+        "/uploads/diagnostics/x.pdf", or an absolute path inside the root.
+        
+        Raises:
+            ValueError: If the path escapes the uploads root
+        """
+        candidate = path.replace('\\', '/')
+        if not os.path.isabs(candidate) or not candidate.startswith(self.uploads_root):
+            candidate = candidate.lstrip('/')
+            if candidate.startswith('uploads/'):
+                candidate = candidate[len('uploads/'):]
+            candidate = os.path.join(self.uploads_root, candidate)
+        
+        resolved = os.path.realpath(candidate)
+        if os.path.commonpath([resolved, self.uploads_root]) != self.uploads_root:
+            raise ValueError(f"Path is outside the uploads directory: {path}")
+        return resolved
+    
+    def open_local_document(self, file_path: str, file_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Open a local file as a read-only memory map instead of reading it into memory
+        
+        Args:
+            file_path: Path of the file
+            file_type: 'pdf' or 'image'; detected from the extension when omitted
+        
+        Returns:
+            Dictionary with the mapped content, size, content type, file type and path
+        
+        Raises:
+            FileNotFoundError: If the file does not exist
+            ValueError: If the file is empty or its type is not supported
+        """
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+        
+        file_type = file_type or self.detect_file_type(file_path)
+        file_size = os.path.getsize(file_path)
+        if file_size == 0:
+            raise ValueError(f"File is empty: {file_path}")
+        
+        with open(file_path, 'rb') as f:
+            # The mapping stays valid after the file object is closed
+            content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        return {
+            'content': content,
+            'file_size': file_size,
+            'content_type': '',
+            'file_type': file_type,
+            'path': file_path
+        }
+    
+    def open_upload(self, stream: BinaryIO, file_name: str, content_type: str = '') -> Dict[str, Any]:
+        """
+        Open a multipart upload, memory-mapping it when it was spooled to disk
+        
+        Args:
+            stream: Uploaded file stream
+            file_name: Client-side file name
+            content_type: Declared content type
+        """
+        file_type = self.detect_file_type(file_name, content_type or '')
+        spooled_path = getattr(stream, 'name', None)
+        if isinstance(spooled_path, str) and os.path.isfile(spooled_path):
+            document = self.open_local_document(spooled_path, file_type)
+        else:
+            stream.seek(0)
+            content = stream.read()
+            document = {'content': content, 'file_size': len(content), 'file_type': file_type}
+        
+        document['content_type'] = content_type or ''
+        return document
+    
+    def detect_file_type(self, file_name: str, content_type: str = '') -> str:
+        """
+        Classify a document as 'pdf' or 'image' from its content type or extension
+        
+        Raises:
+            ValueError: If the file type is not supported
+        """
+        file_extension = os.path.splitext(file_name.lower())[1]
+        content_type = content_type.lower()
+        
+        if 'pdf' in content_type or file_extension == '.pdf':
+            return 'pdf'
+        if any(img_type in content_type for img_type in ['image/', 'jpeg', 'png', 'jpg', 'tiff']) or \
+           file_extension in IMAGE_EXTENSIONS:
+            return 'image'
+        raise ValueError(f"Unsupported file type: {content_type} or {file_extension}")
+    
+    def _extract_from_pdf(self, file_content: DocumentContent, file_size: int,
+                          file_path: Optional[str] = None) -> Dict[str, Any]:
         """Extract text from PDF using PyPDF2 and OCR fallback"""
         try:
             extracted_text = ""
@@ -73,28 +291,21 @@ class OCRService:
             
             # First try to extract text directly from PDF
             try:
-                pdf_reader = PdfReader(io.BytesIO(file_content))
-                direct_text = ""
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    page_text = page.extract_text()
-                    if page_text.strip():
-                        direct_text += f"\n--- Page {page_num + 1} ---\n{page_text}"
-                
-                metadata['pages_processed'] = len(pdf_reader.pages)
+                direct_text, page_count = self.extract_pdf_text_layer(file_content)
+                metadata['pages_processed'] = page_count
                 
                 # If we got reasonable text directly, use it
-                if len(direct_text.strip()) > 100:  # Arbitrary threshold
+                if self.has_usable_text_layer(direct_text):
                     extracted_text = direct_text
                     metadata['extraction_method'] = 'direct'
                 else:
                     # Fall back to OCR if direct extraction didn't yield much text
-                    extracted_text = self._ocr_pdf_pages(file_content)
+                    extracted_text = self._ocr_pdf_pages(file_content, file_path)
                     metadata['extraction_method'] = 'ocr'
                     
             except Exception as e:
                 logger.warning(f"Direct PDF text extraction failed, using OCR: {str(e)}")
-                extracted_text = self._ocr_pdf_pages(file_content)
+                extracted_text = self._ocr_pdf_pages(file_content, file_path)
                 metadata['extraction_method'] = 'ocr'
             
             return {
@@ -112,47 +323,436 @@ class OCRService:
                 'metadata': {'file_type': 'pdf', 'file_size': file_size}
             }
     
-    def _ocr_pdf_pages(self, file_content: bytes) -> str:
-        """Convert PDF pages to images and run OCR"""
+    def extract_pdf_text_layer(self, file_content: DocumentContent) -> Tuple[str, int]:
+        """
+        Extract the embedded text layer of a PDF
+        
+        Returns:
+            Tuple of (text with page markers, number of pages)
+        """
+        pdf_reader = PdfReader(_content_stream(file_content))
+        direct_text = ""
+        
+        for page_num, page in enumerate(pdf_reader.pages):
+            page_text = page.extract_text()
+            if page_text.strip():
+                direct_text += f"\n--- Page {page_num + 1} ---\n{page_text}"
+        
+        return direct_text, len(pdf_reader.pages)
+    
+    def has_usable_text_layer(self, direct_text: str) -> bool:
+        """Whether an extracted text layer holds enough text to skip OCR"""
+        return len(direct_text.strip()) > MIN_TEXT_LAYER_CHARS
+    
+    def rasterize_pdf(self, file_content: DocumentContent, file_path: Optional[str] = None) -> List[Image.Image]:
+        """Render the first PDF pages to images for OCR, straight from file_path when it is on disk"""
+        return self._rasterize_page_range(file_content, file_path, 1, MAX_OCR_PAGES)
+    
+    def load_pdf_pages(self, file_content: DocumentContent,
+                       file_path: Optional[str] = None) -> Tuple[List[Image.Image], Dict[str, int]]:
+        """
+        Page images of the first PDF pages for OCR
+        
+        Pages that only draw a single embedded scan use that image at its native
+        resolution (JPEG streams are decoded directly, never re-encoded); only
+        pages with mixed content are rasterized.
+        
+        Returns:
+            Tuple of (page images in page order, {'embedded': n, 'rasterized': n})
+        """
+        pdf_reader = PdfReader(_content_stream(file_content))
+        page_count = min(len(pdf_reader.pages), MAX_OCR_PAGES)
+        images: List[Optional[Image.Image]] = [
+            self.extract_scan_image(pdf_reader, pdf_reader.pages[index]) for index in range(page_count)
+        ]
+        
+        stats = {'embedded': sum(image is not None for image in images), 'rasterized': 0}
+        missing = [index for index, image in enumerate(images) if image is None]
+        if missing:
+            # Rasterize the mixed-content pages, one call per contiguous run
+            runs = []
+            for index in missing:
+                if runs and runs[-1][1] == index - 1:
+                    runs[-1][1] = index
+                else:
+                    runs.append([index, index])
+            for first, last in runs:
+                rendered = self._rasterize_page_range(file_content, file_path, first + 1, last + 1)
+                images[first:last + 1] = rendered
+                stats['rasterized'] += len(rendered)
+        
+        return [image for image in images if image is not None], stats
+    
+    def extract_scan_image(self, pdf_reader: PdfReader, page) -> Optional[Image.Image]:
+        """
+        The embedded image of a page that draws nothing but one upright image
+        
+        Returns:
+            The image, rotated like the page and prepared for OCR, or None if
+            the page has text, vector content or several images
+        """
         try:
-            # Convert PDF to images
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
-                temp_pdf.write(file_content)
-                temp_pdf_path = temp_pdf.name
+            operations = ContentStream(page.get_contents(), pdf_reader).operations
+            if any(operator not in SCAN_PAGE_OPERATORS for _, operator in operations):
+                return None
             
-            try:
-                # Convert PDF pages to images
-                images = pdf2image.convert_from_path(temp_pdf_path, dpi=300, first_page=1, last_page=5)  # Limit to first 5 pages
-                
-                extracted_text = ""
-                for page_num, image in enumerate(images):
-                    # Run OCR on each page
-                    page_text = pytesseract.image_to_string(image, config=self.tesseract_config)
-                    if page_text.strip():
-                        extracted_text += f"\n--- Page {page_num + 1} ---\n{page_text}"
-                
-                return extracted_text
-                
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_pdf_path):
-                    os.unlink(temp_pdf_path)
-                    
+            drawn = [operands[0] for operands, operator in operations if operator == b'Do']
+            if len(drawn) != 1:
+                return None
+            
+            # Rotated or mirrored placements are left to the rasterizer
+            for operands, operator in operations:
+                if operator == b'cm' and (operands[1] != 0 or operands[2] != 0 or
+                                          operands[0] <= 0 or operands[3] <= 0):
+                    return None
+            
+            xobject = page['/Resources']['/XObject'][drawn[0]].get_object()
+            if xobject.get('/Subtype') != '/Image':
+                return None
+            
+            image = page.images[drawn[0]].image
+            if page.rotation:
+                image = image.rotate(-page.rotation, expand=True)
+            return self._enhance_image_for_ocr(image)
+            
+        except Exception as e:
+            # Unsupported encodings (e.g. JBIG2) fall back to rasterizing the page
+            logger.debug(f"Embedded image extraction failed, rasterizing page: {str(e)}")
+            return None
+    
+    def _rasterize_page_range(self, file_content: DocumentContent, file_path: Optional[str],
+                              first_page: int, last_page: int) -> List[Image.Image]:
+        """Render a range of PDF pages (1-based, inclusive) at 300 DPI"""
+        if file_path:
+            return pdf2image.convert_from_path(file_path, dpi=300, first_page=first_page, last_page=last_page)
+        
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
+            temp_pdf.write(file_content)
+            temp_pdf_path = temp_pdf.name
+        
+        try:
+            return pdf2image.convert_from_path(temp_pdf_path, dpi=300, first_page=first_page, last_page=last_page)
+        finally:
+            # Clean up temporary file
+            if os.path.exists(temp_pdf_path):
+                os.unlink(temp_pdf_path)
+    
+    def load_image(self, file_content: DocumentContent) -> Image.Image:
+        """Open an image document and enhance it for OCR"""
+        image = Image.open(_content_stream(file_content))
+        return self._enhance_image_for_ocr(image)
+    
+    def ocr_page(self, image: Image.Image, stats: Optional[Dict[str, Any]] = None,
+                 preprocess: bool = True, words: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        Run OCR on a single page image
+        
+        Args:
+            image: Page image
+            stats: Dictionary accumulating per-pass statistics of the cascade (optional)
+            preprocess: False if the image already went through preprocess_image
+            words: List receiving the recognized words with their boxes on the
+                preprocessed page (optional)
+        """
+        stats = stats if stats is not None else {}
+        if preprocess and self.preprocess_method != 'none':
+            image = self.preprocess_image(image, stats)
+        
+        regions = self.find_text_regions(image, stats) if self.region_detection else None
+        if regions is None:
+            text = self._ocr_block(image, stats, words)
+        else:
+            text = self._ocr_regions(image, regions, stats, words)
+        
+        stats['pages'] = stats.get('pages', 0) + 1
+        return text
+    
+    def ocr_pages(self, images: List[Image.Image], stats: Optional[Dict[str, Any]] = None,
+                  preprocess: bool = True, words: Optional[List[List[Dict[str, Any]]]] = None) -> str:
+        """
+        Run OCR on rendered PDF pages, joining them with page markers
+        
+        Args:
+            images: Page images
+            stats: Dictionary accumulating per-pass statistics of the cascade (optional)
+            preprocess: False if the images already went through preprocess_image
+            words: List receiving one list of recognized words per page (optional)
+        """
+        extracted_text = ""
+        for page_num, image in enumerate(images):
+            page_words = [] if words is not None else None
+            page_text = self.ocr_page(image, stats, preprocess, page_words)
+            if words is not None:
+                words.append(page_words)
+            if page_text.strip():
+                extracted_text += f"\n--- Page {page_num + 1} ---\n{page_text}"
+        return extracted_text
+    
+    def read_boxes(self, image: Image.Image, boxes: List[Tuple[int, int, int, int]],
+                   single_line: bool = True) -> List[Tuple[str, float]]:
+        """
+        OCR small areas of a page in parallel
+        
+        Args:
+            image: Preprocessed page image
+            boxes: Areas (left, top, right, bottom) to read
+            single_line: Read each area as one text line rather than a block
+            
+        Returns:
+            (text, mean word confidence) of each area, one line of text per
+            recognized line; confidence is 0 when nothing was read
+        """
+        config = self.line_tesseract_config if single_line else self.fast_tesseract_config
+        
+        def read(box):
+            data = pytesseract.image_to_data(image.crop(box), config=config, nice=self.tesseract_nice,
+                                             output_type=pytesseract.Output.DICT)
+            words = self._word_boxes(data, 1.0)
+            if not words:
+                return '', 0.0
+            lines: Dict[Tuple[int, int, int], List[str]] = {}
+            for word in words:
+                lines.setdefault(word['line'], []).append(word['text'])
+            return ('\n'.join(' '.join(line) for line in lines.values()),
+                    sum(word['confidence'] for word in words) / len(words))
+        
+        return self._map(read, boxes)
+    
+    def preprocess_image(self, image: Image.Image, stats: Optional[Dict[str, Any]] = None) -> Image.Image:
+        """Deskew, binarize, crop and denoise a page, falling back to the original on failure"""
+        started = time.perf_counter()
+        page_stats: Dict[str, Any] = {}
+        try:
+            image = preprocess_page(image, self.preprocess_method, page_stats)
+        except Exception as e:
+            logger.warning(f"Image preprocessing failed, using original: {str(e)}")
+        if stats is not None:
+            stats['preprocess_ms'] = round(stats.get('preprocess_ms', 0.0) + (time.perf_counter() - started) * 1000, 2)
+            if 'skew_degrees' in page_stats:
+                stats.setdefault('skew_degrees', []).append(page_stats['skew_degrees'])
+        return image
+    
+    def find_text_regions(self, image: Image.Image, stats: Dict[str, Any]) -> Optional[List[Tuple[int, int, int, int]]]:
+        """
+        Text regions of a page, or None if the whole page should be OCRed
+        
+        Pages where detection fails or finds no or too many regions fall back
+        to whole-page OCR.
+        """
+        try:
+            regions = detect_text_regions(image)
+        except Exception as e:
+            logger.warning(f"Text region detection failed, using the whole page: {str(e)}")
+            return None
+        if not regions or len(regions) > MAX_TEXT_REGIONS:
+            return None
+        
+        page_pixels = image.size[0] * image.size[1]
+        region_pixels = sum((right - left) * (bottom - top) for left, top, right, bottom in regions)
+        stats['regions'] = stats.get('regions', 0) + len(regions)
+        stats['page_pixels'] = stats.get('page_pixels', 0) + page_pixels
+        stats['region_pixels'] = stats.get('region_pixels', 0) + region_pixels
+        stats['region_area_fraction'] = round(stats['region_pixels'] / stats['page_pixels'], 3)
+        return regions
+    
+    def _ocr_regions(self, image: Image.Image, regions: List[Tuple[int, int, int, int]],
+                     stats: Dict[str, Any], words: Optional[List[Dict[str, Any]]] = None) -> str:
+        """OCR text regions in parallel and join them in reading order"""
+        crops = [image.crop(region) for region in regions]
+        region_stats: List[Dict[str, Any]] = [{} for _ in crops]
+        region_words = [[] if words is not None else None for _ in crops]
+        texts = self._map(self._ocr_block, crops, region_stats, region_words)
+        
+        for part in region_stats:
+            self._merge_pass_stats(stats, part)
+        if words is not None:
+            # Move word boxes from region to page coordinates
+            for index, ((left, top, _, _), found) in enumerate(zip(regions, region_words)):
+                for word in found:
+                    word_left, word_top, word_right, word_bottom = word['box']
+                    word['box'] = (word_left + left, word_top + top, word_right + left, word_bottom + top)
+                    word['line'] = (index,) + word['line']
+                    words.append(word)
+        return '\n\n'.join(text.strip() for text in texts if text.strip())
+    
+    def _map(self, function: Callable[..., Any], *iterables) -> List[Any]:
+        """Map a function over page areas on the region thread pool"""
+        items = list(zip(*iterables))
+        if self.region_workers <= 1 or len(items) <= 1:
+            return [function(*item) for item in items]
+        if self._region_executor is None:
+            self._region_executor = ThreadPoolExecutor(max_workers=self.region_workers,
+                                                       thread_name_prefix='ocr-region')
+        return list(self._region_executor.map(lambda item: function(*item), items))
+    
+    def _ocr_block(self, image: Image.Image, stats: Dict[str, Any],
+                   words: Optional[List[Dict[str, Any]]] = None) -> str:
+        """OCR a page or region with the cascade or the single full-quality pass"""
+        if self.cascade_enabled:
+            return self._cascade_ocr(image, stats, words)
+        if words is None:
+            return pytesseract.image_to_string(image, config=self.tesseract_config, nice=self.tesseract_nice)
+        data = pytesseract.image_to_data(image, config=self.tesseract_config, nice=self.tesseract_nice,
+                                         output_type=pytesseract.Output.DICT)
+        words.extend(self._word_boxes(data, 1.0))
+        return self._join_lines(self._group_lines(data, 1.0))
+    
+    def _cascade_ocr(self, image: Image.Image, stats: Dict[str, Any],
+                     words: Optional[List[Dict[str, Any]]] = None) -> str:
+        """
+        Fast pass over the whole page, then high-quality re-OCR of low-confidence lines
+        
+        Lines are stitched back in Tesseract's reading order, with a blank line
+        between text blocks.
+        """
+        started = time.perf_counter()
+        width, height = image.size
+        scale = min(1.0, FAST_PASS_WIDTH / width)
+        fast_image = image if scale == 1.0 else \
+            image.resize((round(width * scale), round(height * scale)), Image.Resampling.BILINEAR)
+        
+        data = pytesseract.image_to_data(fast_image, config=self.fast_tesseract_config, nice=self.tesseract_nice,
+                                         output_type=pytesseract.Output.DICT)
+        lines = self._group_lines(data, scale)
+        if words is not None:
+            words.extend(self._word_boxes(data, scale))
+        fast_ms = (time.perf_counter() - started) * 1000
+        
+        started = time.perf_counter()
+        low_confidence = [line for line in lines if line['confidence'] < self.refine_confidence]
+        improved = 0
+        for line in low_confidence:
+            left, top, right, bottom = line['box']
+            crop = image.crop((max(0, left - REFINE_PADDING), max(0, top - REFINE_PADDING),
+                               min(width, right + REFINE_PADDING), min(height, bottom + REFINE_PADDING)))
+            refined = self._group_lines(
+                pytesseract.image_to_data(crop, config=self.line_tesseract_config, nice=self.tesseract_nice,
+                                          output_type=pytesseract.Output.DICT), 1.0
+            )
+            if not refined:
+                continue
+            text = ' '.join(part['text'] for part in refined)
+            confidence = sum(part['confidence'] for part in refined) / len(refined)
+            if confidence > line['confidence']:
+                line['text'], line['confidence'] = text, confidence
+                improved += 1
+        refine_ms = (time.perf_counter() - started) * 1000
+        
+        words = sum(line['words'] for line in lines)
+        self._merge_pass_stats(stats, {
+            'words': words,
+            'mean_confidence': sum(line['confidence'] * line['words'] for line in lines) / words if words else 0.0,
+            'lines': len(lines),
+            'low_confidence_lines': len(low_confidence),
+            'improved_lines': improved,
+            'fast_pass_ms': fast_ms,
+            'refine_pass_ms': refine_ms
+        })
+        
+        return self._join_lines(lines)
+    
+    @staticmethod
+    def _join_lines(lines: List[Dict[str, Any]]) -> str:
+        """Stitch lines back together with a blank line between text blocks"""
+        parts = []
+        previous_block = None
+        for line in lines:
+            if previous_block is not None and line['block'] != previous_block:
+                parts.append('')
+            parts.append(line['text'])
+            previous_block = line['block']
+        return '\n'.join(parts)
+    
+    @staticmethod
+    def _word_boxes(data: Dict[str, List[Any]], scale: float) -> List[Dict[str, Any]]:
+        """
+        Recognized words of Tesseract output
+        
+        Returns:
+            Words with text, confidence, (block, paragraph, line) key and
+            bounding box scaled back to the full-resolution image
+        """
+        words = []
+        for index, word in enumerate(data['text']):
+            confidence = float(data['conf'][index])
+            if confidence < 0 or not str(word).strip():
+                continue
+            left, top = data['left'][index], data['top'][index]
+            box = (left, top, left + data['width'][index], top + data['height'][index])
+            words.append({
+                'text': str(word).strip(),
+                'confidence': confidence,
+                'line': (data['block_num'][index], data['par_num'][index], data['line_num'][index]),
+                'box': tuple(int(round(coordinate / scale)) for coordinate in box)
+            })
+        return words
+    
+    @staticmethod
+    def _group_lines(data: Dict[str, List[Any]], scale: float) -> List[Dict[str, Any]]:
+        """
+        Group Tesseract word boxes into lines
+        
+        Returns:
+            Lines in reading order with text, mean word confidence, block number
+            and bounding box scaled back to the full-resolution page
+        """
+        lines: Dict[Tuple[int, int, int], Dict[str, Any]] = {}
+        for index, word in enumerate(data['text']):
+            confidence = float(data['conf'][index])
+            if confidence < 0 or not str(word).strip():
+                continue
+            key = (data['block_num'][index], data['par_num'][index], data['line_num'][index])
+            left, top = data['left'][index], data['top'][index]
+            right, bottom = left + data['width'][index], top + data['height'][index]
+            line = lines.get(key)
+            if line is None:
+                lines[key] = {'words': [str(word).strip()], 'confidences': [confidence],
+                              'block': key[0], 'box': [left, top, right, bottom]}
+            else:
+                line['words'].append(str(word).strip())
+                line['confidences'].append(confidence)
+                box = line['box']
+                box[0], box[1] = min(box[0], left), min(box[1], top)
+                box[2], box[3] = max(box[2], right), max(box[3], bottom)
+        
+        return [{
+            'text': ' '.join(line['words']),
+            'confidence': sum(line['confidences']) / len(line['confidences']),
+            'words': len(line['words']),
+            'block': line['block'],
+            'box': tuple(int(round(coordinate / scale)) for coordinate in line['box'])
+        } for line in lines.values()]
+    
+    @staticmethod
+    def _merge_pass_stats(stats: Dict[str, Any], part: Dict[str, Any]) -> None:
+        """Add one block's cascade statistics to the running totals"""
+        words = stats.get('words', 0) + part.get('words', 0)
+        if words:
+            stats['mean_confidence'] = round(
+                (stats.get('mean_confidence', 0.0) * stats.get('words', 0) +
+                 part.get('mean_confidence', 0.0) * part.get('words', 0)) / words, 2)
+        for key, value in part.items():
+            if key != 'mean_confidence':
+                stats[key] = round(stats.get(key, 0) + value, 2)
+    
+    def _ocr_pdf_pages(self, file_content: DocumentContent, file_path: Optional[str] = None) -> str:
+        """Convert PDF pages to images and run OCR"""
+        try:
+            images, _ = self.load_pdf_pages(file_content, file_path)
+            return self.ocr_pages(images)
         except Exception as e:
             logger.error(f"Error in OCR PDF processing: {str(e)}")
             return f"OCR processing failed: {str(e)}"
     
-    def _extract_from_image(self, file_content: bytes, file_size: int) -> Dict[str, Any]:
+    def _extract_from_image(self, file_content: DocumentContent, file_size: int) -> Dict[str, Any]:
         """Extract text from image using OCR"""
         try:
-            # Open image from bytes
-            image = Image.open(io.BytesIO(file_content))
-            
-            # Enhance image for better OCR results
-            image = self._enhance_image_for_ocr(image)
+            # Open image from bytes, enhanced for better OCR results
+            image = self.load_image(file_content)
             
             # Run OCR
-            extracted_text = pytesseract.image_to_string(image, config=self.tesseract_config)
+            ocr_passes: Dict[str, Any] = {}
+            extracted_text = self.ocr_page(image, ocr_passes)
             
             metadata = {
                 'file_type': 'image',
@@ -160,6 +760,8 @@ class OCRService:
                 'image_dimensions': image.size,
                 'extraction_method': 'ocr'
             }
+            if ocr_passes:
+                metadata['ocr_passes'] = ocr_passes
             
             return {
                 'success': True,
@@ -207,21 +809,15 @@ class OCRService:
             Dictionary with extracted text and metadata
         """
         try:
-            if not os.path.exists(file_path):
-                raise FileNotFoundError(f"File not found: {file_path}")
+            document = self.open_local_document(file_path)
             
-            file_size = os.path.getsize(file_path)
-            file_extension = os.path.splitext(file_path.lower())[1]
-            
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-            
-            if file_extension == '.pdf':
-                return self._extract_from_pdf(file_content, file_size)
-            elif file_extension in ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']:
-                return self._extract_from_image(file_content, file_size)
-            else:
-                raise ValueError(f"Unsupported file extension: {file_extension}")
+            # Memory-mapped, so large PDFs are paged in on demand rather than copied
+            try:
+                if document['file_type'] == 'pdf':
+                    return self._extract_from_pdf(document['content'], document['file_size'], file_path)
+                return self._extract_from_image(document['content'], document['file_size'])
+            finally:
+                document['content'].close()
                 
         except Exception as e:
             logger.error(f"Error extracting text from file {file_path}: {str(e)}")
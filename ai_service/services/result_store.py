@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'data', 'diagnostic_results.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diagnostic_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    test_result_id TEXT NOT NULL,
+    attachment_url TEXT,
+    input_hash TEXT NOT NULL,
+    content_hash TEXT,
+    created_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_diagnostic_results_test_result
+    ON diagnostic_results (test_result_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_diagnostic_results_content
+    ON diagnostic_results (content_hash, input_hash);
+CREATE INDEX IF NOT EXISTS idx_diagnostic_results_created_at
+    ON diagnostic_results (created_at);
+"""
+
+
+def input_hash(test_type: Optional[str], findings: str) -> str:
+    """Hash of the request inputs, other than the document, that shape an analysis"""
+    return hashlib.sha256(json.dumps([test_type or '', findings or '']).encode('utf-8')).hexdigest()
+
+
+def content_hash(content: bytes) -> str:
+    """Hash of a fetched document's bytes"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class DiagnosticResultStore:
+    """
+    SQLite store of completed diagnostic analyses.
+
+    Results are looked up by test result (same attachment and inputs) or, once
+    the document has been fetched, by its content hash so a re-uploaded file is
+    not analyzed twice. Rows older than ``max_age_days`` or beyond ``max_rows``
+    are evicted, oldest first.
+    """
+
+    EVICT_INTERVAL_SECONDS = 60
+
+    def __init__(self, db_path: Optional[str] = None, max_age_days: Optional[float] = None,
+                 max_rows: Optional[int] = None):
+        """
+        Initialize the store, creating the database if needed
+
+        Args:
+            db_path: SQLite file path (defaults to RESULT_STORE_PATH or ai_service/data)
+            max_age_days: Age after which results are evicted (defaults to RESULT_STORE_MAX_AGE_DAYS)
+            max_rows: Maximum number of stored results (defaults to RESULT_STORE_MAX_ROWS)
+        """
+        self.db_path = db_path or os.getenv('RESULT_STORE_PATH', DEFAULT_DB_PATH)
+        self.max_age_days = max_age_days if max_age_days is not None else \
+            float(os.getenv('RESULT_STORE_MAX_AGE_DAYS', 30))
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv('RESULT_STORE_MAX_ROWS', 10000))
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def find_by_test_result(self, test_result_id: str, attachment_url: Optional[str],
+                            inputs_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Latest unexpired result for a test result analyzed with the same attachment and inputs
+
+        Returns:
+            Stored record or None
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT * FROM diagnostic_results '
+                'WHERE test_result_id = ? AND attachment_url IS ? AND input_hash = ? AND created_at >= ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (test_result_id, attachment_url, inputs_hash, self._cutoff())
+            ).fetchone()
+        return self._to_record(row)
+
+    def find_by_content(self, document_hash: str, inputs_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Latest unexpired result for an identical document analyzed with the same inputs
+
+        Returns:
+            Stored record or None
+        """
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT * FROM diagnostic_results '
+                'WHERE content_hash = ? AND input_hash = ? AND created_at >= ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (document_hash, inputs_hash, self._cutoff())
+            ).fetchone()
+        return self._to_record(row)
+
+    def save(self, test_result_id: str, attachment_url: Optional[str], inputs_hash: str,
+             document_hash: Optional[str], payload: Dict[str, Any]) -> None:
+        """Store a completed analysis and evict old results if due"""
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO diagnostic_results '
+                '(test_result_id, attachment_url, input_hash, content_hash, created_at, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (test_result_id, attachment_url, inputs_hash, document_hash, time.time(),
+                 json.dumps(payload, default=str))
+            )
+
+        with self._lock:
+            due = time.time() - self._last_eviction >= self.EVICT_INTERVAL_SECONDS
+            if due:
+                self._last_eviction = time.time()
+        if due:
+            self.evict()
+
+    def list_results(self, start: Optional[float] = None, end: Optional[float] = None,
+                     limit: int = 100, include_payload: bool = False) -> List[Dict[str, Any]]:
+        """
+        Stored results created in a time range, newest first
+
+        Args:
+            start: Earliest creation time as a Unix timestamp (optional)
+            end: Latest creation time as a Unix timestamp (optional)
+            limit: Maximum number of results
+            include_payload: Include the stored analysis of each result
+
+        Returns:
+            List of stored records
+        """
+        columns = '*' if include_payload else \
+            'id, test_result_id, attachment_url, input_hash, content_hash, created_at'
+        with self._connect() as connection:
+            rows = connection.execute(
+                f'SELECT {columns} FROM diagnostic_results '
+                'WHERE created_at >= ? AND created_at <= ? '
+                'ORDER BY created_at DESC LIMIT ?',
+                (start if start is not None else 0, end if end is not None else time.time(), limit)
+            ).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def delete_test_result(self, test_result_id: str) -> int:
+        """Delete every stored result of a test result and return the count removed"""
+        with self._connect() as connection:
+            return connection.execute(
+                'DELETE FROM diagnostic_results WHERE test_result_id = ?', (test_result_id,)
+            ).rowcount
+
+    def evict(self) -> int:
+        """
+        Remove results older than the maximum age and the oldest results beyond the row limit
+
+        Returns:
+            Number of results removed
+        """
+        with self._connect() as connection:
+            removed = connection.execute(
+                'DELETE FROM diagnostic_results WHERE created_at < ?', (self._cutoff(),)
+            ).rowcount
+            removed += connection.execute(
+                'DELETE FROM diagnostic_results WHERE id IN ('
+                'SELECT id FROM diagnostic_results ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_rows,)
+            ).rowcount
+        if removed:
+            logger.info(f"Evicted {removed} stored diagnostic results")
+        return removed
+
+    def _cutoff(self) -> float:
+        """Creation time before which results are expired, whether or not evicted yet"""
+        return time.time() - self.max_age_days * 86400
+
+    @staticmethod
+    def _to_record(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        record = {
+            'id': row['id'],
+            'testResultId': row['test_result_id'],
+            'attachmentUrl': row['attachment_url'],
+            'inputHash': row['input_hash'],
+            'contentHash': row['content_hash'],
+            'createdAt': row['created_at']
+        }
+        if 'payload' in row.keys():
+            record['payload'] = json.loads(row['payload'])
+        return record
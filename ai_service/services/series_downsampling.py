@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling
+
+    Keeps the first and last points and, from each of threshold - 2 equal
+    buckets in between, the point forming the largest triangle with the point
+    kept from the previous bucket and the average of the next bucket. The
+    loop runs once per bucket and each bucket is scored with array
+    operations, so long series cost little more than a pass over the data.
+
+    Args:
+        x: Ascending x coordinates (e.g. days)
+        y: Values at x
+        threshold: Number of points to keep
+
+    Returns:
+        Ascending indices of the kept points
+    """
+    count = len(x)
+    if threshold >= count or count < 3:
+        return np.arange(count)
+    if threshold < 3:
+        return np.array([0, count - 1])
+
+    # Bucket edges over the interior points; each bucket holds at least one point
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    sums_x = np.concatenate(([0.0], np.cumsum(x)))
+    sums_y = np.concatenate(([0.0], np.cumsum(y)))
+    sizes = np.diff(edges)
+    average_x = (sums_x[edges[1:]] - sums_x[edges[:-1]]) / sizes
+    average_y = (sums_y[edges[1:]] - sums_y[edges[:-1]]) / sizes
+    # The third vertex for each bucket is the next bucket's average, then the last point
+    next_x = np.append(average_x[1:], x[-1])
+    next_y = np.append(average_y[1:], y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, count - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Twice the triangle area, up to sign
+        areas = np.abs((x[previous] - next_x[bucket]) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y[bucket] - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
@@ -0,0 +1,444 @@
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+_WHITESPACE = ' \t\r\n'
+_STRING_SPECIAL = re.compile(r'["\\]')
+_SCALAR_CHARS = re.compile(r'[A-Za-z0-9.+\-]*')
+_START_KINDS = {'{': 'object', '[': 'array', '"': 'string', 't': 'boolean', 'f': 'boolean', 'n': 'null'}
+
+Path = Tuple[Any, ...]
+
+
+class MalformedJSONError(ValueError):
+    """Raised as soon as a (possibly partial) response can no longer be valid output"""
+
+    def __init__(self, message: str, position: Optional[int] = None, document: str = ''):
+        super().__init__(message)
+        self.position = position
+        self.document = document
+
+
+class _Frame:
+    __slots__ = ('kind', 'path', 'schema', 'start', 'key', 'keys', 'index', 'empty')
+
+    def __init__(self, kind: str, path: Path, schema: Optional[Dict[str, Any]], start: int):
+        self.kind = kind
+        self.path = path
+        self.schema = schema
+        self.start = start
+        self.key = None
+        self.keys = set()
+        self.index = 0
+        self.empty = True
+
+
+class IncrementalJSONParser:
+    """
+    Incremental JSON parser for streamed LLM responses.
+
+    Tokens are fed as they arrive. The document is checked against a small
+    JSON-Schema subset (type, properties, items, required, anyOf/oneOf and
+    local $ref) while it is being generated, so a malformed generation raises
+    MalformedJSONError at the first bad token instead of after the whole body.
+    Values that complete directly under one of ``item_paths`` (for example
+    every element of ``structuredData.testValues``) are surfaced immediately.
+    Text before the first JSON opener (markdown fences, chatter) and after the
+    end of the document is ignored.
+    """
+
+    def __init__(self, schema: Optional[Dict[str, Any]] = None,
+                 item_paths: Iterable[Path] = (),
+                 on_item: Optional[Callable[[Path, Any], None]] = None,
+                 max_preamble: Optional[int] = 2000,
+                 max_length: int = 500000,
+                 coerce_scalars: bool = False):
+        """
+        Args:
+            schema: Expected JSON schema of the document (optional)
+            item_paths: Paths whose direct children are surfaced once complete;
+                use '*' to match any key or array index
+            on_item: Callback invoked with (path, value) for each surfaced child
+            max_preamble: Characters tolerated before the document starts
+                (None for no limit)
+            max_length: Upper bound on the response size
+            coerce_scalars: Only abort on structural mismatches, leaving scalar
+                type differences (e.g. a number where a string is expected) to a
+                validator that coerces them
+        """
+        self.schema = schema or None
+        self.item_paths = [tuple(p) for p in item_paths]
+        self.on_item = on_item
+        self.max_preamble = max_preamble
+        self.max_length = max_length
+        self.coerce_scalars = coerce_scalars
+
+        root_type = (self._resolve(self.schema) or {}).get('type')
+        if root_type == 'object':
+            self._openers = '{'
+        elif root_type == 'array':
+            self._openers = '['
+        else:
+            self._openers = '{['
+
+        self._buf = ''
+        self._pos = 0
+        self._state = 'preamble'
+        self._stack: List[_Frame] = []
+        self._value_start = 0
+        self._value_path: Path = ()
+        self._string_is_key = False
+        self._emitted: List[Tuple[Path, Any]] = []
+        self._document_span = None
+        self._result = None
+        self._decoded = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the top-level document has been completed"""
+        return self._state == 'done'
+
+    @property
+    def text(self) -> str:
+        """Raw text received so far"""
+        return self._buf
+
+    @property
+    def document(self) -> Optional[str]:
+        """Raw JSON text of the completed document, without surrounding chatter"""
+        if self._document_span is None:
+            return None
+        start, end = self._document_span
+        return self._buf[start:end]
+
+    def feed(self, chunk: str) -> List[Tuple[Path, Any]]:
+        """
+        Consume the next chunk of the response
+
+        Args:
+            chunk: Next piece of streamed text
+
+        Returns:
+            List of (path, value) pairs completed by this chunk
+        """
+        if not chunk or self._state in ('done', 'failed'):
+            return []
+
+        self._buf += chunk
+        if len(self._buf) > self.max_length:
+            self._abort(f"Response exceeded {self.max_length} characters", len(self._buf))
+
+        self._emitted = []
+        buf = self._buf
+        n = len(buf)
+        i = self._pos
+
+        while i < n:
+            state = self._state
+
+            if state == 'string':
+                match = _STRING_SPECIAL.search(buf, i)
+                if not match:
+                    i = n
+                    break
+                j = match.start()
+                if buf[j] == '\\':
+                    if j + 1 >= n:
+                        # Escape sequence split across chunks
+                        i = j
+                        break
+                    i = j + 2
+                    continue
+                self._finish_string(j + 1)
+                i = j + 1
+                continue
+
+            if state == 'scalar':
+                j = _SCALAR_CHARS.match(buf, i).end()
+                if j >= n:
+                    # Numbers and literals may continue in the next chunk
+                    i = n
+                    break
+                self._finish_scalar(j)
+                i = j
+                continue
+
+            if state == 'done':
+                break
+
+            char = buf[i]
+            if char in _WHITESPACE:
+                i += 1
+                continue
+
+            if state == 'preamble':
+                if char in self._openers:
+                    i = self._start_value(char, i)
+                    continue
+                if self.max_preamble is not None and i >= self.max_preamble:
+                    self._abort("No JSON document found in response", i)
+                i += 1
+                continue
+
+            frame = self._stack[-1]
+
+            if state == 'value':
+                if char == ']' and frame.kind == 'array' and frame.empty:
+                    self._close_frame(i)
+                    i += 1
+                    continue
+                i = self._start_value(char, i)
+                continue
+
+            if state == 'key':
+                if char == '"':
+                    self._string_is_key = True
+                    self._value_start = i
+                    self._state = 'string'
+                elif char == '}' and frame.empty:
+                    self._close_frame(i)
+                else:
+                    self._abort(f"Expected object key at {self._format_path(frame.path)}", i)
+                i += 1
+                continue
+
+            if state == 'colon':
+                if char != ':':
+                    self._abort(f"Expected ':' after key {frame.key!r}", i)
+                self._state = 'value'
+                i += 1
+                continue
+
+            if state == 'after_value':
+                if char == ',':
+                    self._state = 'key' if frame.kind == 'object' else 'value'
+                elif (char == '}' and frame.kind == 'object') or (char == ']' and frame.kind == 'array'):
+                    self._close_frame(i)
+                else:
+                    self._abort(f"Unexpected {char!r} in {frame.kind} at {self._format_path(frame.path)}", i)
+                i += 1
+                continue
+
+        self._pos = i
+        return self._emitted
+
+    def close(self) -> Any:
+        """
+        Finish parsing
+
+        Returns:
+            The parsed document
+
+        Raises:
+            MalformedJSONError: If the response ended before the document did
+        """
+        if self._state == 'scalar' and not self._stack:
+            # A bare top-level number or literal has no closing delimiter
+            self._finish_scalar(len(self._buf))
+        if self._state == 'preamble':
+            self._abort("No JSON document found in response", len(self._buf))
+        if self._state != 'done':
+            self._abort("Response ended before the JSON document was complete", len(self._buf))
+        if not self._decoded:
+            start, end = self._document_span
+            self._result = self._decode(start, end, ())
+            self._decoded = True
+        return self._result
+
+    def _start_value(self, char: str, i: int) -> int:
+        parent = self._stack[-1] if self._stack else None
+        if parent is None:
+            path: Path = ()
+            schema = self.schema
+        elif parent.kind == 'object':
+            path = parent.path + (parent.key,)
+            schema = self._child_schema(parent.schema, parent.key)
+        else:
+            path = parent.path + (parent.index,)
+            schema = self._child_schema(parent.schema, None)
+
+        kind = _START_KINDS.get(char)
+        if kind is None and (char == '-' or char.isdigit()):
+            kind = 'number'
+        if kind is None:
+            self._abort(f"Unexpected {char!r} where a value was expected at {self._format_path(path)}", i)
+
+        schema = self._check_type(schema, kind, path, i)
+        if parent is not None:
+            parent.empty = False
+
+        if kind in ('object', 'array'):
+            self._stack.append(_Frame(kind, path, schema, i))
+            self._state = 'key' if kind == 'object' else 'value'
+            return i + 1
+
+        self._value_start = i
+        self._value_path = path
+        if kind == 'string':
+            self._string_is_key = False
+            self._state = 'string'
+            return i + 1
+        self._state = 'scalar'
+        return i
+
+    def _finish_string(self, end: int) -> None:
+        if self._string_is_key:
+            frame = self._stack[-1]
+            frame.key = self._decode(self._value_start, end, frame.path)
+            frame.keys.add(frame.key)
+            self._state = 'colon'
+            return
+        value = self._decode(self._value_start, end, self._value_path)
+        self._value_completed(self._value_path, self._value_start, end, value)
+
+    def _finish_scalar(self, end: int) -> None:
+        span = self._buf[self._value_start:end]
+        try:
+            value = json.loads(span)
+        except ValueError:
+            self._abort(f"Invalid literal {span!r} at {self._format_path(self._value_path)}", self._value_start)
+        self._value_completed(self._value_path, self._value_start, end, value)
+
+    def _decode(self, start: int, end: int, path: Path) -> Any:
+        """Decode a completed value; the scanner lets through what json rejects (e.g. raw newlines in strings)"""
+        try:
+            return json.loads(self._buf[start:end])
+        except json.JSONDecodeError as e:
+            self._abort(f"Invalid value at {self._format_path(path)} ({e})", start + e.pos)
+
+    def _close_frame(self, i: int) -> None:
+        frame = self._stack.pop()
+        if frame.kind == 'object' and frame.schema:
+            missing = [key for key in frame.schema.get('required', []) if key not in frame.keys]
+            if missing:
+                self._abort(f"Missing required keys {missing} at {self._format_path(frame.path)}", i)
+        self._value_completed(frame.path, frame.start, i + 1, None)
+
+    def _value_completed(self, path: Path, start: int, end: int, value: Any) -> None:
+        if self._stack:
+            parent = self._stack[-1]
+            if parent.kind == 'array':
+                parent.index += 1
+            self._state = 'after_value'
+        else:
+            self._state = 'done'
+
+        emit = path and self._matches_item_path(path[:-1])
+        if not self._stack:
+            # The document itself is only decoded on demand in close()
+            self._document_span = (start, end)
+            if value is not None:
+                self._result = value
+                self._decoded = True
+        if value is None and emit:
+            value = self._decode(start, end, path)
+        if emit:
+            self._emitted.append((path, value))
+            if self.on_item:
+                self.on_item(path, value)
+
+    def _matches_item_path(self, parent_path: Path) -> bool:
+        for item_path in self.item_paths:
+            if len(item_path) == len(parent_path) and all(
+                    expected == '*' or expected == actual for expected, actual in zip(item_path, parent_path)):
+                return True
+        return False
+
+    def _resolve(self, schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        while schema:
+            if '$ref' in schema:
+                schema = self._lookup_ref(schema['$ref'])
+            elif len(schema.get('allOf', [])) == 1:
+                schema = schema['allOf'][0]
+            else:
+                break
+        return schema
+
+    def _lookup_ref(self, ref: str) -> Optional[Dict[str, Any]]:
+        if not ref.startswith('#/'):
+            return None
+        node: Any = self.schema
+        for part in ref[2:].split('/'):
+            if not isinstance(node, dict):
+                return None
+            node = node.get(part)
+        return node
+
+    def _child_schema(self, schema: Optional[Dict[str, Any]], key: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not schema:
+            return None
+        if key is None:
+            items = schema.get('items')
+            return items if isinstance(items, dict) else None
+        child = schema.get('properties', {}).get(key)
+        if child is None and isinstance(schema.get('additionalProperties'), dict):
+            child = schema['additionalProperties']
+        return child
+
+    def _check_type(self, schema: Optional[Dict[str, Any]], kind: str, path: Path, i: int) -> Optional[Dict[str, Any]]:
+        schema = self._resolve(schema)
+        if not schema:
+            return None
+        branches = schema.get('anyOf') or schema.get('oneOf')
+        if branches:
+            for branch in branches:
+                branch = self._resolve(branch)
+                if not branch or self._type_allows(branch, kind):
+                    return branch
+            for branch in branches:
+                branch = self._resolve(branch)
+                if self._structure_allows(branch, kind):
+                    return branch
+        elif self._structure_allows(schema, kind):
+            return schema
+        self._abort(f"Expected {self._describe(schema)} at {self._format_path(path)}, got {kind}", i)
+
+    @staticmethod
+    def _type_allows(schema: Dict[str, Any], kind: str) -> bool:
+        expected = schema.get('type')
+        if expected is None:
+            return True
+        types = [expected] if isinstance(expected, str) else expected
+        return kind in types or (kind == 'number' and 'integer' in types)
+
+    def _structure_allows(self, schema: Dict[str, Any], kind: str) -> bool:
+        if self._type_allows(schema, kind):
+            return True
+        if not self.coerce_scalars or kind in ('object', 'array'):
+            return False
+        expected = schema.get('type')
+        types = [expected] if isinstance(expected, str) else expected
+        return not any(t in ('object', 'array') for t in types)
+
+    def _describe(self, schema: Dict[str, Any]) -> str:
+        branches = schema.get('anyOf') or schema.get('oneOf')
+        if branches:
+            return '|'.join(str((self._resolve(b) or {}).get('type', 'any')) for b in branches)
+        return str(schema.get('type', 'any'))
+
+    @staticmethod
+    def _format_path(path: Path) -> str:
+        return '$' + ''.join(f'[{p}]' if isinstance(p, int) else f'.{p}' for p in path)
+
+    def _abort(self, message: str, position: int) -> None:
+        self._state = 'failed'
+        raise MalformedJSONError(message, position, self._buf)
+
+
+def parse_json_document(text: str, schema: Optional[Dict[str, Any]] = None) -> Any:
+    """
+    Parse a complete LLM response that contains a JSON document
+
+    Args:
+        text: Full response text, possibly wrapped in markdown or prose
+        schema: Expected JSON schema of the document (optional)
+
+    Returns:
+        The parsed document
+
+    Raises:
+        MalformedJSONError: If no valid document could be parsed
+    """
+    parser = IncrementalJSONParser(schema=schema, max_preamble=None)
+    parser.feed(text)
+    return parser.close()
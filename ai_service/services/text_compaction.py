@@ -0,0 +1,135 @@
+import re
+from typing import Any, Dict, List, Set, Tuple
+
+# Page markers written by OCRService between the pages of a PDF
+PAGE_MARKER = re.compile(r'^--- Page (\d+) ---$', re.MULTILINE)
+
+# Lines repeated across pages are only dropped if at least this long, so
+# short table cells such as "Negative" are never lost
+MIN_REPEATED_LINE_CHARS = 12
+
+# Most lines of a page's header or footer: the block before its first or
+# after its last blank line. Repeated lines with digits are only dropped
+# there, so a result row such as the same analyte on two pages of a
+# cumulative report is kept.
+HEADER_FOOTER_LINES = 3
+
+DIGIT = re.compile(r'\d')
+
+# Report furniture that carries nothing for the analysis
+BOILERPLATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'^page\s*\d+\s*((of|/)\s*\d+)?$',
+    r'computer[- ]generated (report|document)',
+    r'does not require (a |any )?(physical )?signature',
+    r'^[-*=\s]*end of (the )?report[-*=\s]*$',
+    r'results? (relates?|pertains?|applies|apply) only to the (sample|specimen)s?',
+    r'not (valid )?for medico[- ]?legal purposes?',
+    r'^printed (on|by|at)\b',
+)]
+
+
+def _normalize_line(line: str) -> str:
+    return ' '.join(line.split())
+
+
+def _is_boilerplate(line: str) -> bool:
+    return any(pattern.search(line) for pattern in BOILERPLATE_PATTERNS)
+
+
+def _band(lines: List[str], indices) -> List[int]:
+    """Leading block of the given line indices, up to a blank line and HEADER_FOOTER_LINES lines; boilerplate is skipped"""
+    band: List[int] = []
+    for index in indices:
+        if _is_boilerplate(lines[index]):
+            continue
+        if not lines[index]:
+            if band:
+                break
+            continue
+        band.append(index)
+        if len(band) == HEADER_FOOTER_LINES:
+            break
+    return band
+
+
+def _dedupable_lines(lines: List[str]) -> Set[int]:
+    """Indices of a page's lines that may be dropped as repeats: long enough and in the header or footer or digit-free"""
+    band = set(_band(lines, range(len(lines))) + _band(lines, reversed(range(len(lines)))))
+    return {index for index, line in enumerate(lines)
+            if len(line) >= MIN_REPEATED_LINE_CHARS and (index in band or not DIGIT.search(line))}
+
+
+def _split_pages(text: str) -> List[Tuple[str, str]]:
+    """(marker, body) of each page; text without page markers is one page with no marker"""
+    parts = PAGE_MARKER.split(text)
+    pages = [('', parts[0])] if parts[0].strip() else []
+    for index in range(1, len(parts), 2):
+        pages.append((f'--- Page {parts[index]} ---', parts[index + 1]))
+    return pages
+
+
+def compact_text(text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Strip report boilerplate and lines repeated on several pages
+
+    Whitespace is normalized, known boilerplate (page numbers, "computer
+    generated report" notes, disclaimers) is removed and lines appearing on
+    more than one page, such as lab headers and addresses, are kept only
+    where they first occur. Repeated lines holding digits are only removed
+    from the page header and footer bands, so repeated results survive.
+    Page markers are preserved.
+
+    Args:
+        text: Extracted report text
+
+    Returns:
+        Tuple of (compacted text, statistics with characters in, out and
+        saved and the number of lines removed by kind)
+    """
+    pages = []
+    for marker, body in _split_pages(text):
+        lines = [_normalize_line(line) for line in body.splitlines()]
+        pages.append((marker, lines, _dedupable_lines(lines)))
+
+    # Pages each dedupable line occurs on
+    occurrences: Dict[str, int] = {}
+    for _, lines, dedupable in pages:
+        for key in {lines[index].lower() for index in dedupable}:
+            occurrences[key] = occurrences.get(key, 0) + 1
+
+    seen = set()
+    boilerplate_lines = duplicate_lines = 0
+    output: List[str] = []
+    for marker, lines, dedupable in pages:
+        kept: List[str] = []
+        for index, line in enumerate(lines):
+            if not line:
+                # Keep single blank lines between blocks
+                if kept and kept[-1]:
+                    kept.append('')
+                continue
+            if _is_boilerplate(line):
+                boilerplate_lines += 1
+                continue
+            key = line.lower()
+            if index in dedupable and occurrences.get(key, 0) > 1:
+                if key in seen:
+                    duplicate_lines += 1
+                    continue
+                seen.add(key)
+            kept.append(line)
+
+        while kept and not kept[-1]:
+            kept.pop()
+        if kept:
+            output.extend([marker] + kept if marker else kept)
+
+    compacted = '\n'.join(output)
+    stats = {
+        'chars_in': len(text),
+        'chars_out': len(compacted),
+        'chars_saved': len(text) - len(compacted),
+        'boilerplate_lines': boilerplate_lines,
+        'duplicate_lines': duplicate_lines
+    }
+    return compacted, stats
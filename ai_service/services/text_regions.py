@@ -0,0 +1,103 @@
+import logging
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .image_preprocessing import binarize, to_gray_array
+
+logger = logging.getLogger(__name__)
+
+Box = Tuple[int, int, int, int]
+
+# Detection runs on the page scaled down to this width
+DETECTION_WIDTH = 600
+
+# Bands are split at gaps wider than this many times the page's median gap
+# between lines (and at least the median line height)
+ROW_GAP_FACTOR = 2.0
+
+# Minimum whitespace gap between pieces within a band, as a fraction of the page width
+MIN_COLUMN_GAP = 0.04
+
+# Pieces denser than this are pictures or logos rather than text
+MAX_TEXT_DENSITY = 0.45
+
+# Pieces with less ink than this (in detection pixels) are specks
+MIN_BLOCK_PIXELS = 12
+
+# Padding around each region in full-resolution pixels
+BLOCK_PADDING = 12
+
+
+def _runs(profile: np.ndarray, min_gap: int) -> List[Tuple[int, int]]:
+    """Inked runs of a projection profile, merging runs separated by less than min_gap"""
+    inked = profile > 0
+    if not inked.any():
+        return []
+    # Starts and ends of the inked runs
+    edges = np.diff(np.concatenate(([0], inked.astype(np.int8), [0])))
+    starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    # Keep only the gaps wide enough to split on
+    split = (starts[1:] - ends[:-1]) >= min_gap
+    run_starts = np.concatenate(([starts[0]], starts[1:][split]))
+    run_ends = np.concatenate((ends[:-1][split], [ends[-1]]))
+    return list(zip(run_starts.tolist(), run_ends.tolist()))
+
+
+def _row_gap(row_profile: np.ndarray) -> int:
+    """Gap separating text bands: a paragraph break relative to the page's own line spacing"""
+    lines = _runs(row_profile, 1)
+    if len(lines) < 2:
+        return 1
+    heights = [end - start for start, end in lines]
+    gaps = [start - end for (_, end), (start, _) in zip(lines, lines[1:])]
+    return max(2, int(ROW_GAP_FACTOR * float(np.median(gaps))), int(np.median(heights)))
+
+
+def _looks_like_text(piece: np.ndarray) -> bool:
+    rows = np.nonzero(piece.any(axis=1))[0]
+    if not len(rows):
+        return False
+    tight = piece[rows[0]:rows[-1] + 1]
+    return tight.sum() >= MIN_BLOCK_PIXELS and tight.mean() <= MAX_TEXT_DENSITY
+
+
+def detect_text_regions(image: Image.Image) -> List[Box]:
+    """
+    Find the text regions of a page
+
+    The page is downsampled and binarized, then cut into horizontal bands at
+    gaps of its row profile that are wide for its line spacing. Within each
+    band the column profile separates pieces; specks and pieces too dense to
+    be text (logos, photos) are dropped and the band is trimmed to the
+    remaining text. Bands are not split into columns, so table rows stay on
+    one line for OCR.
+
+    Returns:
+        Boxes (left, top, right, bottom) in full-resolution pixels, top to bottom
+    """
+    width, height = image.size
+    factor = max(1, int(np.ceil(width / DETECTION_WIDTH)))
+    small = image.convert('L').reduce(factor) if factor > 1 else image.convert('L')
+    ink = binarize(to_gray_array(small))
+
+    row_profile = ink.sum(axis=1)
+    min_column_gap = max(1, int(MIN_COLUMN_GAP * ink.shape[1]))
+
+    regions = []
+    for band_top, band_bottom in _runs(row_profile, _row_gap(row_profile)):
+        band = ink[band_top:band_bottom]
+        pieces = [(start, end) for start, end in _runs(band.sum(axis=0), min_column_gap)
+                  if _looks_like_text(band[:, start:end])]
+        if not pieces:
+            continue
+        left, right = pieces[0][0], pieces[-1][1]
+        text_ink = np.zeros_like(band)
+        for start, end in pieces:
+            text_ink[:, start:end] = band[:, start:end]
+        rows = np.nonzero(text_ink.any(axis=1))[0]
+        top, bottom = band_top + int(rows[0]), band_top + int(rows[-1]) + 1
+        regions.append((max(0, left * factor - BLOCK_PADDING), max(0, top * factor - BLOCK_PADDING),
+                        min(width, right * factor + BLOCK_PADDING), min(height, bottom * factor + BLOCK_PADDING)))
+    return regions
@@ -0,0 +1,29 @@
+import io
+import os
+import tempfile
+from typing import BinaryIO, Optional
+
+from flask import Request
+
+# Uploads up to this size stay in memory; larger ones are spooled to disk
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv('UPLOAD_SPOOL_THRESHOLD', 1024 * 1024))
+
+
+class SpoolingRequest(Request):
+    """
+    Request class that writes large multipart uploads straight to a named
+    temporary file.
+
+    The file keeps a real path, so PDFs can be memory-mapped and rasterized
+    from disk without another copy. It is deleted when the request closes its
+    files.
+    """
+
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None,
+                         content_length: Optional[int] = None) -> BinaryIO:
+        size = content_length or total_content_length
+        if size is not None and size <= UPLOAD_SPOOL_THRESHOLD:
+            return io.BytesIO()
+        suffix = os.path.splitext(filename or '')[1].lower()
+        return tempfile.NamedTemporaryFile('wb+', prefix='upload-', suffix=suffix)
@@ -0,0 +1,372 @@
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from .metrics import metrics
+from .vitals_trends import VITAL_SERIES
+
+try:
+    import fcntl
+except ImportError:  # Windows; the single process is not enforced there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                  'data', 'anomaly_state.json')
+
+# Smallest standard deviation assumed per series, so a patient with very
+# steady readings is not alerted on ordinary measurement noise
+MIN_STD = {
+    'systolic': 4.0,
+    'diastolic': 3.0,
+    'blood sugar': 8.0,
+    'heart rate': 4.0,
+    'weight': 0.5,
+    'cholesterol': 8.0,
+}
+
+# State per patient series: [readings, EWMA mean, EWMA variance, upper CUSUM, lower CUSUM,
+# outside concerning bounds, UNIX time of the newest learned reading]
+COUNT, MEAN, VARIANCE, CUSUM_HIGH, CUSUM_LOW, OUTSIDE, LAST_TIME = range(7)
+STATE_SIZE = 7
+SNAPSHOT_VERSION = 2
+
+metrics.describe('vitals_anomaly_readings_total', 'Vital readings scored by the online anomaly detector')
+metrics.describe('vitals_anomaly_alerts_total', 'Vital sign alerts raised by type')
+
+
+class AnomalyStateLockedError(Exception):
+    """The detector state is owned by another process of the service"""
+
+
+class OnlineAnomalyDetector:
+    """
+    Per-patient online anomaly detection for incoming vital readings.
+
+    Each patient series (e.g. a patient's systolic pressure) keeps seven
+    numbers: an exponentially weighted mean and variance of its readings, two
+    CUSUM sums of their standardized deviations, the reading count, whether
+    the last reading was beyond the vital's concerning bounds and the time of
+    the newest learned reading. Scoring a reading is O(1) and raises:
+
+    - ``spike``: the reading is ``z_threshold`` standard deviations from the patient's mean
+    - ``drift``: a CUSUM sum crossed ``cusum_h``, i.e. a sustained shift from the mean
+    - ``out_of_range``: the reading crossed the concerning bounds of VITAL_SERIES
+
+    Spike and drift need ``warmup`` readings first. Spikes update the mean as
+    if they were at the threshold, so one bad reading barely moves the baseline.
+    Readings not newer than the last learned one (gateway retries, backfills)
+    are scored against the baseline and checked against the concerning
+    bounds, but not learned. Dates more than ``max_skew_seconds`` past the
+    arrival time are taken as the arrival time, so a device with a wrong
+    clock cannot hold back the series' later readings.
+    The state is snapshotted to disk at most every ``snapshot_seconds`` and at
+    exit, and reloaded on start.
+
+    The baselines live in the memory of one process, so only one process may
+    run the detector: the first to score a reading locks the state file (see
+    claim) and other processes are refused.
+    """
+
+    def __init__(self, state_path: Optional[str] = None, alpha: Optional[float] = None,
+                 z_threshold: Optional[float] = None, cusum_k: Optional[float] = None,
+                 cusum_h: Optional[float] = None, warmup: Optional[int] = None,
+                 snapshot_seconds: Optional[float] = None, max_skew_seconds: Optional[float] = None):
+        """
+        Initialize the detector, restoring the last snapshot
+
+        Args:
+            state_path: Snapshot file (defaults to ANOMALY_STATE_PATH or ai_service/data)
+            alpha: EWMA weight of a new reading (defaults to ANOMALY_EWMA_ALPHA)
+            z_threshold: Standard deviations from the mean that make a spike (defaults to ANOMALY_Z_THRESHOLD)
+            cusum_k: CUSUM allowance in standard deviations (defaults to ANOMALY_CUSUM_K)
+            cusum_h: CUSUM decision threshold in standard deviations (defaults to ANOMALY_CUSUM_H)
+            warmup: Readings learned before spikes and drifts are raised (defaults to ANOMALY_WARMUP_READINGS)
+            snapshot_seconds: Least interval between snapshots (defaults to ANOMALY_SNAPSHOT_SECONDS)
+            max_skew_seconds: How far past arrival a reading's date is trusted (defaults to
+                ANOMALY_MAX_CLOCK_SKEW_SECONDS)
+        """
+        self.state_path = state_path or os.getenv('ANOMALY_STATE_PATH', DEFAULT_STATE_PATH)
+        self.alpha = alpha or float(os.getenv('ANOMALY_EWMA_ALPHA', 0.1))
+        self.z_threshold = z_threshold or float(os.getenv('ANOMALY_Z_THRESHOLD', 4.0))
+        self.cusum_k = cusum_k if cusum_k is not None else float(os.getenv('ANOMALY_CUSUM_K', 0.5))
+        self.cusum_h = cusum_h or float(os.getenv('ANOMALY_CUSUM_H', 5.0))
+        self.warmup = warmup if warmup is not None else int(os.getenv('ANOMALY_WARMUP_READINGS', 10))
+        self.snapshot_seconds = snapshot_seconds if snapshot_seconds is not None else \
+            float(os.getenv('ANOMALY_SNAPSHOT_SECONDS', 30))
+        self.max_skew_seconds = max_skew_seconds if max_skew_seconds is not None else \
+            float(os.getenv('ANOMALY_MAX_CLOCK_SKEW_SECONDS', 300))
+        self._lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._claim_lock = threading.Lock()
+        self._claimed = False
+        self._lock_handle = None
+        # Restored once this process claims the state
+        self._state: Dict[str, List[float]] = {}
+        self._dirty = False
+        self._last_snapshot = time.monotonic()
+        atexit.register(self.snapshot)
+
+    def score(self, patient_id: str, vital_type: str, reading: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Score a new reading against the patient's history and learn from it
+
+        Args:
+            patient_id: Patient identifier
+            vital_type: Key of VITAL_SERIES
+            reading: Reading with the vital's fields and a 'date' (arrival time when missing or invalid)
+
+        Returns:
+            {'series': per-series value, expected value, z-score, CUSUM sums and
+            whether the reading was learned, 'alerts': raised alerts, most severe first}
+
+        Raises:
+            AnomalyStateLockedError: If another process runs the detector
+        """
+        self.claim()
+        series, alerts = {}, []
+        arrival = time.time()
+        timestamp = _reading_time(reading, arrival)
+        if timestamp > arrival + self.max_skew_seconds:
+            logger.warning(f"Reading of patient {patient_id} dated {reading.get('date')} is in the future; "
+                           f"using its arrival time")
+            timestamp = arrival
+        with self._lock:
+            for name, field, unit, _, concerning in VITAL_SERIES[vital_type]:
+                try:
+                    value = float(reading.get(field))
+                except (TypeError, ValueError):
+                    continue
+                if not math.isfinite(value):
+                    continue
+                state = self._state.setdefault(f'{patient_id}|{vital_type}|{field}',
+                                               [0, 0.0, 0.0, 0.0, 0.0, 0, 0.0])
+                if state[COUNT] and timestamp <= state[LAST_TIME]:
+                    series[name] = self._score_only(state, name, value)
+                    # Not compared with the newest reading, so raised whenever outside the bounds
+                    alert = _range_alert(name, unit, concerning, value, state[MEAN])
+                    series_alerts = [alert] if alert else []
+                else:
+                    state[LAST_TIME] = timestamp
+                    series[name], series_alerts = self._update(state, name, unit, concerning, value)
+                alerts.extend(dict(alert, vitalType=vital_type, series=name, value=value)
+                              for alert in series_alerts)
+            self._dirty = self._dirty or bool(series)
+
+        metrics.inc('vitals_anomaly_readings_total', vital=vital_type)
+        for alert in alerts:
+            metrics.inc('vitals_anomaly_alerts_total', type=alert['type'])
+            logger.warning(f"Vital alert for patient {patient_id}: {alert['message']}")
+        alerts.sort(key=lambda alert: alert['severity'] != 'high')
+        self._maybe_snapshot()
+        return {'series': series, 'alerts': alerts}
+
+    def _update(self, state: List[float], name: str, unit: str, concerning, value: float):
+        """Score a value against one series state and update it; called with the lock held"""
+        alerts = []
+        count, mean = state[COUNT], state[MEAN]
+        std = max(math.sqrt(state[VARIANCE]), MIN_STD.get(name, 0.0))
+        warmed_up = count >= self.warmup
+        z = (value - mean) / std if count else 0.0
+
+        if warmed_up:
+            if abs(z) >= self.z_threshold:
+                alerts.append({
+                    'type': 'spike',
+                    'severity': 'high' if abs(z) >= 2 * self.z_threshold else 'moderate',
+                    'expected': round(mean, 1),
+                    'message': f"{name.capitalize()} {value:g} {unit} is {abs(z):.1f} standard deviations "
+                               f"{'above' if z > 0 else 'below'} this patient's usual {mean:.0f} {unit}"
+                })
+            # Capped like the learned value, so a lone spike cannot pass for a drift
+            step = min(max(z, -self.z_threshold), self.z_threshold)
+            state[CUSUM_HIGH] = max(0.0, state[CUSUM_HIGH] + step - self.cusum_k)
+            state[CUSUM_LOW] = max(0.0, state[CUSUM_LOW] - step - self.cusum_k)
+            for index, direction in ((CUSUM_HIGH, 'rising'), (CUSUM_LOW, 'falling')):
+                if state[index] > self.cusum_h:
+                    alerts.append({
+                        'type': 'drift',
+                        'severity': 'moderate',
+                        'expected': round(mean, 1),
+                        'message': f"{name.capitalize()} has been {direction} from this patient's "
+                                   f"usual {mean:.0f} {unit} over recent readings"
+                    })
+                    # Start watching for the next shift
+                    state[CUSUM_HIGH] = state[CUSUM_LOW] = 0.0
+
+        alert = _range_alert(name, unit, concerning, value, mean if count else None)
+        if alert and not state[OUTSIDE]:
+            alerts.append(alert)
+        state[OUTSIDE] = int(alert is not None)
+
+        # Spikes are learned at the threshold so they barely shift the baseline
+        learned = min(max(value, mean - self.z_threshold * std), mean + self.z_threshold * std) \
+            if warmed_up else value
+        # Cumulative averages until the EWMA weight takes over
+        alpha = max(self.alpha, 1.0 / (count + 1))
+        difference = learned - mean
+        state[MEAN] = mean + alpha * difference
+        state[VARIANCE] = (1 - alpha) * (state[VARIANCE] + alpha * difference * difference)
+        state[COUNT] = count + 1
+
+        return {
+            'value': value,
+            'expected': round(mean, 2) if count else None,
+            'z': round(z, 2),
+            'cusumHigh': round(state[CUSUM_HIGH], 2),
+            'cusumLow': round(state[CUSUM_LOW], 2),
+            'warmingUp': not warmed_up,
+            'learned': True
+        }, alerts
+
+    def _score_only(self, state: List[float], name: str, value: float) -> Dict[str, Any]:
+        """Score a value that is not newer than the series' last reading, leaving the state as is"""
+        std = max(math.sqrt(state[VARIANCE]), MIN_STD.get(name, 0.0))
+        return {
+            'value': value,
+            'expected': round(state[MEAN], 2),
+            'z': round((value - state[MEAN]) / std, 2),
+            'cusumHigh': round(state[CUSUM_HIGH], 2),
+            'cusumLow': round(state[CUSUM_LOW], 2),
+            'warmingUp': state[COUNT] < self.warmup,
+            'learned': False
+        }
+
+    def claim(self) -> None:
+        """
+        Make this process the owner of the detector state and restore it
+
+        The state file is locked for the life of the process. It is taken on
+        first use rather than at start, so a process that never scores (e.g.
+        the parent of Flask's reloader) does not hold it. A successor started
+        while the old process was exiting reads its final snapshot.
+
+        Raises:
+            AnomalyStateLockedError: If another process holds the state file
+        """
+        if self._claimed:
+            return
+        with self._claim_lock:
+            if self._claimed:
+                return
+            if fcntl is not None:
+                directory = os.path.dirname(self.state_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                handle = open(self.state_path + '.lock', 'a')
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    handle.close()
+                    raise AnomalyStateLockedError(
+                        f"Anomaly state {self.state_path} is owned by another process; "
+                        f"run the AI service as a single process")
+                self._lock_handle = handle
+            state = self._restore()
+            with self._lock:
+                self._state = state
+            self._claimed = True
+
+    def reset(self, patient_id: str) -> int:
+        """
+        Forget a patient's history; returns the number of series dropped
+
+        Raises:
+            AnomalyStateLockedError: If another process runs the detector
+        """
+        self.claim()
+        prefix = f'{patient_id}|'
+        with self._lock:
+            keys = [key for key in self._state if key.startswith(prefix)]
+            for key in keys:
+                del self._state[key]
+            self._dirty = self._dirty or bool(keys)
+        return len(keys)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'series': len(self._state),
+                'alpha': self.alpha,
+                'zThreshold': self.z_threshold,
+                'cusumK': self.cusum_k,
+                'cusumH': self.cusum_h,
+                'warmupReadings': self.warmup
+            }
+
+    def snapshot(self) -> None:
+        """Write the state to disk if it changed since the last snapshot"""
+        with self._snapshot_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                state = {key: list(values) for key, values in self._state.items()}
+                self._dirty = False
+                self._last_snapshot = time.monotonic()
+            try:
+                directory = os.path.dirname(self.state_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.state_path + '.tmp', 'w') as handle:
+                    json.dump({'version': SNAPSHOT_VERSION, 'savedAt': time.time(), 'state': state}, handle,
+                              separators=(',', ':'))
+                os.replace(self.state_path + '.tmp', self.state_path)
+            except OSError as e:
+                logger.error(f"Failed to snapshot anomaly state: {str(e)}")
+                with self._lock:
+                    self._dirty = True
+
+    def _maybe_snapshot(self) -> None:
+        if self._dirty and time.monotonic() - self._last_snapshot >= self.snapshot_seconds:
+            self.snapshot()
+
+    def _restore(self) -> Dict[str, List[float]]:
+        try:
+            with open(self.state_path) as handle:
+                state = json.load(handle).get('state', {})
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to restore anomaly state, starting empty: {str(e)}")
+            return {}
+        # Version 1 snapshots predate the last reading time; any reading is newer
+        latest = time.time() + self.max_skew_seconds
+        for values in state.values():
+            values.extend([0.0] * (STATE_SIZE - len(values)))
+            values[LAST_TIME] = min(values[LAST_TIME], latest)
+        logger.info(f"Restored anomaly state of {len(state)} patient series")
+        return state
+
+
+def _range_alert(name: str, unit: str, concerning, value: float,
+                 expected: Optional[float]) -> Optional[Dict[str, Any]]:
+    """out_of_range alert for a value beyond the series' concerning bounds, or None"""
+    low, high = concerning
+    below = low is not None and value < low
+    if not below and (high is None or value <= high):
+        return None
+    return {
+        'type': 'out_of_range',
+        'severity': 'high',
+        'expected': round(expected, 1) if expected is not None else None,
+        'message': f"{name.capitalize()} {value:g} {unit} is {'below' if below else 'above'} "
+                   f"the concerning limit of {low if below else high:g} {unit}"
+    }
+
+
+def _reading_time(reading: Dict[str, Any], arrival: float) -> float:
+    """UNIX time of a reading's date (UTC unless it has an offset), or its arrival when missing or invalid"""
+    try:
+        date = datetime.fromisoformat(str(reading['date']).replace('Z', '+00:00'))
+    except (KeyError, ValueError):
+        return arrival
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
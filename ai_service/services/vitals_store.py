@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .metrics import metrics
+from .vitals_trends import VITAL_SERIES, VitalSeries, days_to_dates
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'vitals')
+
+# Columns are little-endian float64: reading time in days since the epoch, then the series fields
+DTYPE = np.dtype('<f8')
+DAYS_COLUMN = 'days'
+
+metrics.describe('vitals_store_readings_total', 'Vital readings ingested into the columnar store')
+
+
+def vital_columns(vital_type: str) -> List[str]:
+    """Value columns stored for a vital type, one per reading field"""
+    return [field for _, field, _, _, _ in VITAL_SERIES[vital_type]]
+
+
+class VitalsStore:
+    """
+    Append-only columnar store of vital readings on the local disk.
+
+    Each patient and vital type has one file per column under
+    ``<root>/<patient hash>/<vital type>/``: the reading times and one column
+    per reading field (systolic and diastolic for blood pressure), row-aligned
+    and sorted by time. Reads memory-map the columns, so a window query is a
+    binary search and a slice. Readings newer than the stored ones are
+    appended; older ones (backfills) rewrite the vital's columns merged.
+    Duplicate readings are dropped. Reads map the columns under the
+    patient's lock, so they never pair columns from before and after a
+    rewrite. Writes assume a single writing process.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        """
+        Initialize the store
+
+        Args:
+            root: Directory of the column files (defaults to VITALS_STORE_PATH or ai_service/data/vitals)
+        """
+        self.root = root or os.getenv('VITALS_STORE_PATH', DEFAULT_ROOT)
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._patient_locks: Dict[str, threading.Lock] = {}
+
+    def ingest(self, patient_id: str, vitals: Dict[str, List[Dict[str, Any]]]) -> Dict[str, int]:
+        """
+        Store a patient's readings
+
+        Args:
+            patient_id: Patient identifier
+            vitals: Readings keyed by vital type, as sent to /api/health-insights
+
+        Returns:
+            Readings added per vital type; unknown types and unusable readings are skipped
+        """
+        added = {}
+        for vital_type, readings in vitals.items():
+            if vital_type not in VITAL_SERIES or not isinstance(readings, list):
+                continue
+            added[vital_type] = self.append(patient_id, vital_type,
+                                            [reading for reading in readings if isinstance(reading, dict)])
+        return added
+
+    def append(self, patient_id: str, vital_type: str, readings: List[Dict[str, Any]]) -> int:
+        """
+        Store readings of one vital
+
+        Args:
+            patient_id: Patient identifier
+            vital_type: Key of VITAL_SERIES
+            readings: Readings with a 'date' and the vital's fields, in any order
+
+        Returns:
+            Number of readings added
+        """
+        fields = vital_columns(vital_type)
+        series = VitalSeries.from_readings(vital_type, readings)
+        batch = np.vstack([series.days, *(series.columns[field] for field in fields)])
+        # A reading needs at least one value
+        batch = batch[:, np.isfinite(batch[1:]).any(axis=0)]
+        if not batch.shape[1]:
+            return 0
+
+        directory = self._vital_dir(patient_id, vital_type)
+        with self._patient_lock(patient_id):
+            # Only a backfill reads the stored columns; appends cost the size of the batch
+            mapped = self._map(directory, fields)
+            if mapped is not None and batch[0, 0] <= mapped[DAYS_COLUMN][-1]:
+                # Backfill: rewrite the vital merged and sorted
+                stored = np.vstack([np.array(mapped[name]) for name in [DAYS_COLUMN, *fields]])
+                merged = np.hstack([stored, batch])
+                merged = _dedupe(merged[:, np.argsort(merged[0], kind='stable')])
+                added = merged.shape[1] - stored.shape[1]
+                if added:
+                    self._rewrite(directory, fields, merged)
+            else:
+                batch = _dedupe(batch)
+                added = batch.shape[1]
+                self._append(directory, fields, batch)
+        metrics.inc('vitals_store_readings_total', added, vital=vital_type)
+        return added
+
+    def window(self, patient_id: str, vital_type: str, last_days: Optional[float] = None,
+               until: Optional[float] = None) -> VitalSeries:
+        """
+        Stored readings of one vital in a time window
+
+        Args:
+            patient_id: Patient identifier
+            vital_type: Key of VITAL_SERIES
+            last_days: Window length in days ending at ``until``; all readings when omitted
+            until: Window end as a UNIX timestamp (defaults to now)
+
+        Returns:
+            The readings as a read-only VitalSeries over the mapped columns;
+            empty when nothing is stored
+        """
+        fields = vital_columns(vital_type)
+        # A backfill replaces the column files one at a time
+        with self._patient_lock(patient_id):
+            columns = self._map(self._vital_dir(patient_id, vital_type), fields)
+        if columns is None:
+            return VitalSeries(np.empty(0), {field: np.empty(0) for field in fields})
+
+        days = columns[DAYS_COLUMN]
+        start, end = 0, len(days)
+        if last_days is not None:
+            end_day = (until if until is not None else time.time()) / 86400
+            start = int(np.searchsorted(days, end_day - last_days, side='left'))
+            end = int(np.searchsorted(days, end_day, side='right'))
+        return VitalSeries(days[start:end], {field: columns[field][start:end] for field in fields})
+
+    def readings(self, patient_id: str, vital_type: str, last_days: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Stored readings of one vital in the window, as reading dicts oldest first"""
+        return self.window(patient_id, vital_type, last_days).readings()
+
+    def daily_means(self, patient_id: str, vital_type: str,
+                    last_days: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Mean of each field per calendar day (UTC) of the window
+
+        Returns:
+            [{'date', 'count', <field>: mean or None}] per day with readings, oldest first
+        """
+        series = self.window(patient_id, vital_type, last_days)
+        if not len(series):
+            return []
+        days, columns = series.days, series.columns
+        day_numbers = np.floor(days)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(day_numbers)) + 1))
+        counts = np.diff(np.append(starts, len(days)))
+        means = {}
+        for field, column in columns.items():
+            present = np.isfinite(column)
+            totals = np.add.reduceat(np.where(present, column, 0.0), starts)
+            present_counts = np.add.reduceat(present.astype(np.int64), starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.round(totals / present_counts, 2)
+            means[field] = np.where(present_counts > 0, mean, None).tolist()
+        dates = days_to_dates(day_numbers[starts], unit='D')
+        return [dict(date=date, count=int(count), **{field: means[field][index] for field in means})
+                for index, (date, count) in enumerate(zip(dates, counts))]
+
+    def vitals(self, patient_id: str, last_days: Optional[float] = None) -> Dict[str, VitalSeries]:
+        """
+        Stored readings of every vital in the window, keyed by vital type, as
+        VitalSeries that analyze_trends and sample_readings take directly
+        """
+        vitals = {}
+        for vital_type in VITAL_SERIES:
+            series = self.window(patient_id, vital_type, last_days)
+            if len(series):
+                vitals[vital_type] = series
+        return vitals
+
+    def summary(self, patient_id: str) -> Dict[str, Dict[str, Any]]:
+        """Reading count and first and last reading dates per stored vital type"""
+        summary = {}
+        for vital_type in VITAL_SERIES:
+            days = self.window(patient_id, vital_type).days
+            if len(days):
+                first, last = days_to_dates(days[[0, -1]])
+                summary[vital_type] = {'readings': len(days), 'first': first, 'last': last}
+        return summary
+
+    def version(self, patient_id: str) -> Optional[str]:
+        """
+        Cheap fingerprint of a patient's stored readings, changing with every
+        ingest; None when nothing is stored
+        """
+        parts = []
+        for vital_type in VITAL_SERIES:
+            days = self.window(patient_id, vital_type).days
+            if len(days):
+                parts.append(f'{vital_type}:{len(days)}:{days[-1]!r}')
+        return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest() if parts else None
+
+    def delete(self, patient_id: str) -> bool:
+        """Drop a patient's readings; returns whether there were any"""
+        directory = self._patient_dir(patient_id)
+        with self._patient_lock(patient_id):
+            if not os.path.isdir(directory):
+                return False
+            shutil.rmtree(directory)
+            return True
+
+    def _patient_dir(self, patient_id: str) -> str:
+        # Hashed so ids never form paths
+        return os.path.join(self.root, hashlib.sha256(str(patient_id).encode('utf-8')).hexdigest()[:32])
+
+    def _vital_dir(self, patient_id: str, vital_type: str) -> str:
+        return os.path.join(self._patient_dir(patient_id), vital_type)
+
+    def _patient_lock(self, patient_id: str) -> threading.Lock:
+        with self._lock:
+            return self._patient_locks.setdefault(str(patient_id), threading.Lock())
+
+    @staticmethod
+    def _map(directory: str, fields: List[str]) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Memory-map a vital's columns, trimmed to their common length (after an
+        interrupted write); called with the patient's lock held
+        """
+        paths = {name: os.path.join(directory, f'{name}.f8') for name in [DAYS_COLUMN, *fields]}
+        try:
+            rows = min(os.path.getsize(path) for path in paths.values()) // DTYPE.itemsize
+        except OSError:
+            return None
+        if not rows:
+            return None
+        return {name: np.memmap(path, dtype=DTYPE, mode='r', shape=(rows,)) for name, path in paths.items()}
+
+    @staticmethod
+    def _append(directory: str, fields: List[str], batch: np.ndarray) -> None:
+        os.makedirs(directory, exist_ok=True)
+        # The reading times are written last, so readers never see rows without values
+        for name, column in reversed(list(zip([DAYS_COLUMN, *fields], batch))):
+            with open(os.path.join(directory, f'{name}.f8'), 'ab') as handle:
+                handle.write(column.astype(DTYPE).tobytes())
+
+    @staticmethod
+    def _rewrite(directory: str, fields: List[str], table: np.ndarray) -> None:
+        for name, column in zip([DAYS_COLUMN, *fields], table):
+            path = os.path.join(directory, f'{name}.f8')
+            with open(path + '.tmp', 'wb') as handle:
+                handle.write(column.astype(DTYPE).tobytes())
+            os.replace(path + '.tmp', path)
+
+
+def _dedupe(table: np.ndarray) -> np.ndarray:
+    """Drop rows equal to the previous row of a time-sorted (columns, rows) table; NaN equals NaN"""
+    if table.shape[1] < 2:
+        return table
+    same = (table[:, 1:] == table[:, :-1]) | (np.isnan(table[:, 1:]) & np.isnan(table[:, :-1]))
+    return table[:, np.concatenate(([True], ~same.all(axis=0)))]
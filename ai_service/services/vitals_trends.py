@@ -0,0 +1,447 @@
+import logging
+import math
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .series_downsampling import lttb_indices
+
+logger = logging.getLogger(__name__)
+
+# Vital type -> (series, reading field, unit, normal range, concerning bounds)
+# A bound of None means that side is not checked
+VITAL_SERIES: Dict[str, List[Tuple[str, str, str, Tuple[float, float], Tuple[Optional[float], Optional[float]]]]] = {
+    'bloodPressure': [
+        ('systolic', 'systolic', 'mmHg', (90, 120), (90, 140)),
+        ('diastolic', 'diastolic', 'mmHg', (60, 80), (None, 90)),
+    ],
+    'bloodSugar': [('blood sugar', 'value', 'mg/dL', (70, 140), (70, 200))],
+    'heartRate': [('heart rate', 'value', 'bpm', (60, 100), (50, 120))],
+    'weight': [('weight', 'value', 'kg', (0, math.inf), (None, None))],
+    'cholesterol': [('cholesterol', 'value', 'mg/dL', (0, 200), (None, 240))],
+}
+
+VITAL_LABELS = {
+    'bloodPressure': 'blood pressure',
+    'bloodSugar': 'blood sugar',
+    'heartRate': 'heart rate',
+    'weight': 'weight',
+    'cholesterol': 'cholesterol',
+}
+
+# Readings averaged by the rolling mean
+ROLLING_WINDOW = 7
+
+# Readings whose residual from the trend line is this many standard deviations out are anomalies
+ANOMALY_Z = 3.0
+
+# A trend counts when the fitted change over the observed span exceeds this
+# share of the readings' standard deviation and the fit explains enough variance
+MIN_TREND_EFFECT = 0.5
+MIN_TREND_R2 = 0.1
+
+# Weight changes are relative to the mean: per 30 days, beyond this share they are a trend,
+# beyond the second they are concerning
+WEIGHT_TREND_SHARE = 0.01
+WEIGHT_CONCERNING_SHARE = 0.03
+
+# Most recent readings always kept when a series is downsampled for a prompt
+LATEST_READINGS = 3
+
+# Trend of a multi-series vital is the most severe of its series
+TREND_SEVERITY = {'stable': 0, 'improving': 1, 'declining': 2, 'concerning': 3}
+
+RECOMMENDATIONS = {
+    'bloodPressure': {
+        'improving': ['Keep up the current treatment and lifestyle changes', 'Continue home blood pressure checks'],
+        'stable': ['Continue regular blood pressure monitoring', 'Limit salt and stay physically active'],
+        'declining': ['Reduce salt intake and review medication adherence', 'Discuss the rising readings with your healthcare provider'],
+        'concerning': ['Contact your healthcare provider about your blood pressure soon', 'Measure at the same time each day and record the readings'],
+    },
+    'bloodSugar': {
+        'improving': ['Keep following your diet and medication plan', 'Continue regular glucose checks'],
+        'stable': ['Continue regular glucose monitoring', 'Keep meals balanced and regular'],
+        'declining': ['Review carbohydrate intake and medication timing', 'Discuss the trend with your healthcare provider'],
+        'concerning': ['Contact your healthcare provider about your blood sugar soon', 'Check glucose more often until it is reviewed'],
+    },
+    'heartRate': {
+        'improving': ['Keep up your current activity level', 'Continue monitoring your resting heart rate'],
+        'stable': ['Continue regular heart rate monitoring', 'Stay physically active'],
+        'declining': ['Note symptoms such as palpitations or dizziness', 'Discuss the change with your healthcare provider'],
+        'concerning': ['Contact your healthcare provider about your heart rate soon', 'Avoid stimulants such as caffeine until reviewed'],
+    },
+    'weight': {
+        'improving': ['Keep up your current diet and activity', 'Continue weighing yourself regularly'],
+        'stable': ['Continue regular weight checks', 'Maintain a balanced diet and activity'],
+        'declining': ['Review your diet and activity level', 'Discuss the weight change with your healthcare provider'],
+        'concerning': ['Discuss the rapid weight change with your healthcare provider', 'Record your diet and symptoms until reviewed'],
+    },
+    'cholesterol': {
+        'improving': ['Keep following your diet and medication plan', 'Recheck cholesterol as scheduled'],
+        'stable': ['Recheck cholesterol as scheduled', 'Favor fiber and unsaturated fats'],
+        'declining': ['Reduce saturated fat intake and stay active', 'Discuss lipid-lowering options with your healthcare provider'],
+        'concerning': ['Contact your healthcare provider about your cholesterol', 'Review diet and medication adherence'],
+    },
+}
+
+
+def _to_days(dates: List[Any]) -> np.ndarray:
+    """Reading dates as fractional days since the epoch; unparseable dates become NaN"""
+    try:
+        # ISO strings: drop the timezone suffix and fractional seconds numpy does not parse
+        stamps = np.array([str(date)[:19] for date in dates], dtype='datetime64[s]')
+        return stamps.astype(np.float64) / 86400
+    except ValueError:
+        days = np.full(len(dates), np.nan)
+        for index, date in enumerate(dates):
+            try:
+                days[index] = datetime.fromisoformat(str(date).replace('Z', '+00:00')).timestamp() / 86400
+            except ValueError:
+                pass
+        return days
+
+
+def _to_values(values: List[Any]) -> np.ndarray:
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        parsed = np.full(len(values), np.nan)
+        for index, value in enumerate(values):
+            try:
+                parsed[index] = float(value)
+            except (TypeError, ValueError):
+                pass
+        return parsed
+
+
+def days_to_dates(days: np.ndarray, unit: str = 's') -> List[str]:
+    """ISO dates of fractional days since the epoch, at the given datetime64 unit"""
+    seconds = np.round(np.asarray(days, dtype=np.float64) * 86400).astype(np.int64)
+    return np.datetime_as_string(seconds.astype('datetime64[s]'), unit=unit).tolist()
+
+
+class VitalSeries:
+    """
+    Readings of one vital as columns: reading times in days since the epoch,
+    ascending, and the values of each reading field (NaN where a reading
+    lacks the field). ``rows`` maps each row to its position in the source
+    readings when the series was built from reading dicts.
+    """
+
+    def __init__(self, days: np.ndarray, columns: Dict[str, np.ndarray], rows: Optional[np.ndarray] = None):
+        self.days = days
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def from_readings(cls, vital_type: str, readings: List[Dict[str, Any]]) -> 'VitalSeries':
+        """Parse reading dicts, in any order; readings without a usable date are dropped"""
+        days = _to_days([reading.get('date') for reading in readings])
+        rows = np.nonzero(np.isfinite(days))[0]
+        rows = rows[np.argsort(days[rows], kind='stable')]
+        columns = {field: _to_values([reading.get(field) for reading in readings])[rows]
+                   for _, field, _, _, _ in VITAL_SERIES[vital_type]}
+        return cls(days[rows], columns, rows)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def readings(self, indices: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """Rows as reading dicts with an ISO date; missing values are None"""
+        days = self.days if indices is None else self.days[indices]
+        values = [np.where(np.isfinite(column), column, None).tolist()
+                  for column in (self.columns.values() if indices is None else
+                                 (column[indices] for column in self.columns.values()))]
+        keys = ['date', *self.columns]
+        return [dict(zip(keys, row)) for row in zip(days_to_dates(days), *values)]
+
+def series_statistics(days: np.ndarray, values: np.ndarray, normal_range: Tuple[float, float]) -> Dict[str, Any]:
+    """
+    Trend statistics of one series of readings
+
+    Args:
+        days: Reading times in days, ascending
+        values: Reading values
+        normal_range: (low, high) bounds of the normal range
+
+    Returns:
+        Count, mean, standard deviation, latest value and rolling mean, least
+        squares slope per 30 days with its R^2, time-weighted share in range
+        and readings whose residual from the trend line is anomalous
+    """
+    count = len(values)
+    mean = float(values.mean())
+    std = float(values.std())
+
+    # Least squares line through the readings
+    centered_days = days - days.mean()
+    span = float(days[-1] - days[0])
+    slope = r2 = 0.0
+    if count >= 3 and span > 0:
+        slope = float((centered_days * (values - mean)).sum() / (centered_days ** 2).sum())
+        residuals = values - (mean + slope * centered_days)
+        total = float(((values - mean) ** 2).sum())
+        r2 = 1 - float((residuals ** 2).sum()) / total if total else 0.0
+    else:
+        residuals = values - mean
+
+    # Rolling mean of the latest readings from cumulative sums
+    window = min(ROLLING_WINDOW, count)
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    rolling = (cumulative[window:] - cumulative[:-window]) / window
+
+    # Each reading stands until the next one; the last for the median interval
+    intervals = np.diff(days)
+    durations = np.append(intervals, np.median(intervals) if count > 1 else 1.0)
+    in_range = (values >= normal_range[0]) & (values <= normal_range[1])
+    time_in_range = float((durations * in_range).sum() / durations.sum()) if durations.sum() > 0 \
+        else float(in_range.mean())
+
+    residual_std = float(residuals.std())
+    z_scores = residuals / residual_std if residual_std > 0 else np.zeros(count)
+    anomalies = np.nonzero(np.abs(z_scores) >= ANOMALY_Z)[0]
+
+    return {
+        'count': count,
+        'mean': round(mean, 2),
+        'std': round(std, 2),
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'latest': round(float(values[-1]), 2),
+        'rollingMean': round(float(rolling[-1]), 2),
+        'slopePer30Days': round(slope * 30, 3),
+        'r2': round(max(0.0, r2), 3),
+        'spanDays': round(span, 1),
+        'timeInRange': round(time_in_range, 3),
+        'anomalies': [
+            {'date': str(np.datetime64(int(days[index] * 86400), 's')), 'value': float(values[index]),
+             'zScore': round(float(z_scores[index]), 2)}
+            for index in anomalies
+        ],
+        # Fitted change over the observed span, relative to the spread of the readings
+        '_effect': abs(slope) * span / std if std > 0 else 0.0
+    }
+
+
+def _classify(stats: Dict[str, Any], normal_range: Tuple[float, float],
+              concerning: Tuple[Optional[float], Optional[float]]) -> str:
+    low, high = concerning
+    level = stats['rollingMean']
+    if (low is not None and level < low) or (high is not None and level > high):
+        return 'concerning'
+
+    significant = stats['_effect'] >= MIN_TREND_EFFECT and stats['r2'] >= MIN_TREND_R2
+    if not significant:
+        return 'stable'
+    rising = stats['slopePer30Days'] > 0
+    if level > normal_range[1]:
+        trend = 'declining' if rising else 'improving'
+    elif level < normal_range[0]:
+        trend = 'improving' if rising else 'declining'
+    else:
+        # In range: only a drift that leaves the range within 90 days matters
+        projected = level + stats['slopePer30Days'] * 3
+        trend = 'declining' if projected > normal_range[1] or projected < normal_range[0] else 'stable'
+    if trend == 'declining' and stats['timeInRange'] < 0.5:
+        return 'concerning'
+    return trend
+
+
+def _classify_weight(stats: Dict[str, Any], height_cm: Optional[float]) -> str:
+    monthly_share = abs(stats['slopePer30Days']) / stats['mean'] if stats['mean'] else 0.0
+    significant = stats['_effect'] >= MIN_TREND_EFFECT and stats['r2'] >= MIN_TREND_R2
+    if not significant or monthly_share < WEIGHT_TREND_SHARE:
+        return 'stable'
+    if monthly_share >= WEIGHT_CONCERNING_SHARE:
+        return 'concerning'
+    if not height_cm:
+        return 'stable'
+    bmi = stats['rollingMean'] / (height_cm / 100) ** 2
+    losing = stats['slopePer30Days'] < 0
+    if bmi >= 25:
+        return 'improving' if losing else 'declining'
+    if bmi < 18.5:
+        return 'declining' if losing else 'improving'
+    return 'stable'
+
+
+def _describe(name: str, unit: str, stats: Dict[str, Any], normal_range: Tuple[float, float]) -> str:
+    text = (f"{name.capitalize()} averaged {stats['mean']:g} {unit} over {stats['count']} reading{'s' if stats['count'] != 1 else ''} "
+            f"(latest {stats['latest']:g}, recent average {stats['rollingMean']:g})")
+    if stats['count'] >= 3 and stats['spanDays'] > 0:
+        direction = 'rising' if stats['slopePer30Days'] > 0 else 'falling'
+        if stats['_effect'] >= MIN_TREND_EFFECT and stats['r2'] >= MIN_TREND_R2:
+            text += f", {direction} {abs(stats['slopePer30Days']):g} {unit} per month"
+        else:
+            text += ', with no clear trend'
+    if math.isfinite(normal_range[1]):
+        text += f"; in range ({normal_range[0]:g}-{normal_range[1]:g}) {stats['timeInRange']:.0%} of the time"
+    if stats['anomalies']:
+        text += f"; {len(stats['anomalies'])} unusual reading{'s' if len(stats['anomalies']) > 1 else ''}"
+    return text + '.'
+
+
+def analyze_vital(vital_type: str, readings: Union[List[Dict[str, Any]], VitalSeries],
+                  height_cm: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Trend analysis of one vital
+
+    Args:
+        vital_type: Key of VITAL_SERIES, e.g. 'bloodPressure'
+        readings: Readings with a 'date' and the series fields, in any order, or a VitalSeries
+        height_cm: Patient height, used to judge weight trends by BMI
+
+    Returns:
+        trendAnalysis entry (trend, confidence, summary, recommendations) with
+        the per-series statistics, or None if there are no usable readings
+    """
+    series = readings if isinstance(readings, VitalSeries) else VitalSeries.from_readings(vital_type, readings)
+    series_entries = []
+    for name, field, unit, normal_range, concerning in VITAL_SERIES[vital_type]:
+        values = np.asarray(series.columns[field])
+        usable = np.isfinite(values)
+        if not usable.any():
+            continue
+        days, values = np.asarray(series.days)[usable], values[usable]
+
+        stats = series_statistics(days, values, normal_range)
+        trend = _classify_weight(stats, height_cm) if vital_type == 'weight' else \
+            _classify(stats, normal_range, concerning)
+        series_entries.append((name, unit, normal_range, stats, trend))
+
+    if not series_entries:
+        return None
+
+    trend = max((entry[4] for entry in series_entries), key=TREND_SEVERITY.get)
+    count = min(entry[3]['count'] for entry in series_entries)
+    fit = max(entry[3]['r2'] for entry in series_entries)
+    # More readings and a clearer fit give more confidence
+    confidence = min(0.95, 0.3 + 0.5 * (1 - 1 / math.sqrt(count)) + 0.15 * fit)
+
+    summary = ' '.join(_describe(name, unit, stats, normal_range)
+                       for name, unit, normal_range, stats, _ in series_entries)
+    statistics = {}
+    for name, _, _, stats, series_trend in series_entries:
+        stats.pop('_effect')
+        statistics[name] = dict(stats, trend=series_trend)
+    return {
+        'trend': trend,
+        'confidence': round(confidence, 2),
+        'summary': summary,
+        'recommendations': RECOMMENDATIONS[vital_type][trend],
+        'statistics': statistics
+    }
+
+
+def sample_readings(vital_type: str, readings: Union[List[Dict[str, Any]], VitalSeries], budget: int,
+                    latest: int = LATEST_READINGS) -> List[Dict[str, Any]]:
+    """
+    Reduce a vital's readings to at most ``budget`` while keeping the shape of the series
+
+    The first series of the vital (systolic for blood pressure) is downsampled
+    with LTTB; the latest readings and the minimum and maximum of every
+    series are always kept.
+
+    Args:
+        vital_type: Key of VITAL_SERIES
+        readings: Readings with a 'date' and the series fields, in any order, or a VitalSeries
+        budget: Most readings to return
+        latest: Most recent readings always kept
+
+    Returns:
+        The kept readings, oldest first; readings without a usable date or value are dropped.
+        Readings of a VitalSeries are returned as reading dicts
+    """
+    series = readings if isinstance(readings, VitalSeries) else VitalSeries.from_readings(vital_type, readings)
+    values = np.stack([np.asarray(series.columns[field]) for _, field, _, _, _ in VITAL_SERIES[vital_type]])
+    usable = np.nonzero(np.isfinite(values).all(axis=0))[0]
+    days, values = np.asarray(series.days)[usable], values[:, usable]
+
+    count = len(usable)
+    if count > budget:
+        forced = np.concatenate((np.arange(max(0, count - latest), count),
+                                 values.argmin(axis=1), values.argmax(axis=1)))
+        forced = np.unique(forced)[-budget:]
+        shape = lttb_indices(days, values[0], max(3, budget - len(forced)))
+        kept = np.union1d(shape, forced)
+        if len(kept) > budget:
+            # Forced readings take precedence over the shape points
+            kept = np.union1d(np.setdiff1d(kept, forced)[:budget - len(forced)], forced)
+    else:
+        kept = np.arange(count)
+    if isinstance(readings, VitalSeries):
+        return series.readings(usable[kept])
+    return [readings[index] for index in series.rows[usable[kept]]]
+
+
+def analyze_trends(vitals: Dict[str, List[Dict[str, Any]]], height_cm: Any = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Trend analysis of every known vital that has readings
+
+    Args:
+        vitals: Readings keyed by vital type, as sent by the Node server, or VitalSeries
+        height_cm: Patient height in centimetres (optional)
+
+    Returns:
+        trendAnalysis entries keyed by vital type
+    """
+    try:
+        height = float(height_cm) if height_cm else None
+    except (TypeError, ValueError):
+        height = None
+
+    trends = {}
+    for vital_type in VITAL_SERIES:
+        readings = vitals.get(vital_type) or []
+        if not isinstance(readings, VitalSeries):
+            if not isinstance(readings, list):
+                continue
+            readings = [reading for reading in readings if isinstance(reading, dict)]
+        if not len(readings):
+            continue
+        try:
+            entry = analyze_vital(vital_type, readings, height)
+        except Exception as e:
+            logger.error(f"Trend analysis of {vital_type} failed: {str(e)}")
+            continue
+        if entry:
+            trends[vital_type] = entry
+    return trends
+
+
+def risk_flags(trends: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Risk factors for vitals whose trend is declining or concerning
+
+    Args:
+        trends: trendAnalysis entries from analyze_trends
+
+    Returns:
+        riskFactors entries, most severe first
+    """
+    flags = []
+    for vital_type, entry in trends.items():
+        if entry['trend'] not in ('declining', 'concerning'):
+            continue
+        label = VITAL_LABELS[vital_type]
+        # Name the flag after the level of the series that set the trend
+        condition = f'{label.capitalize()} trend'
+        for name, _, _, normal_range, _ in VITAL_SERIES[vital_type]:
+            stats = entry['statistics'].get(name)
+            if not stats or stats['trend'] != entry['trend']:
+                continue
+            if stats['rollingMean'] > normal_range[1]:
+                condition = f'Elevated {label}'
+            elif stats['rollingMean'] < normal_range[0]:
+                condition = f'Low {label}'
+            elif vital_type == 'weight':
+                condition = f"Rapid weight {'gain' if stats['slopePer30Days'] > 0 else 'loss'}"
+            break
+        flags.append({
+            'condition': condition,
+            'riskLevel': 'high' if entry['trend'] == 'concerning' else 'moderate',
+            'factors': [entry['summary']],
+            'preventionTips': entry['recommendations']
+        })
+    return sorted(flags, key=lambda flag: flag['riskLevel'] != 'high')
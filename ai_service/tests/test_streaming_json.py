@@ -0,0 +1,180 @@
+import json
+
+import pytest
+
+from services.streaming_json import IncrementalJSONParser, MalformedJSONError, parse_json_document
+
+ANALYSIS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'summary': {'type': 'string'},
+        'confidence': {'type': 'number'},
+        'testValues': {'type': 'array', 'items': {'$ref': '#/$defs/TestValue'}},
+    },
+    'required': ['summary'],
+    '$defs': {
+        'TestValue': {
+            'type': 'object',
+            'properties': {'parameter': {'type': 'string'}, 'value': {'type': 'number'}},
+            'required': ['parameter'],
+        },
+    },
+}
+
+
+def feed_in_chunks(parser, text, size):
+    for start in range(0, len(text), size):
+        parser.feed(text[start:start + size])
+    return parser.close()
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_escapes_split_across_chunks(size):
+    document = {'summary': 'quote " backslash \\ tab \t accent é emoji \U0001F600 slash /'}
+    text = json.dumps(document)
+    assert '\\\\' in text and '\\u00e9' in text
+
+    assert feed_in_chunks(IncrementalJSONParser(schema=ANALYSIS_SCHEMA), text, size) == document
+
+
+@pytest.mark.parametrize('size', [1, 2, 5])
+def test_numbers_split_across_chunks(size):
+    text = '{"summary": "ok", "confidence": -12.5e-3, "testValues": [{"parameter": "Hb", "value": 13250}]}'
+
+    result = feed_in_chunks(IncrementalJSONParser(schema=ANALYSIS_SCHEMA), text, size)
+
+    assert result['confidence'] == -12.5e-3
+    assert result['testValues'][0]['value'] == 13250
+
+
+def test_number_at_end_of_chunk_waits_for_more():
+    parser = IncrementalJSONParser()
+
+    assert parser.feed('[12') == []
+    parser.feed('34]')
+
+    assert parser.close() == [1234]
+
+
+def test_code_fence_and_chatter_are_skipped():
+    text = 'Here is the analysis:\n```json\n{"summary": "ok"}\n```\nLet me know if you need more.'
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA)
+
+    parser.feed(text)
+
+    assert parser.done
+    assert parser.document == '{"summary": "ok"}'
+    assert parser.close() == {'summary': 'ok'}
+
+
+def test_fence_split_across_chunks():
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA)
+
+    assert feed_in_chunks(parser, '```json\n{"summary": "`x`"}\n```', 4) == {'summary': '`x`'}
+
+
+def test_preamble_limit():
+    parser = IncrementalJSONParser(max_preamble=10)
+
+    with pytest.raises(MalformedJSONError, match='No JSON document'):
+        parser.feed('no json here, just a long explanation')
+
+
+def test_schema_mismatch_aborts_before_the_document_ends():
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA)
+    parser.feed('{"summary": "ok", "testValues": ')
+
+    with pytest.raises(MalformedJSONError, match=r'\$\.testValues') as raised:
+        parser.feed('{"parameter": ')
+
+    assert raised.value.position == len('{"summary": "ok", "testValues": ')
+    assert raised.value.document.startswith('{"summary"')
+    # Later chunks of an aborted stream are ignored
+    assert parser.feed('"Hb"}}') == []
+
+
+def test_schema_mismatch_in_referenced_items():
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA)
+
+    with pytest.raises(MalformedJSONError, match=r'\$\.testValues\[1\]'):
+        parser.feed('{"summary": "ok", "testValues": [{"parameter": "Hb"}, "Glucose"]')
+
+
+def test_scalar_mismatch_is_left_to_the_validator_when_coercing():
+    text = '{"summary": 12, "confidence": "0.8"}'
+
+    with pytest.raises(MalformedJSONError):
+        IncrementalJSONParser(schema=ANALYSIS_SCHEMA).feed(text)
+
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA, coerce_scalars=True)
+    parser.feed(text)
+    assert parser.close() == {'summary': 12, 'confidence': '0.8'}
+
+
+def test_missing_required_key_aborts_when_the_object_closes():
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA)
+
+    with pytest.raises(MalformedJSONError, match=r"Missing required keys \['parameter'\]"):
+        parser.feed('{"summary": "ok", "testValues": [{"value": 1}]')
+
+
+def test_on_item_receives_each_value_as_it_completes():
+    received = []
+    parser = IncrementalJSONParser(schema=ANALYSIS_SCHEMA, item_paths=[('testValues',)],
+                                   on_item=lambda path, item: received.append((path, item)))
+
+    parser.feed('{"summary": "ok", "testValues": [{"parameter": "Hb", "value": 13}, ')
+    assert received == [(('testValues', 0), {'parameter': 'Hb', 'value': 13})]
+
+    completed = parser.feed('{"parameter": "WBC"}')
+    assert completed == [(('testValues', 1), {'parameter': 'WBC'})]
+
+    parser.feed(']}')
+    assert len(received) == 2
+    assert parser.close()['testValues'][1] == {'parameter': 'WBC'}
+
+
+def test_item_path_wildcards():
+    received = []
+    parser = IncrementalJSONParser(item_paths=[('groups', '*')], on_item=lambda path, item: received.append(path))
+
+    parser.feed('{"groups": {"blood": [1, 2], "urine": [3]}}')
+
+    assert received == [('groups', 'blood', 0), ('groups', 'blood', 1), ('groups', 'urine', 0)]
+
+
+@pytest.mark.parametrize('text', ['[1, 2,]', '{"summary": "ok",}', '{"a": [1,], "b": 2}'])
+def test_trailing_commas_are_rejected(text):
+    with pytest.raises(MalformedJSONError):
+        IncrementalJSONParser().feed(text)
+
+
+@pytest.mark.parametrize('text', ['[1 2]', '{"a" 1}', '{"a": tru}', '{1: 2}', '{"a": "line\nbreak"}'])
+def test_invalid_json_is_rejected(text):
+    parser = IncrementalJSONParser()
+
+    with pytest.raises(MalformedJSONError):
+        parser.feed(text)
+        parser.close()
+
+
+def test_truncated_document_fails_on_close():
+    parser = IncrementalJSONParser()
+    parser.feed('{"summary": "cut off')
+
+    assert not parser.done
+    with pytest.raises(MalformedJSONError, match='ended before'):
+        parser.close()
+
+
+def test_max_length():
+    parser = IncrementalJSONParser(max_length=10)
+
+    with pytest.raises(MalformedJSONError, match='exceeded 10 characters'):
+        parser.feed('{"summary": "too long"}')
+
+
+def test_parse_json_document_allows_any_preamble():
+    text = 'x' * 5000 + '\n{"summary": "ok"}'
+
+    assert parse_json_document(text, schema=ANALYSIS_SCHEMA) == {'summary': 'ok'}
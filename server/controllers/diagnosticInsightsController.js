@@ -107,7 +107,8 @@ const triggerNewAnalysis = async (req, res) => {
     processTestResultAsync(testResultId, insights._id, {
       attachmentUrl,
       testType,
-      findings
+      findings,
+      force: true
     }).catch(error => {
       console.error('Error in async processing:', error);
     });
@@ -174,7 +175,9 @@ const processTestResultAsync = async (testResultId, insightsId, additionalData =
       testResultId,
       attachmentUrl: additionalData.attachmentUrl,
       testType: additionalData.testType,
-      findings: additionalData.findings
+      findings: additionalData.findings,
+      // Bypass the AI service's stored result on explicit re-analysis
+      force: Boolean(additionalData.force)
     };
 
     // Call AI service for insights generation
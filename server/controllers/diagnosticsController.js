@@ -2,6 +2,7 @@ const asyncHandler = require('express-async-handler');
 const DiagnosticTest = require('../models/DiagnosticTest');
 const Patient = require('../models/Patient');
 const User = require('../models/User');
+const aiServiceClient = require('../utils/aiServiceClient');
 
 // @desc    Get all diagnostic requests
 // @route   GET /api/diagnostics/requests
@@ -180,6 +181,11 @@ const uploadTestResult = asyncHandler(async (req, res) => {
 
   await diagnosticTest.save();
 
+  // Start text extraction now so AI insights do not wait for OCR later (fire-and-forget)
+  if (req.file) {
+    aiServiceClient.prefetchDiagnosticText(diagnosticTest.attachmentUrl);
+  }
+
   // Format the response
   const formattedResult = {
     id: `${diagnosticTest._id}-result`,
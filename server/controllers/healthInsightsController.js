@@ -119,6 +119,8 @@ const generateHealthInsights = async (patientId, forceRegenerate = false) => {
 
     // Prepare data for AI analysis
     const analysisData = {
+      // Lets the AI service cache insights per patient
+      patient_id: patientId.toString(),
       patient: {
         age: calculateAge(patient.dateOfBirth),
         gender: patient.gender,
@@ -148,7 +150,7 @@ const generateHealthInsights = async (patientId, forceRegenerate = false) => {
     };
 
     // Call AI service for insights
-    const aiInsights = await aiServiceClient.generateHealthInsights(analysisData);
+    const aiInsights = await aiServiceClient.generateHealthInsights(analysisData, forceRegenerate);
     
     // Create new insights record
     const healthInsights = new HealthInsights({
@@ -175,7 +177,10 @@ const generateHealthInsights = async (patientId, forceRegenerate = false) => {
       }
     });
 
-    await healthInsights.save();
+    // Stale AI insights are not stored, so the next request picks up the AI service's refresh
+    if (aiInsights.cacheStatus !== 'stale') {
+      await healthInsights.save();
+    }
     
     return healthInsights;
 
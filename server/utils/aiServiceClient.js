@@ -281,9 +281,10 @@ class AIServiceClient {
   /**
    * Generate health insights from patient data
    * @param {Object} patientData - Patient's medical data including vitals, medications, conditions
+   * @param {boolean} forceRefresh - Regenerate even if the AI service has cached insights for this data
    * @returns {Promise<Object>} AI-generated health insights
    */
-  async generateHealthInsights(patientData) {
+  async generateHealthInsights(patientData, forceRefresh = false) {
     try {
       console.log('Requesting health insights from AI service...');
       
@@ -291,11 +292,16 @@ class AIServiceClient {
         patient_data: patientData,
         analysis_type: 'comprehensive',
         include_trends: true,
-        include_recommendations: true
+        include_recommendations: true,
+        force_refresh: forceRefresh
       });
 
       if (response.data.success) {
-        return response.data.insights;
+        // 'stale' insights are served while the AI service regenerates them
+        return {
+          ...response.data.insights,
+          cacheStatus: response.data.cache ? response.data.cache.status : null
+        };
       } else {
         throw new Error('AI service returned unsuccessful response');
       }
@@ -387,6 +393,29 @@ class AIServiceClient {
     };
   }
 
+  /**
+   * Queue background text extraction of an uploaded diagnostic attachment
+   * so a later insights request starts from ready-made text
+   * @param {string} attachmentUrl - Attachment URL as stored on the test result
+   * @returns {Promise<Object>} Prefetch status
+   */
+  async prefetchDiagnosticText(attachmentUrl) {
+    try {
+      const response = await this.client.post('/api/ocr-prefetch', { attachmentUrl });
+      return {
+        success: true,
+        data: response.data.data
+      };
+    } catch (error) {
+      // Prefetching is an optimization; insights generation still extracts the text itself
+      console.error('OCR prefetch request failed:', error.message);
+      return {
+        success: false,
+        error: error.message
+      };
+    }
+  }
+
   /**
    * Test connection to AI service
    * @returns {Promise<boolean>} Connection status